@@ -0,0 +1,322 @@
+"""
+Generation backends for Cyber Safer.
+
+The app needs two things from a backend: a tokenizer to build prompts
+(apply_chat_template, and calling it for input_ids) and an engine with the
+BatchingEngine interface (start, stats, forget_session, and async generate
+yielding text). Pick one with CYBERS_BACKEND:
+
+  transformers  the configured Hugging Face model (CYBERS_MODEL), in this
+                process or in model workers (see workers.py)
+  tiny          a small chat model on CPU without quantization
+                (CYBERS_TINY_MODEL), for development without a GPU
+  scripted      no model at all: canned replies streamed at a fixed rate,
+                the same reply for the same prompt; for load tests and UI work
+"""
+
+import asyncio
+import hashlib
+import json
+import os
+import re
+import time
+from typing import Any, AsyncGenerator, Dict, List, Optional, Sequence, Tuple
+
+from metrics import QUEUE_WAIT
+
+# ---------- Model loading ----------
+
+def build_bnb(bits: Optional[int]):
+    if not bits:
+        return None
+    import torch
+    from transformers import BitsAndBytesConfig
+    if bits == 4:
+        return BitsAndBytesConfig(
+            load_in_4bit=True,
+            bnb_4bit_use_double_quant=True,
+            bnb_4bit_quant_type="nf4",
+            bnb_4bit_compute_dtype=torch.bfloat16 if torch.cuda.is_available() else torch.float32,
+        )
+    if bits == 8:
+        return BitsAndBytesConfig(load_in_8bit=True)
+    raise ValueError("--bits must be 4, 8, or omitted")
+
+def config_from_env() -> Dict[str, Any]:
+    """Engine settings, from the same CYBERS_* variables the app reads."""
+    return {
+        "model_name": os.getenv("CYBERS_MODEL", "meta-llama/Llama-3.1-8B-Instruct"),
+        "bits": int(os.getenv("CYBERS_BITS", "4")),
+        "trust_remote": True,
+        "device": os.getenv("CYBERS_DEVICE", "auto"),
+        "max_batch": int(os.getenv("CYBERS_MAX_BATCH", "8")),
+        "prefix_cache_mb": int(os.getenv("CYBERS_PREFIX_CACHE_MB", "512")),
+        "session_cache_mb": int(os.getenv("CYBERS_SESSION_CACHE_MB", "1024")),
+        "session_offload_mb": int(os.getenv("CYBERS_SESSION_OFFLOAD_MB", "4096")),
+        "draft_model": os.getenv("CYBERS_DRAFT_MODEL", ""),
+        "draft_tokens": int(os.getenv("CYBERS_DRAFT_TOKENS", "4")),
+        "draft_max_batch": int(os.getenv("CYBERS_DRAFT_MAX_BATCH", "4")),
+    }
+
+def load_tokenizer(config: Dict[str, Any]):
+    from transformers import AutoTokenizer
+    tok = AutoTokenizer.from_pretrained(config["model_name"], trust_remote_code=config["trust_remote"])
+    tok.padding_side = "left"
+    if tok.pad_token_id is None and tok.eos_token_id is not None:
+        tok.pad_token = tok.eos_token
+    return tok
+
+def load_engine(config: Dict[str, Any]):
+    """Load tokenizer and model and start a BatchingEngine on them, as (tok, mdl, engine)."""
+    import torch
+    from transformers import AutoModelForCausalLM
+    from engine import BatchingEngine
+
+    bits = config["bits"]
+    print(f"🛡️ Loading model: {config['model_name']}")
+    bnb = build_bnb(bits)
+    tok = load_tokenizer(config)
+
+    print(f"🔧 Quantization: {bits}-bit" if bits else "🔧 No quantization")
+    use_cuda = torch.cuda.is_available() and config.get("device") != "cpu"
+    print(f"🖥️  Device: {'CUDA' if use_cuda else 'CPU'}")
+    if use_cuda:
+        print(f"🎮 GPU: {torch.cuda.get_device_name(0)}")
+        print(f"💾 GPU Memory: {torch.cuda.get_device_properties(0).total_memory / 1e9:.2f} GB")
+    print(f"⏳ Loading model (this may take 1-2 minutes)...")
+
+    # Force CUDA usage if available - use aggressive device_map
+    if use_cuda:
+        device_map_setting = {"": 0}  # Force ALL layers to GPU 0
+        print(f"📍 Device map: Forcing all layers to GPU 0")
+    elif config.get("device") == "cpu":
+        device_map_setting = {"": "cpu"}
+        print(f"📍 Device map: CPU")
+    else:
+        device_map_setting = "auto"
+        print(f"📍 Device map: auto (CPU mode)")
+
+    mdl = AutoModelForCausalLM.from_pretrained(
+        config["model_name"],
+        device_map=device_map_setting,  # Force all to GPU
+        dtype=torch.bfloat16 if use_cuda else torch.float32,
+        trust_remote_code=config["trust_remote"],
+        quantization_config=bnb,
+        # Don't use offload_buffers - causes offloading to CPU
+    ).eval()
+
+    print(f"✅ Model loaded successfully!")
+
+    # Verify model is on GPU
+    if use_cuda:
+        model_device = next(mdl.parameters()).device
+        print(f"✅ Model is on: {model_device}")
+        if str(model_device) == "cpu":
+            print("⚠️  WARNING: Model loaded to CPU despite CUDA being available!")
+            print("   This will be MUCH slower. Check your PyTorch installation.")
+    else:
+        print(f"⚠️  Running on CPU (no CUDA available)")
+
+    print(f"📊 Model size: {sum(p.numel() for p in mdl.parameters()) / 1e9:.2f}B parameters")
+
+    draft = None
+    if config.get("draft_model"):
+        draft = load_draft(config, tok, device_map_setting, bnb, torch.bfloat16 if use_cuda else torch.float32)
+
+    max_batch = config["max_batch"]
+    prefix_mb, session_mb, offload_mb = config["prefix_cache_mb"], config["session_cache_mb"], config["session_offload_mb"]
+    engine = BatchingEngine(
+        mdl, tok,
+        max_batch_size=max_batch,
+        prefix_cache_bytes=prefix_mb * 2**20,
+        session_cache_bytes=session_mb * 2**20,
+        session_offload_bytes=offload_mb * 2**20,
+        draft_model=draft,
+        draft_tokens=config.get("draft_tokens", 4),
+        draft_max_batch=config.get("draft_max_batch", 4),
+    )
+    print(f"🧮 Continuous batching: up to {max_batch} concurrent generations")
+    print(f"🗂️  Prefix KV cache: {prefix_mb} MB" if prefix_mb else "🗂️  Prefix KV cache: disabled")
+    print(f"🗂️  Session KV cache: {session_mb} MB (+{offload_mb} MB offload)"
+          if session_mb else "🗂️  Session KV cache: disabled")
+    if draft is not None:
+        print(f"🎯 Speculative decoding: {config['draft_tokens']} draft tokens per step, "
+              f"batches up to {config['draft_max_batch']}")
+    engine.start()
+    return tok, mdl, engine
+
+def load_draft(config: Dict[str, Any], tok, device_map, bnb, dtype):
+    """Load the speculative decoding draft model, or None if it cannot share the tokenizer."""
+    from transformers import AutoModelForCausalLM, AutoTokenizer
+    name = config["draft_model"]
+    print(f"⏳ Loading draft model: {name}")
+    draft_tok = AutoTokenizer.from_pretrained(name, trust_remote_code=config["trust_remote"])
+    if draft_tok.get_vocab() != tok.get_vocab():
+        print(f"⚠️  Draft model {name} uses a different tokenizer; speculative decoding disabled")
+        return None
+    draft = AutoModelForCausalLM.from_pretrained(
+        name,
+        device_map=device_map,
+        dtype=dtype,
+        trust_remote_code=config["trust_remote"],
+        quantization_config=bnb,
+    ).eval()
+    print(f"✅ Draft model loaded ({sum(p.numel() for p in draft.parameters()) / 1e9:.2f}B parameters)")
+    return draft
+
+# ---------- Scripted backend ----------
+
+DEFAULT_SCRIPT = [
+    "That's a really good question. Before you reply to anyone online, take a second "
+    "to think about who they are and how you know it's really them.",
+    "Nice thinking! Checking things yourself, through a website or app you already "
+    "trust, is one of the best ways to stay safe online.",
+    "Hmm, I'd slow down here. Anyone who rushes you or asks for personal details "
+    "should make you a little suspicious. What do you think they're after?",
+]
+
+class ScriptedTokenizer:
+    """Just enough of a tokenizer for prompt building: one token per word."""
+
+    def apply_chat_template(self, msgs, tokenize=False, add_generation_prompt=False):
+        text = "".join(f"<{m['role']}>{m['content']}\n" for m in msgs)
+        return text + "<assistant>" if add_generation_prompt else text
+
+    def __call__(self, text: str, **kwargs) -> Dict[str, List[int]]:
+        return {"input_ids": [_word_id(word) for word in text.split()]}
+
+def _word_id(word: str) -> int:
+    # Stable across processes, unlike hash()
+    return int.from_bytes(hashlib.blake2b(word.encode(), digest_size=2).digest(), "big")
+
+class ScriptedEngine:
+    """Streams canned replies word by word; no model, same interface as BatchingEngine.
+
+    The reply is picked from the script by a hash of the prompt, so a given
+    conversation always gets the same answer. Each request waits
+    prefill_ms_per_token per prompt token, then streams tokens_per_second; at
+    most max_batch_size replies stream at once and the rest queue, like the
+    real engine.
+    """
+
+    def __init__(self, replies: Sequence[str], max_batch_size: int = 8, tokens_per_second: float = 30.0,
+                 prefill_ms_per_token: float = 0.0):
+        self.replies = [re.findall(r"\s*\S+", reply) for reply in replies] or [["..."]]
+        self.max_batch_size = max_batch_size
+        self.delay = 1 / tokens_per_second if tokens_per_second > 0 else 0
+        self.prefill = prefill_ms_per_token / 1000
+        self._slots: Optional[asyncio.Semaphore] = None
+        self._streams: Dict[str, List[List[bool]]] = {}  # session id -> cancel flag per reply
+        self.waiting = 0
+        self.active = 0
+        self.completed = 0
+
+    def start(self):
+        pass
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "queue_depth": self.waiting,
+            "batch_size": self.active,
+            "max_batch_size": self.max_batch_size,
+            "completed": self.completed,
+        }
+
+    def forget_session(self, session_id: str):
+        pass
+
+    def cancel_session(self, session_id: str):
+        for cancelled in self._streams.get(session_id, []):
+            cancelled[0] = True
+
+    async def generate(self, input_ids: List[int], max_new_tokens: int = 250,
+                       temperature: float = 0.7, top_p: float = 0.9,
+                       prefix_lengths: Sequence[int] = (),
+                       session_id: Optional[str] = None) -> AsyncGenerator[str, None]:
+        key = hashlib.blake2b(repr(list(input_ids)).encode(), digest_size=8).digest()
+        words = self.replies[int.from_bytes(key, "big") % len(self.replies)]
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.max_batch_size)
+        cancelled = [False]
+        self._streams.setdefault(session_id or "", []).append(cancelled)
+        self.waiting += 1
+        submitted_at = time.perf_counter()
+        try:
+            async with self._slots:
+                self.waiting -= 1
+                QUEUE_WAIT.observe(time.perf_counter() - submitted_at)
+                self.active += 1
+                try:
+                    await asyncio.sleep(self.prefill * len(input_ids))
+                    for i, word in enumerate(words[:max_new_tokens]):
+                        await asyncio.sleep(self.delay)
+                        if cancelled[0]:
+                            break
+                        yield word.lstrip() if i == 0 else word
+                finally:
+                    self.active -= 1
+            self.completed += 1
+        finally:
+            streams = self._streams[session_id or ""]
+            streams.remove(cancelled)
+            if not streams:
+                del self._streams[session_id or ""]
+
+def load_script(path: str) -> List[str]:
+    """Replies from a JSON list (or {"replies": [...]}), or the built-in ones."""
+    if not path:
+        return DEFAULT_SCRIPT
+    with open(path, "r", encoding="utf-8") as f:
+        data = json.load(f)
+    return data.get("replies", []) if isinstance(data, dict) else data
+
+# ---------- Backend selection ----------
+
+BACKENDS = ("transformers", "tiny", "scripted")
+
+def tiny_config(config: Dict[str, Any]) -> Dict[str, Any]:
+    """The engine config with the model swapped for a small unquantized CPU one."""
+    return dict(config, model_name=os.getenv("CYBERS_TINY_MODEL", "HuggingFaceTB/SmolLM2-135M-Instruct"),
+                bits=0, device="cpu")
+
+def model_label(name: str, config: Dict[str, Any]) -> str:
+    """What a backend generates with, for status output."""
+    if name == "scripted":
+        return "scripted"
+    return tiny_config(config)["model_name"] if name == "tiny" else config["model_name"]
+
+def load_backend(name: str, config: Dict[str, Any], workers: int = 0,
+                 addresses: Sequence[str] = (), authkey: bytes = b"") -> Tuple[Any, Any]:
+    """Load the named backend, blocking until it can generate, as (tokenizer, engine)."""
+    if name == "scripted":
+        replies = load_script(os.getenv("CYBERS_SCRIPT", ""))
+        engine = ScriptedEngine(
+            replies,
+            max_batch_size=config["max_batch"],
+            tokens_per_second=float(os.getenv("CYBERS_SCRIPTED_TPS", "30")),
+            prefill_ms_per_token=float(os.getenv("CYBERS_SCRIPTED_PREFILL_MS", "0")),
+        )
+        print(f"📜 Scripted backend: {len(replies)} replies at {os.getenv('CYBERS_SCRIPTED_TPS', '30')} tokens/s")
+        return ScriptedTokenizer(), engine
+    if name == "tiny":
+        config = tiny_config(config)
+    elif name != "transformers":
+        raise ValueError(f"Unknown backend '{name}' (choose from {', '.join(BACKENDS)})")
+    if workers or addresses:
+        from workers import WorkerPool
+        # The model lives in worker processes; this process only needs the tokenizer
+        tok = load_tokenizer(config)
+        engine = WorkerPool(config, workers=workers, addresses=addresses, authkey=authkey)
+        print(f"🔌 Model workers: {len(engine.workers)} "
+              f"({'at ' + ', '.join(addresses) if addresses else 'spawned'})")
+        engine.start()
+        try:
+            engine.wait_ready()
+        except BaseException:
+            # Nobody else holds the pool yet; without this its supervisors
+            # would keep respawning (and reloading) failed workers for good
+            engine.stop()
+            raise
+        return tok, engine
+    tok, _, engine = load_engine(config)
+    return tok, engine
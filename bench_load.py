@@ -0,0 +1,427 @@
+#!/usr/bin/env python3
+"""
+Load test: replay scripted scenario conversations against the chat API.
+
+Each virtual learner starts a scenario, answers the opener with a few canned
+replies (red flag keywords and examples from flags/*.json mixed with neutral
+ones), then completes and exits. Learners run concurrently, each with its own
+session.
+
+Measured per chat turn: time to first token (after any red flag notices),
+inter-token latency, tokens/sec and end-to-end time, summarised as
+p50/p95/p99. A probe fetches the static index page throughout, which shows
+whether streaming ever stalls the server. Streamed chunks are counted as
+tokens, which is what the engine sends unless the server coalesces them
+(CYBERS_STREAM_FLUSH_MS); chunks per reply, characters per chunk and CPU time
+show what coalescing saves.
+
+Usage:
+  python bench_load.py --mock                      # in-process app, scripted backend (no model)
+  python bench_load.py --url http://localhost:8021 --users 20 --conversations 60
+  python bench_load.py --mock --users 30 --json report.json --csv turns.csv
+  python bench_load.py --mock --users 50 --mock-tps 100 --mock-flush-ms 0   # compare with the default 30
+
+Needs httpx (pip install httpx).
+"""
+
+import argparse
+import asyncio
+import csv
+import glob
+import json
+import os
+import random
+import socket
+import statistics
+import sys
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+import httpx
+
+NEUTRAL_REPLIES = [
+    "hey",
+    "ok what do I need to do",
+    "sounds cool",
+    "wait what do you mean",
+    "hmm idk",
+    "tell me more",
+    "really?",
+    "ok",
+]
+
+# ---------- Scripts ----------
+
+def load_scripts(scenarios_dir: str = "scenarios", flags_dir: str = "flags") -> Dict[str, Dict[str, Any]]:
+    """Scenario ID -> {"red_flags", "examples": {flag: [learner replies]}}."""
+    examples = {}
+    for path in glob.glob(os.path.join(flags_dir, "*.json")):
+        with open(path, "r", encoding="utf-8") as f:
+            flag = json.load(f)
+        # Keyword phrases exercise the keyword matcher, examples the paraphrase path
+        examples[flag.get("id", os.path.basename(path)[:-5])] = flag.get("keywords", []) + flag.get("examples", [])
+    scripts = {}
+    for path in sorted(glob.glob(os.path.join(scenarios_dir, "*.json"))):
+        with open(path, "r", encoding="utf-8") as f:
+            scenario = json.load(f)
+        red_flags = scenario.get("red_flags", [])
+        scripts[scenario.get("id", os.path.basename(path)[:-5])] = {
+            "red_flags": red_flags,
+            "examples": {flag: examples.get(flag) or [flag.replace("_", " ")] for flag in red_flags},
+        }
+    return scripts
+
+def build_conversation(script: Dict[str, Any], turns: int, rng: random.Random) -> List[str]:
+    """Learner replies for one run: a neutral opener, then red flag examples and neutral filler."""
+    flags = list(script["red_flags"])
+    rng.shuffle(flags)
+    replies = [rng.choice(NEUTRAL_REPLIES)]
+    while len(replies) < turns:
+        if flags and rng.random() < 0.7:
+            replies.append(rng.choice(script["examples"][flags.pop()]))
+        else:
+            replies.append(rng.choice(NEUTRAL_REPLIES))
+    return replies
+
+# ---------- Client ----------
+
+class TurnResult:
+    """Timings for one chat turn."""
+
+    def __init__(self, user: int, scenario_id: str, turn: int, message: str):
+        self.user = user
+        self.scenario_id = scenario_id
+        self.turn = turn
+        self.message = message
+        self.status = 0
+        self.error: Optional[str] = None
+        self.ttft: Optional[float] = None
+        self.e2e: Optional[float] = None
+        self.tokens = 0
+        self.chars = 0
+        self.gaps: List[float] = []
+        self.flags = 0
+        self.abandoned = False
+
+    @property
+    def tokens_per_second(self) -> Optional[float]:
+        if self.ttft is None or self.e2e is None or self.tokens < 2 or self.e2e <= self.ttft:
+            return None
+        return (self.tokens - 1) / (self.e2e - self.ttft)
+
+    def row(self) -> Dict[str, Any]:
+        return {
+            "user": self.user,
+            "scenario": self.scenario_id,
+            "turn": self.turn,
+            "status": self.status,
+            "error": self.error or "",
+            "flags": self.flags,
+            "abandoned": int(self.abandoned),
+            "tokens": self.tokens,
+            "chars": self.chars,
+            "ttft_ms": _ms(self.ttft),
+            "mean_itl_ms": _ms(statistics.mean(self.gaps)) if self.gaps else "",
+            "tokens_per_s": round(self.tokens_per_second, 2) if self.tokens_per_second else "",
+            "e2e_ms": _ms(self.e2e),
+        }
+
+def _ms(seconds: Optional[float]):
+    return round(seconds * 1000, 1) if seconds is not None else ""
+
+async def chat_turn(client: httpx.AsyncClient, result: TurnResult, timeout: float,
+                    abandon_after: Optional[int] = None):
+    """POST one message and time the streamed reply.
+
+    Red flag notices ([COUNTER:..] and 🚩 lines, ended by a blank line) come
+    before the model's reply and are not counted as tokens. With abandon_after
+    the learner closes the connection after that many tokens, like a closed tab.
+    """
+    start = time.perf_counter()
+    last = None
+    in_preamble: Optional[bool] = None  # unknown until the first chunk
+    preamble = ""
+    try:
+        async with client.stream("POST", "/api/chat/stream", json={"message": result.message},
+                                 timeout=timeout) as response:
+            result.status = response.status_code
+            if response.status_code != 200:
+                result.error = (await response.aread()).decode(errors="replace")[:200]
+                return
+            async for chunk in response.aiter_text():
+                if in_preamble is None:
+                    in_preamble = chunk.startswith("[COUNTER:")
+                if in_preamble:
+                    preamble += chunk
+                    if "\n\n" not in preamble:
+                        continue
+                    notices, chunk = preamble.split("\n\n", 1)
+                    result.flags = notices.count("🚩")
+                    in_preamble = False
+                if not chunk:
+                    continue
+                now = time.perf_counter()
+                if result.ttft is None:
+                    result.ttft = now - start
+                else:
+                    result.gaps.append(now - last)
+                last = now
+                result.tokens += 1
+                result.chars += len(chunk)
+                if abandon_after is not None and result.tokens >= abandon_after:
+                    result.abandoned = True
+                    break
+    except httpx.HTTPError as e:
+        result.error = f"{type(e).__name__}: {e}"
+    finally:
+        result.e2e = time.perf_counter() - start
+
+async def learner(user: int, base_url: str, jobs: asyncio.Queue, results: List[TurnResult],
+                  turns: int, think_time: float, timeout: float, abandon: float, rng: random.Random):
+    """One virtual learner working through conversations from the queue."""
+    async with httpx.AsyncClient(base_url=base_url) as client:
+        while True:
+            try:
+                scenario_id, script = jobs.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            try:
+                response = await client.post(f"/api/scenario/{scenario_id}/start", timeout=timeout)
+                response.raise_for_status()
+            except httpx.HTTPError as e:
+                failed = TurnResult(user, scenario_id, 0, "(start)")
+                failed.error = f"{type(e).__name__}: {e}"
+                results.append(failed)
+                continue
+            for turn, message in enumerate(build_conversation(script, turns, rng), 1):
+                result = TurnResult(user, scenario_id, turn, message)
+                abandon_after = rng.randint(1, 5) if rng.random() < abandon else None
+                await chat_turn(client, result, timeout, abandon_after)
+                results.append(result)
+                if think_time:
+                    await asyncio.sleep(rng.uniform(0, 2 * think_time))
+            try:
+                await client.post("/api/scenario/complete", timeout=timeout)
+                await client.post("/api/scenario/exit", timeout=timeout)
+            except httpx.HTTPError:
+                pass
+
+def probe(base_url: str, interval: float, latencies: List[float], stop: threading.Event):
+    """Fetch the static index page during the run; slow answers mean a stalled event loop.
+
+    Runs on its own thread so the load client's busy event loop does not skew it.
+    """
+    with httpx.Client(base_url=base_url) as client:
+        while not stop.is_set():
+            start = time.perf_counter()
+            try:
+                client.get("/", timeout=30)
+                latencies.append(time.perf_counter() - start)
+            except httpx.HTTPError:
+                pass
+            stop.wait(interval)
+
+async def wait_ready(base_url: str, timeout: float):
+    """Wait for /api/ready (model loaded) before measuring anything."""
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient(base_url=base_url) as client:
+        while True:
+            try:
+                response = await client.get("/api/ready", timeout=5)
+                if response.status_code == 200:
+                    return
+                status = response.json().get("status")
+                if status == "error":
+                    sys.exit(f"❌ Model failed to load: {response.json().get('error')}")
+            except httpx.HTTPError:
+                pass
+            if time.monotonic() > deadline:
+                sys.exit(f"❌ {base_url} not ready after {timeout:.0f}s")
+            await asyncio.sleep(1)
+
+async def run(args) -> Dict[str, Any]:
+    rng = random.Random(args.seed)
+    scripts = load_scripts()
+    if args.scenarios:
+        scripts = {sid: s for sid, s in scripts.items() if sid in args.scenarios}
+    if not scripts:
+        sys.exit("❌ No scenarios to replay")
+    await wait_ready(args.url, args.ready_timeout)
+
+    jobs: asyncio.Queue = asyncio.Queue()
+    ids = sorted(scripts)
+    for i in range(args.conversations):
+        sid = ids[i % len(ids)] if args.round_robin else rng.choice(ids)
+        jobs.put_nowait((sid, scripts[sid]))
+
+    results: List[TurnResult] = []
+    probe_latencies: List[float] = []
+    stop = threading.Event()
+    print(f"🏋️ {args.conversations} conversations × {args.turns} turns, {args.users} concurrent learners → {args.url}")
+    start = time.perf_counter()
+    cpu_start = time.process_time()
+    prober = threading.Thread(target=probe, args=(args.url, args.probe_interval, probe_latencies, stop), daemon=True)
+    prober.start()
+    await asyncio.gather(*(
+        learner(user, args.url, jobs, results, args.turns, args.think_time, args.timeout, args.abandon,
+                random.Random(rng.random()))
+        for user in range(args.users)
+    ))
+    wall = time.perf_counter() - start
+    cpu = time.process_time() - cpu_start
+    stop.set()
+    prober.join()
+    return summarise(results, wall, cpu, args, probe_latencies)
+
+# ---------- Report ----------
+
+def percentiles(values: List[float]) -> Dict[str, Any]:
+    if not values:
+        return {"count": 0}
+    values = sorted(values)
+    def pct(p):
+        k = (len(values) - 1) * p / 100
+        lo, hi = int(k), min(int(k) + 1, len(values) - 1)
+        return values[lo] + (values[hi] - values[lo]) * (k - lo)
+    return {
+        "count": len(values),
+        "mean": round(statistics.mean(values), 2),
+        "p50": round(pct(50), 2),
+        "p95": round(pct(95), 2),
+        "p99": round(pct(99), 2),
+        "max": round(values[-1], 2),
+    }
+
+def summarise(results: List[TurnResult], wall: float, cpu: float, args,
+              probe_latencies: List[float]) -> Dict[str, Any]:
+    served = [r for r in results if r.status == 200 and not r.error]
+    # Abandoned turns count towards throughput but not towards reply timings
+    ok = [r for r in served if not r.abandoned]
+    tokens = sum(r.tokens for r in served)
+    return {
+        "config": {
+            "url": args.url,
+            "users": args.users,
+            "conversations": args.conversations,
+            "turns": args.turns,
+            "think_time": args.think_time,
+            "abandon": args.abandon,
+            "seed": args.seed,
+            "mock": args.mock,
+            "mock_flush_ms": args.mock_flush_ms,
+        },
+        "wall_seconds": round(wall, 2),
+        # In-process with --mock, so this includes the server's share
+        "cpu_seconds": round(cpu, 2),
+        "turns": len(results),
+        "errors": len(results) - len(served),
+        "abandoned": len(served) - len(ok),
+        "error_statuses": sorted({r.status for r in results if r.status != 200}),
+        "tokens": tokens,
+        "throughput_tokens_per_s": round(tokens / wall, 2) if wall else 0,
+        "turns_per_s": round(len(ok) / wall, 2) if wall else 0,
+        "ttft_ms": percentiles([r.ttft * 1000 for r in ok if r.ttft is not None]),
+        "inter_token_ms": percentiles([g * 1000 for r in ok for g in r.gaps]),
+        "tokens_per_s_per_stream": percentiles([r.tokens_per_second for r in ok if r.tokens_per_second]),
+        "e2e_ms": percentiles([r.e2e * 1000 for r in ok if r.e2e is not None]),
+        "chunks_per_reply": percentiles([r.tokens for r in ok]),
+        "chars_per_chunk": round(sum(r.chars for r in ok) / sum(r.tokens for r in ok), 1)
+                           if any(r.tokens for r in ok) else 0,
+        "static_probe_ms": percentiles([t * 1000 for t in probe_latencies]),
+        "_results": results,
+    }
+
+def print_report(report: Dict[str, Any]):
+    print(f"\n📊 {report['turns']} turns in {report['wall_seconds']}s "
+          f"({report['turns_per_s']} turns/s, {report['throughput_tokens_per_s']} tokens/s overall)")
+    if report["errors"]:
+        print(f"❌ {report['errors']} failed turns (statuses {report['error_statuses']})")
+    if report["abandoned"]:
+        print(f"✋ {report['abandoned']} turns abandoned mid-reply")
+    if report["chunks_per_reply"]["count"]:
+        print(f"📦 {report['chunks_per_reply']['mean']} chunks per reply, {report['chars_per_chunk']} chars per chunk, "
+              f"{report['cpu_seconds']}s CPU")
+    print(f"  {'':<22}{'p50':>10}{'p95':>10}{'p99':>10}{'max':>10}")
+    for label, key in (("time to first token ms", "ttft_ms"), ("inter-token ms", "inter_token_ms"),
+                       ("tokens/s per stream", "tokens_per_s_per_stream"), ("end-to-end ms", "e2e_ms"),
+                       ("static page ms", "static_probe_ms")):
+        stats = report[key]
+        if stats["count"]:
+            print(f"  {label:<22}{stats['p50']:>10}{stats['p95']:>10}{stats['p99']:>10}{stats['max']:>10}")
+
+def write_reports(report: Dict[str, Any], json_path: Optional[str], csv_path: Optional[str]):
+    results = report.pop("_results")
+    if json_path:
+        with open(json_path, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+        print(f"💾 Summary written to {json_path}")
+    if csv_path:
+        rows = [r.row() for r in results]
+        with open(csv_path, "w", encoding="utf-8", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=list(TurnResult(0, "", 0, "").row()))
+            writer.writeheader()
+            writer.writerows(rows)
+        print(f"💾 Per-turn timings written to {csv_path}")
+
+# ---------- Mock server ----------
+
+def start_mock_server(args) -> str:
+    """Serve cybers.app with the scripted backend on a free local port, return its URL."""
+    os.environ.update({
+        "CYBERS_BACKEND": "scripted",
+        "CYBERS_SCRIPTED_TPS": str(args.mock_tps),
+        "CYBERS_SCRIPTED_PREFILL_MS": str(args.mock_prefill_ms),
+        "CYBERS_MAX_BATCH": str(args.mock_batch),
+    })
+    if args.mock_flush_ms is not None:
+        os.environ["CYBERS_STREAM_FLUSH_MS"] = str(args.mock_flush_ms)
+    import uvicorn
+    import cybers
+
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    server = uvicorn.Server(uvicorn.Config(cybers.app, host="127.0.0.1", port=port, log_level="warning"))
+    threading.Thread(target=server.run, name="mock-server", daemon=True).start()
+    return f"http://127.0.0.1:{port}"
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the Cyber Safer chat API")
+    parser.add_argument("--url", default="http://localhost:8021", help="server to test")
+    parser.add_argument("--users", type=int, default=8, help="concurrent learners")
+    parser.add_argument("--conversations", type=int, default=0,
+                        help="scenario runs in total (default: 2 per learner)")
+    parser.add_argument("--turns", type=int, default=4, help="learner messages per conversation")
+    parser.add_argument("--think-time", type=float, default=0.0,
+                        help="mean seconds a learner waits between messages")
+    parser.add_argument("--abandon", type=float, default=0.0,
+                        help="fraction of replies the learner walks away from after a few tokens")
+    parser.add_argument("--probe-interval", type=float, default=0.25,
+                        help="seconds between static page fetches that check the server stays responsive")
+    parser.add_argument("--scenarios", nargs="*", help="only replay these scenario IDs")
+    parser.add_argument("--round-robin", action="store_true", help="cycle scenarios instead of sampling")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--timeout", type=float, default=300.0, help="seconds per request")
+    parser.add_argument("--ready-timeout", type=float, default=600.0, help="seconds to wait for /api/ready")
+    parser.add_argument("--json", help="write the summary here")
+    parser.add_argument("--csv", help="write per-turn timings here")
+    parser.add_argument("--mock", action="store_true",
+                        help="run the app in-process with the scripted backend instead of --url")
+    parser.add_argument("--mock-tps", type=float, default=30.0, help="mock decode rate per stream")
+    parser.add_argument("--mock-prefill-ms", type=float, default=0.5, help="mock prefill cost per prompt token")
+    parser.add_argument("--mock-batch", type=int, default=8, help="mock concurrent generations")
+    parser.add_argument("--mock-flush-ms", type=float,
+                        help="mock server's token coalescing interval (default: CYBERS_STREAM_FLUSH_MS)")
+    args = parser.parse_args()
+    args.conversations = args.conversations or 2 * args.users
+
+    if args.mock:
+        args.url = start_mock_server(args)
+    report = asyncio.run(run(args))
+    print_report(report)
+    write_reports(report, args.json, args.csv)
+    sys.exit(1 if report["errors"] else 0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmark: compiled red flag matcher vs the original keyword loop.
+Usage: python bench_redflags.py [iterations]
+"""
+
+import os
+import sys
+import json
+import time
+
+from redflags import RedFlagMatcher, load_flag_catalogue
+
+MESSAGES = [
+    "who is this?",
+    "Is that really you, Sarah? Prove who you are first",
+    "I'm not clicking that link, it looks like a scam",
+    "ok what do I need to do",
+    "Why is this so urgent? What happens if I wait?",
+    "I'm going to tell my teacher and block you",
+    "I don't trust this. Let me check the website address myself",
+    "sure, here's my password",
+    "lol you're going to hurl when you see this",
+    "I won't pay anything, I can't afford it and I'm reporting this as phishing",
+    "Why do you need my address? That's personal",
+    "I'll verify this on Instagram with the real Sarah before I do anything else at all",
+]
+
+# Phrasings the substring loop caught through plurals and longer words;
+# whole-word matching has to keep catching them (checked, not timed)
+BASELINE_PHRASES = [
+    "I will tell parents",
+    "ill tell my teacher",
+    "ask parents",
+    "tell teachers",
+    "talk to adults",
+    "suspicious links",
+    "don't give information",
+]
+
+def legacy_detect_red_flags(user_message, red_flags, extra_keywords=None):
+    """The original detect_red_flags from cybers.py, kept here as the baseline."""
+    detected = []
+    message_lower = user_message.lower()
+    flag_keywords = {
+        "questions_sender": [
+            "who are you", "who is this", "who is that",
+            "are you really", "is that really you", "is that you really", "is that you,",
+            "is this really", "are you actually", "is this actually",
+            "prove who you", "prove you're", "prove this is"
+        ],
+        "refuses_to_click": ["won't click", "not clicking", "don't trust", "suspicious link", "not opening", "won't open"],
+        "checks_url": ["url", "link", "address", "domain", "website"],
+        "reports_phishing": ["report", "spam", "phishing", "scam", "reporting"],
+        "questions_urgency": ["why urgent", "why now", "what happens if", "why 24 hours", "why immediate"],
+        "asks_for_proof": ["show me proof", "need proof", "provide evidence", "show evidence"],
+        "refuses_money": ["no money", "won't pay", "not sending", "can't afford", "won't give"],
+        "blocks_contact": ["block", "blocking you", "stop contacting", "leave me alone"],
+        "tells_adult": ["tell parent", "tell teacher", "get help", "talk to adult", "ask parent"],
+        "questions_personal_info": ["why do you need", "why personal", "don't give info"],
+        "recognizes_manipulation": ["manipulating", "trying to trick", "not fair", "guilt trip"],
+        "verifies_independently": [
+            "check myself", "look it up", "verify elsewhere",
+            "call them directly", "call you directly",
+            "verify on", "verify you on", "check on instagram", "check you on",
+            "verify this", "check this myself", "confirm myself"
+        ]
+    }
+    flag_keywords.update(extra_keywords or {})
+    for flag in red_flags:
+        keywords = flag_keywords.get(flag, [flag.replace("_", " ")])
+        if any(keyword in message_lower for keyword in keywords):
+            detected.append(flag)
+    return detected
+
+def load_flag_sets(scenarios_dir="scenarios"):
+    """The red_flags list of every scenario."""
+    flag_sets = {}
+    for filename in sorted(os.listdir(scenarios_dir)):
+        if filename.endswith(".json"):
+            with open(os.path.join(scenarios_dir, filename), "r", encoding="utf-8") as f:
+                scenario = json.load(f)
+            flag_sets[scenario.get("id", filename[:-5])] = scenario.get("red_flags", [])
+    return flag_sets
+
+def bench(label, detect, flag_sets, iterations):
+    start = time.perf_counter()
+    for _ in range(iterations):
+        for red_flags in flag_sets.values():
+            for message in MESSAGES:
+                detect(message, red_flags)
+    elapsed = time.perf_counter() - start
+    calls = iterations * len(flag_sets) * len(MESSAGES)
+    per_call = elapsed / calls * 1e6
+    print(f"  {label:<10} {per_call:8.2f} µs/message   ({calls} calls in {elapsed:.2f}s)")
+    return per_call
+
+def synthetic_keywords(n_flags):
+    """Extra flags with made-up keywords, to see how each approach scales."""
+    return {f"synthetic_{i}": [f"phrase {i} {j}" for j in range(5)] + [f"word{i}x{j}" for j in range(5)]
+            for i in range(n_flags)}
+
+def bench_scaling(catalogue, iterations):
+    print("\nScaling with catalogue size (every scenario checks every extra flag):")
+    base = load_flag_sets()
+    for n_flags in (0, 20, 100):
+        extra = synthetic_keywords(n_flags)
+        flag_sets = {sid: flags + list(extra) for sid, flags in base.items()}
+        keywords = dict(catalogue.keywords, **extra)
+        matcher = RedFlagMatcher(keywords)
+        print(f" +{n_flags} flags ({sum(len(w) for w in keywords.values())} keywords)")
+        legacy = bench("legacy", lambda m, f: legacy_detect_red_flags(m, f, extra), flag_sets, iterations)
+        compiled = bench("compiled", matcher.detect, flag_sets, iterations)
+        print(f"  speedup    {legacy / compiled:8.2f}x")
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    flag_sets = load_flag_sets()
+    scenarios = {sid: {"red_flags": flags} for sid, flags in flag_sets.items()}
+
+    build_start = time.perf_counter()
+    catalogue = load_flag_catalogue("flags", scenarios)
+    matcher = catalogue.default
+    build_ms = (time.perf_counter() - build_start) * 1000
+
+    print(f"🚩 Red flag matcher benchmark: {len(MESSAGES)} messages × {len(flag_sets)} scenarios")
+    print(f"  load       {build_ms:8.2f} ms (once at startup)")
+    legacy = bench("legacy", legacy_detect_red_flags, flag_sets, iterations)
+    compiled = bench("compiled", matcher.detect, flag_sets, iterations)
+    print(f"  speedup    {legacy / compiled:8.2f}x")
+
+    bench_scaling(catalogue, max(iterations // 10, 1))
+
+    print("\nDifferences (whole-word matching vs substring matching):")
+    differences = 0
+    all_flags = sorted(set(f for flags in flag_sets.values() for f in flags))
+    for message in MESSAGES + BASELINE_PHRASES:
+        old = set(legacy_detect_red_flags(message, all_flags))
+        new = set(matcher.detect(message, all_flags))
+        if old != new:
+            differences += 1
+            print(f"  {message!r}")
+            if old - new:
+                print(f"     only legacy:   {sorted(old - new)}")
+            if new - old:
+                print(f"     only compiled: {sorted(new - old)}")
+    if not differences:
+        print("  none")
+
+    print("\nBaseline phrases:")
+    missed = 0
+    for message in BASELINE_PHRASES:
+        detected = matcher.detect(message, all_flags)
+        missed += not detected
+        print(f"  {'✅' if detected else '❌'} {message!r}: {detected}")
+    print(f"  {len(BASELINE_PHRASES) - missed}/{len(BASELINE_PHRASES)} detected")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+"""
+Benchmark: speculative decoding (CYBERS_DRAFT_MODEL) against plain decoding.
+
+Loads the configured model and draft model once, then runs the same adversary
+turns through two engines on the same weights, one with the draft model and
+one without. Each turn is a scenario's persona, its opening message and a
+learner reply, so the replies are the short in-character ones the app serves.
+
+Reported per engine: inter-token latency (decode time per token after the
+first, p50/p95 over replies), tokens/sec, time to first token, and the draft
+acceptance rate.
+
+Usage:
+  CYBERS_DRAFT_MODEL=meta-llama/Llama-3.2-1B-Instruct python bench_speculative.py
+  python bench_speculative.py --turns 40 --concurrency 4 --greedy
+  CYBERS_BACKEND=tiny CYBERS_DRAFT_MODEL=HuggingFaceTB/SmolLM2-135M-Instruct python bench_speculative.py
+"""
+
+import argparse
+import asyncio
+import glob
+import json
+import os
+import random
+import time
+from typing import Any, Dict, List
+
+from backends import config_from_env, load_engine, tiny_config
+from engine import BatchingEngine
+
+LEARNER_REPLIES = [
+    "who is this?",
+    "why do you need my password?",
+    "ok what do I need to do",
+    "I don't trust this, I'm going to check the website myself",
+    "that sounds kind of urgent, what happens if I wait?",
+    "lol ok send me the link",
+]
+
+def system_text(player: Dict[str, Any]) -> str:
+    # Same shape as build_system_text in cybers.py
+    return " ".join([
+        f"You are {player.get('name','Assistant')}, {player.get('profession','')}.",
+        f"Your personality: {player.get('personality','')}",
+        f"Your communication style: {player.get('style','')}",
+        "Keep facts accurate." if player.get("facts_guard") else "",
+        player.get("instructions", ""),
+    ]).strip()
+
+def load_turns(tok, count: int, seed: int) -> List[Dict[str, Any]]:
+    """Prompt token IDs and sampling settings for count adversary turns."""
+    rng = random.Random(seed)
+    scenarios = []
+    for path in sorted(glob.glob("scenarios/*.json")):
+        with open(path, "r", encoding="utf-8") as f:
+            scenario = json.load(f)
+        player_path = os.path.join("players", f"{scenario.get('player', '')}.json")
+        if scenario.get("initial_message") and os.path.exists(player_path):
+            with open(player_path, "r", encoding="utf-8") as f:
+                scenarios.append((scenario, json.load(f)))
+    if not scenarios:
+        raise SystemExit("No scenarios with players found (run from the repo root)")
+    turns = []
+    for i in range(count):
+        scenario, player = scenarios[i % len(scenarios)]
+        msgs = [{"role": "system", "content": system_text(player)},
+                {"role": "assistant", "content": scenario["initial_message"]},
+                {"role": "user", "content": rng.choice(LEARNER_REPLIES)}]
+        prompt = tok.apply_chat_template(msgs, tokenize=False, add_generation_prompt=True)
+        turns.append({
+            "input_ids": tok(prompt)["input_ids"],
+            "max_new_tokens": player.get("max_tokens", 250),
+            "temperature": player.get("temperature", 0.7),
+            "top_p": player.get("top_p", 0.9),
+        })
+    return turns
+
+async def run_turn(engine: BatchingEngine, turn: Dict[str, Any], greedy: bool) -> Dict[str, float]:
+    start = time.perf_counter()
+    first = None
+    tokens = 0
+    async for _ in engine.generate(turn["input_ids"], max_new_tokens=turn["max_new_tokens"],
+                                   temperature=0 if greedy else turn["temperature"], top_p=turn["top_p"]):
+        if first is None:
+            first = time.perf_counter()
+        tokens += 1
+    end = time.perf_counter()
+    decode = end - first if first else 0
+    return {
+        "tokens": tokens,
+        "ttft": (first - start) if first else 0,
+        "itl": decode / (tokens - 1) if tokens > 1 else 0,
+        "decode": decode,
+    }
+
+async def run_engine(engine: BatchingEngine, turns: List[Dict[str, Any]], concurrency: int,
+                     greedy: bool) -> List[Dict[str, float]]:
+    gate = asyncio.Semaphore(concurrency)
+
+    async def one(turn):
+        async with gate:
+            return await run_turn(engine, turn, greedy)
+    return await asyncio.gather(*(one(t) for t in turns))
+
+def percentile(values: List[float], p: float) -> float:
+    values = sorted(values)
+    return values[min(int(round(p / 100 * (len(values) - 1))), len(values) - 1)] if values else 0
+
+def summarise(label: str, results: List[Dict[str, float]], elapsed: float) -> Dict[str, float]:
+    itl = [r["itl"] for r in results if r["tokens"] > 1]
+    tokens = sum(r["tokens"] for r in results)
+    decode = sum(r["decode"] for r in results)
+    summary = {
+        "itl_p50_ms": percentile(itl, 50) * 1000,
+        "itl_p95_ms": percentile(itl, 95) * 1000,
+        "ttft_p50_ms": percentile([r["ttft"] for r in results], 50) * 1000,
+        "tokens_per_s": tokens / decode if decode else 0,
+        "throughput": tokens / elapsed if elapsed else 0,
+        "tokens": tokens,
+    }
+    print(f"{label:<12} ITL p50 {summary['itl_p50_ms']:7.1f} ms  p95 {summary['itl_p95_ms']:7.1f} ms  "
+          f"TTFT p50 {summary['ttft_p50_ms']:7.1f} ms  {summary['tokens_per_s']:6.1f} tok/s per reply  "
+          f"{summary['throughput']:6.1f} tok/s total")
+    return summary
+
+def main():
+    parser = argparse.ArgumentParser(description="Speculative vs plain decoding")
+    parser.add_argument("--turns", type=int, default=20, help="adversary replies per engine")
+    parser.add_argument("--concurrency", type=int, default=1, help="replies decoded at once")
+    parser.add_argument("--greedy", action="store_true", help="greedy decoding instead of persona sampling")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="write the summary here")
+    args = parser.parse_args()
+
+    config = config_from_env()
+    if os.getenv("CYBERS_BACKEND") == "tiny":
+        config = tiny_config(config)
+    if not config["draft_model"]:
+        raise SystemExit("Set CYBERS_DRAFT_MODEL to the draft model to compare against")
+    # Session and prefix caches off, so both engines prefill every prompt
+    config = dict(config, prefix_cache_mb=0, session_cache_mb=0)
+    tok, mdl, speculative = load_engine(config)
+    if speculative.draft is None:
+        raise SystemExit("Draft model could not be used (see above)")
+    plain = BatchingEngine(mdl, tok, max_batch_size=config["max_batch"])
+    turns = load_turns(tok, args.turns, args.seed)
+
+    print(f"\n📊 {args.turns} replies, concurrency {args.concurrency}, "
+          f"{'greedy' if args.greedy else 'persona sampling'}, {config['draft_tokens']} draft tokens\n")
+    # Warm up both engines so neither pays first-call overhead in its timings
+    asyncio.run(run_engine(plain, turns[:1], 1, args.greedy))
+    asyncio.run(run_engine(speculative, turns[:1], 1, args.greedy))
+    speculative.drafted = speculative.accepted = 0
+
+    report = {}
+    for label, engine in (("plain", plain), ("speculative", speculative)):
+        start = time.perf_counter()
+        results = asyncio.run(run_engine(engine, turns, args.concurrency, args.greedy))
+        report[label] = summarise(label, results, time.perf_counter() - start)
+    rate = speculative.accepted / speculative.drafted if speculative.drafted else 0
+    speedup = (report["plain"]["itl_p50_ms"] / report["speculative"]["itl_p50_ms"]
+               if report["speculative"]["itl_p50_ms"] else 0)
+    report["acceptance_rate"] = rate
+    report["itl_speedup"] = speedup
+    print(f"\n🎯 Draft acceptance rate: {rate:.1%}")
+    print(f"⚡ Inter-token latency speedup (p50): {speedup:.2f}x")
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+"""
+Build the adversary reply bank (see replybank.py) offline.
+
+For every scenario, the persona answers its opening message once per learner
+intent, several times each: the red flags from flags/*.json (phrased with the
+flag's examples) plus a few neutral intents below. All prompts go to the
+engine at once, so they decode in full batches, which is far cheaper per
+reply than interactive chat.
+
+Usage:
+  python build_reply_bank.py                          # CYBERS_MODEL, bank/replies.json
+  python build_reply_bank.py --replies 12 --batch 32
+  python build_reply_bank.py --scenarios phishing_prize_winner --out bank/test.json
+  CYBERS_BACKEND=scripted python build_reply_bank.py  # pipeline check, no model
+
+The app loads the bank from CYBERS_REPLY_BANK (default bank/replies.json).
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import time
+from typing import Dict, List
+
+import cybers
+from backends import load_backend, model_label
+from content import ContentRegistry
+from replybank import BANK_VERSION, context_hash
+
+# Learner intents that are not red flags: keywords for serve-time matching,
+# examples to generate from
+NEUTRAL_INTENTS = {
+    "complies": {
+        "keywords": ["ok what do i", "what do i need to do", "how do i claim*", "sure thing", "yes please",
+                     "sounds good", "ok sure", "okay sure"],
+        "examples": ["ok what do I need to do", "sure, how do I claim it?", "yes please", "sounds good!"],
+    },
+    "greets": {
+        "keywords": ["hi", "hello", "hey", "hiya"],
+        "examples": ["hi", "hello", "hey"],
+    },
+    "confused": {
+        "keywords": ["huh", "what do you mean", "i don't understand", "i'm confused", "confused"],
+        "examples": ["huh?", "what do you mean?", "I don't understand", "I'm confused"],
+    },
+}
+
+async def generate(engine, tok, system_text: str, opener: str, learner: str, player: Dict) -> str:
+    msgs = [{"role": "system", "content": system_text},
+            {"role": "assistant", "content": opener},
+            {"role": "user", "content": learner}]
+    ids = tok(tok.apply_chat_template(msgs, tokenize=False, add_generation_prompt=True))["input_ids"]
+    pieces = [piece async for piece in engine.generate(
+        ids, max_new_tokens=player.get("max_tokens", 250), temperature=player.get("temperature", 0.7),
+        top_p=player.get("top_p", 0.9), prefix_lengths=cybers.prefix_lengths(system_text, opener))]
+    return "".join(pieces).strip()
+
+async def build(engine, tok, content: ContentRegistry, scenarios: Dict, intents: Dict[str, Dict[str, List[str]]], replies: int) -> Dict:
+    jobs = []
+    contexts = {}
+    for scenario_id, scenario in scenarios.items():
+        player = content.player(scenario.get("player") or "")
+        opener = scenario.get("initial_message")
+        if not player or not opener:
+            print(f"⏭️  {scenario_id}: no player or opening message, skipped")
+            continue
+        system_text = content.system_text(scenario["player"])
+        contexts[scenario_id] = context_hash(system_text, opener)
+        for intent, spec in intents.items():
+            phrasings = spec["examples"] or spec["keywords"]
+            for i in range(replies):
+                jobs.append((scenario_id, intent, generate(engine, tok, system_text, opener,
+                                                           phrasings[i % len(phrasings)], player)))
+    print(f"⏳ Generating {len(jobs)} replies ({len(contexts)} scenarios × {len(intents)} intents × {replies})")
+    start = time.perf_counter()
+    texts = await asyncio.gather(*(job for _, _, job in jobs))
+    print(f"✅ Generated in {time.perf_counter() - start:.1f}s")
+
+    bank = {sid: {"context": context, "replies": {}} for sid, context in contexts.items()}
+    for (scenario_id, intent, _), text in zip(jobs, texts):
+        kept = bank[scenario_id]["replies"].setdefault(intent, [])
+        if text and text not in kept:
+            kept.append(text)
+    return bank
+
+def main():
+    parser = argparse.ArgumentParser(description="Build the adversary reply bank")
+    parser.add_argument("--out", default=os.getenv("CYBERS_REPLY_BANK", "bank/replies.json"))
+    parser.add_argument("--replies", type=int, default=8, help="replies generated per scenario and intent")
+    parser.add_argument("--batch", type=int, default=32, help="engine batch size")
+    parser.add_argument("--scenarios", nargs="*", help="only these scenario IDs")
+    args = parser.parse_args()
+
+    content = ContentRegistry("scenarios", "players", "flags")
+    content.load()
+    scenarios = content.scenarios
+    if args.scenarios:
+        scenarios = {sid: s for sid, s in scenarios.items() if sid in args.scenarios}
+    catalogue = content.flags
+    intents = {flag: {"keywords": catalogue.keywords[flag], "examples": catalogue.examples.get(flag, [])}
+               for flag in catalogue.keywords if catalogue.keywords[flag]}
+    intents.update(NEUTRAL_INTENTS)
+
+    # Session caches are no use to one-off prompts; shared prefixes still are
+    config = dict(cybers.ENGINE_CONFIG, max_batch=args.batch, session_cache_mb=0)
+    tok, engine = load_backend(cybers.BACKEND, config)
+    cybers.tok = tok
+    bank = asyncio.run(build(engine, tok, content, scenarios, intents, args.replies))
+
+    os.makedirs(os.path.dirname(args.out) or ".", exist_ok=True)
+    with open(args.out, "w", encoding="utf-8") as f:
+        json.dump({
+            "version": BANK_VERSION,
+            "model": model_label(cybers.BACKEND, cybers.ENGINE_CONFIG),
+            "built": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "intents": {intent: spec["keywords"] for intent, spec in intents.items()},
+            "scenarios": bank,
+        }, f, ensure_ascii=False, indent=1)
+    total = sum(len(t) for entry in bank.values() for t in entry["replies"].values())
+    print(f"💾 Wrote {total} replies for {len(bank)} scenarios to {args.out}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,204 @@
+"""
+Scenario and persona content for Cyber Safer, parsed once and kept in memory.
+
+ContentRegistry reads scenarios/*.json, players/*.json and flags/*.json,
+checks them, and precomputes what requests need: each player's system prompt,
+the scenario list grouped by category for /api/scenarios, and the compiled
+red flag catalogue. Starting a scenario is then a dictionary lookup.
+
+A polling thread watches the directories by file mtime and re-parses only the
+files that changed, so content authors can edit scenarios while the server
+runs. A file that fails to parse keeps its last good version. Listeners are
+told which kinds of content changed (e.g. to reload the reply bank).
+"""
+
+import json
+import os
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+
+from redflags import FlagCatalogue, load_flag_catalogue
+
+def build_system_text(p: Dict[str, Any]) -> str:
+    """Construct system prompt from player dict."""
+    return " ".join([
+        f"You are {p.get('name','Assistant')}, {p.get('profession','')}.",
+        f"Your personality: {p.get('personality','')}",
+        f"Your communication style: {p.get('style','')}",
+        "Keep facts accurate." if p.get("facts_guard") else "",
+        p.get("instructions",""),
+    ]).strip()
+
+def scenario_summary(scenario_id: str, scenario: Dict[str, Any]) -> Dict[str, Any]:
+    """A scenario's entry in the /api/scenarios listing."""
+    return {
+        "id": scenario_id,
+        "title": scenario.get("title", "Untitled"),
+        "difficulty": scenario.get("difficulty", "medium"),
+        "description": scenario.get("introduction", "")[:100] + "..."
+    }
+
+def scenario_problems(scenario: Dict[str, Any], players: Dict[str, Any]) -> List[str]:
+    problems = [f"missing '{key}'" for key in ("title", "player", "initial_message") if not scenario.get(key)]
+    if scenario.get("player") and scenario["player"] not in players:
+        problems.append(f"unknown player '{scenario['player']}'")
+    for key in ("red_flags", "success_criteria"):
+        if not isinstance(scenario.get(key, []), list):
+            problems.append(f"'{key}' is not a list")
+    return problems
+
+class ContentRegistry:
+    """In-memory scenarios and players, reloaded file by file when they change on disk."""
+
+    def __init__(self, scenarios_dir: str = "scenarios", players_dir: str = "players",
+                 flags_dir: str = "flags"):
+        self.dirs = {"scenarios": scenarios_dir, "players": players_dir, "flags": flags_dir}
+        self.scenarios: Dict[str, Dict[str, Any]] = {}
+        self.players: Dict[str, Dict[str, Any]] = {}
+        self.system_texts: Dict[str, str] = {}
+        self.categories: Dict[str, List[Dict[str, Any]]] = {}
+        self.flags = FlagCatalogue({})
+        self.loaded_at = 0.0
+        self._listeners: List[Callable[[Set[str]], None]] = []
+        self._lock = threading.Lock()
+        # kind -> path -> ((mtime_ns, size), parsed content keyed by ID)
+        self._files: Dict[str, Dict[str, Tuple[Tuple[int, int], Dict[str, Any]]]] = {kind: {} for kind in self.dirs}
+        # path -> signature of files that failed to parse, so they are not retried until saved again
+        self._failed: Dict[str, Tuple[int, int]] = {}
+
+    # ----- lookups -----
+
+    def scenario(self, scenario_id: str) -> Optional[Dict[str, Any]]:
+        return self.scenarios.get(scenario_id)
+
+    def player(self, name: str) -> Optional[Dict[str, Any]]:
+        """A player by short name ("cyberbully") or path inside the players directory."""
+        return self.players.get(os.path.splitext(os.path.basename(name))[0])
+
+    def system_text(self, name: str) -> str:
+        key = os.path.splitext(os.path.basename(name))[0]
+        return self.system_texts.get(key) or build_system_text(self.players.get(key, {}))
+
+    # ----- loading -----
+
+    def load(self) -> Set[str]:
+        """Parse everything that changed since the last call; returns the kinds that changed."""
+        with self._lock:
+            first = not self.loaded_at
+            changed = {kind for kind in self.dirs if self._scan(kind)}
+            if not changed and not first:
+                return changed
+            if "players" in changed:
+                players = self._merged("players")
+                self.system_texts = {name: build_system_text(p) for name, p in players.items()}
+                self.players = players
+            if changed & {"scenarios", "players"}:
+                scenarios = self._merged("scenarios")
+                for scenario_id, scenario in scenarios.items():
+                    for problem in scenario_problems(scenario, self.players):
+                        print(f"⚠️  Scenario '{scenario_id}': {problem}")
+                categories: Dict[str, List[Dict[str, Any]]] = {}
+                for scenario_id, scenario in sorted(scenarios.items()):
+                    categories.setdefault(scenario.get("category", "uncategorized"), []).append(
+                        scenario_summary(scenario_id, scenario))
+                self.categories = categories
+                self.scenarios = scenarios
+            if changed & {"scenarios", "flags"}:
+                self.flags = load_flag_catalogue(self.dirs["flags"], self.scenarios)
+            self.loaded_at = time.time()
+        print(f"📚 Content: {len(self.scenarios)} scenarios, {len(self.players)} players"
+              + ("" if first else f" (reloaded {', '.join(sorted(changed))})"))
+        for listener in self._listeners:
+            try:
+                listener(changed)
+            except Exception as e:
+                print(f"⚠️  Content reload listener failed: {e}")
+        return changed
+
+    def _scan(self, kind: str) -> bool:
+        """Re-parse new and modified files of one kind and forget deleted ones."""
+        directory = self.dirs[kind]
+        known = self._files[kind]
+        if not os.path.isdir(directory):
+            if not self.loaded_at:
+                print(f"⚠️  {kind.title()} directory '{directory}' not found")
+            changed = bool(known)
+            known.clear()
+            return changed
+        seen, changed = set(), False
+        for entry in os.scandir(directory):
+            if not entry.name.endswith(".json") or not entry.is_file():
+                continue
+            seen.add(entry.path)
+            stat = entry.stat()
+            signature = (stat.st_mtime_ns, stat.st_size)
+            if (entry.path in known and known[entry.path][0] == signature
+                    or self._failed.get(entry.path) == signature):
+                continue
+            try:
+                with open(entry.path, "r", encoding="utf-8") as f:
+                    data = json.load(f)
+                if not isinstance(data, dict):
+                    raise ValueError("not a JSON object")
+            except Exception as e:
+                # Keep the last good version (e.g. an editor saving half a file)
+                print(f"⚠️  Failed to load {entry.path}: {e}")
+                self._failed[entry.path] = signature
+                continue
+            self._failed.pop(entry.path, None)
+            key = data.get("id", entry.name[:-5]) if kind == "scenarios" else entry.name[:-5]
+            known[entry.path] = (signature, {key: data})
+            changed = True
+            if self.loaded_at:
+                print(f"🔄 Reloaded {entry.path}")
+        for path in set(known) - seen:
+            del known[path]
+            changed = True
+            print(f"🗑️  Removed {path}")
+        return changed
+
+    def _merged(self, kind: str) -> Dict[str, Dict[str, Any]]:
+        merged: Dict[str, Dict[str, Any]] = {}
+        for path in sorted(self._files[kind]):
+            merged.update(self._files[kind][path][1])
+        return merged
+
+    # ----- watching -----
+
+    def on_change(self, listener: Callable[[Set[str]], None]):
+        """Call listener(kinds) after every reload that changed something."""
+        self._listeners.append(listener)
+
+    def watch(self, interval: float):
+        """Poll the content directories every interval seconds in a daemon thread."""
+        def poll():
+            while True:
+                time.sleep(interval)
+                try:
+                    if self._changed_on_disk():
+                        self.load()
+                except Exception as e:
+                    print(f"⚠️  Content reload failed: {e}")
+        threading.Thread(target=poll, name="content-watcher", daemon=True).start()
+
+    def _changed_on_disk(self) -> bool:
+        """Cheap check (stat only) for added, removed or modified files."""
+        for kind, directory in self.dirs.items():
+            known = self._files[kind]
+            if not os.path.isdir(directory):
+                if known:
+                    return True
+                continue
+            paths = set()
+            for entry in os.scandir(directory):
+                if entry.name.endswith(".json") and entry.is_file():
+                    paths.add(entry.path)
+                    stat = entry.stat()
+                    signature = (stat.st_mtime_ns, stat.st_size)
+                    if (entry.path not in known or known[entry.path][0] != signature) \
+                            and self._failed.get(entry.path) != signature:
+                        return True
+            if set(known) - paths:
+                return True
+        return False
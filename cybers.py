@@ -9,16 +9,37 @@ Run:
 Then open http://localhost:8021/
 """
 
-import os, re, json, torch, threading
+import os, re, json, time, secrets, asyncio, logging, textwrap, threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from typing import Optional, Dict, Any, AsyncGenerator, List
-from fastapi import FastAPI, HTTPException
-from fastapi.responses import StreamingResponse
+from fastapi import FastAPI, HTTPException, Request, Response
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from pydantic import BaseModel
-from transformers import (
-    AutoTokenizer, AutoModelForCausalLM,
-    TextIteratorStreamer, BitsAndBytesConfig
-)
+from redflags import SemanticFlagIndex
+from content import ContentRegistry, build_system_text
+from backends import load_backend, model_label
+from workers import WorkerPool
+from replycache import ResponseCache, replay
+from replybank import ReplyBank, context_hash
+from store import ResultStore
+from streaming import FlushPolicy, coalesce, encode, media_type, negotiate
+import metrics
+
+# ---------- Logging ----------
+
+# Per-request events go through this logger (DEBUG adds per-token progress);
+# startup messages stay as prints
+LOG_LEVEL = os.getenv("CYBERS_LOG_LEVEL", "INFO").upper()
+log = logging.getLogger("cybers")
+if not log.handlers:
+    _handler = logging.StreamHandler()
+    _handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(message)s"))
+    log.addHandler(_handler)
+    log.propagate = False
+log.setLevel(LOG_LEVEL)
 
 # ---------- Models ----------
 
@@ -30,22 +51,10 @@ class ScenarioState(BaseModel):
     red_flags_detected: List[str] = []
     score: int = 0
     completed: bool = False
+    # Key of this attempt in the result store
+    attempt_id: str = ""
 
-# ---------- Quantization helpers ----------
-
-def build_bnb(bits: Optional[int]):
-    if not bits:
-        return None
-    if bits == 4:
-        return BitsAndBytesConfig(
-            load_in_4bit=True,
-            bnb_4bit_use_double_quant=True,
-            bnb_4bit_quant_type="nf4",
-            bnb_4bit_compute_dtype=torch.bfloat16 if torch.cuda.is_available() else torch.float32,
-        )
-    if bits == 8:
-        return BitsAndBytesConfig(load_in_8bit=True)
-    raise ValueError("--bits must be 4, 8, or omitted")
+# ---------- Helpers ----------
 
 def _first_word(name: Optional[str], default="Assistant") -> str:
     if not name:
@@ -72,67 +81,29 @@ def load_player(path_or_name: str, base_dir: str = "players") -> Dict[str, Any]:
 
 # ---------- Scenario loader ----------
 
-def load_scenarios(scenarios_dir: str = "scenarios") -> Dict[str, Dict[str, Any]]:
-    """Load all scenario JSON files from directory."""
-    scenarios = {}
-    
-    if not os.path.exists(scenarios_dir):
-        print(f"⚠️  Scenarios directory '{scenarios_dir}' not found")
-        return scenarios
-    
-    for filename in os.listdir(scenarios_dir):
-        if filename.endswith(".json"):
-            filepath = os.path.join(scenarios_dir, filename)
-            try:
-                with open(filepath, 'r', encoding='utf-8') as f:
-                    scenario = json.load(f)
-                    scenario_id = scenario.get("id", filename[:-5])
-                    scenarios[scenario_id] = scenario
-                    print(f"📚 Loaded scenario: {scenario.get('title', scenario_id)}")
-            except Exception as e:
-                print(f"⚠️  Failed to load {filename}: {e}")
-    
-    return scenarios
+# Scenarios, players and flags, parsed once and reloaded when they change (see content.py)
+content = ContentRegistry("scenarios", "players", "flags")
+# Seconds between checks for edited content files (0 = load once at startup)
+CONTENT_POLL = float(os.getenv("CYBERS_CONTENT_POLL", "2"))
 
 # ---------- Red flag detection ----------
 
-def detect_red_flags(user_message: str, red_flags: List[str]) -> List[str]:
-    """Simple keyword-based red flag detection."""
-    detected = []
-    message_lower = user_message.lower()
-    
-    # Red flag keywords mapping
-    flag_keywords = {
-        "questions_sender": [
-            "who are you", "who is this", "who is that",
-            "are you really", "is that really you", "is that you really", "is that you,",
-            "is this really", "are you actually", "is this actually",
-            "prove who you", "prove you're", "prove this is"
-        ],
-        "refuses_to_click": ["won't click", "not clicking", "don't trust", "suspicious link", "not opening", "won't open"],
-        "checks_url": ["url", "link", "address", "domain", "website"],
-        "reports_phishing": ["report", "spam", "phishing", "scam", "reporting"],
-        "questions_urgency": ["why urgent", "why now", "what happens if", "why 24 hours", "why immediate"],
-        "asks_for_proof": ["show me proof", "need proof", "provide evidence", "show evidence"],
-        "refuses_money": ["no money", "won't pay", "not sending", "can't afford", "won't give"],
-        "blocks_contact": ["block", "blocking you", "stop contacting", "leave me alone"],
-        "tells_adult": ["tell parent", "tell teacher", "get help", "talk to adult", "ask parent"],
-        "questions_personal_info": ["why do you need", "why personal", "don't give info"],
-        "recognizes_manipulation": ["manipulating", "trying to trick", "not fair", "guilt trip"],
-        "verifies_independently": [
-            "check myself", "look it up", "verify elsewhere", 
-            "call them directly", "call you directly",
-            "verify on", "verify you on", "check on instagram", "check you on",
-            "verify this", "check this myself", "confirm myself"
-        ]
-    }
-    
-    for flag in red_flags:
-        keywords = flag_keywords.get(flag, [flag.replace("_", " ")])
-        if any(keyword in message_lower for keyword in keywords):
-            detected.append(flag)
-    
-    return detected
+def detect_red_flags(user_message: str, red_flags: List[str], scenario_id: Optional[str] = None) -> List[str]:
+    """Whole-word keyword red flag detection (see redflags.py)."""
+    return content.flags.detect(user_message, red_flags, scenario_id)
+
+# Optional second stage for paraphrases the keywords miss
+SEMANTIC_FLAGS = os.getenv("CYBERS_SEMANTIC_FLAGS", "0") == "1"
+SEMANTIC_MODEL = os.getenv("CYBERS_SEMANTIC_MODEL", "sentence-transformers/all-MiniLM-L6-v2")
+SEMANTIC_THRESHOLD = float(os.getenv("CYBERS_SEMANTIC_THRESHOLD", "0.6"))
+SEMANTIC_CACHE = os.getenv("CYBERS_SEMANTIC_CACHE", ".cache")
+semantic_index: Optional[SemanticFlagIndex] = None
+
+async def detect_semantic_flags(user_message: str, red_flags: List[str]) -> List[str]:
+    """Embedding-based detection, run off the event loop."""
+    if not semantic_index or not red_flags:
+        return []
+    return await asyncio.to_thread(semantic_index.detect, user_message, red_flags)
 
 # ---------- Scoring ----------
 
@@ -157,175 +128,727 @@ def calculate_scenario_score(state: ScenarioState, scenario: Dict[str, Any]) ->
 
 # ---------- Model setup ----------
 
+# Generation backend: transformers, tiny (small CPU model) or scripted (no model), see backends.py
+BACKEND = os.getenv("CYBERS_BACKEND", "transformers")
 MODEL_NAME = os.getenv("CYBERS_MODEL", "meta-llama/Llama-3.1-8B-Instruct")
 DEFAULT_PLAYER = os.getenv("CYBERS_PLAYER", "players/mentor.json")
 BITS = int(os.getenv("CYBERS_BITS", "4"))
+MAX_BATCH = int(os.getenv("CYBERS_MAX_BATCH", "8"))
+PREFIX_CACHE_MB = int(os.getenv("CYBERS_PREFIX_CACHE_MB", "512"))
+SESSION_CACHE_MB = int(os.getenv("CYBERS_SESSION_CACHE_MB", "1024"))
+SESSION_OFFLOAD_MB = int(os.getenv("CYBERS_SESSION_OFFLOAD_MB", "4096"))
 TRUST_REMOTE = True
+# Model worker processes (see workers.py); 0 keeps the model in this process
+WORKERS = int(os.getenv("CYBERS_WORKERS", "0"))
+WORKER_ADDRESSES = [a.strip() for a in os.getenv("CYBERS_WORKER_ADDRESSES", "").split(",") if a.strip()]
+WORKER_KEY = os.getenv("CYBERS_WORKER_KEY", "")
+ENGINE_CONFIG = {
+    "model_name": MODEL_NAME,
+    "bits": BITS,
+    "trust_remote": TRUST_REMOTE,
+    "device": os.getenv("CYBERS_DEVICE", "auto"),
+    "max_batch": MAX_BATCH,
+    "prefix_cache_mb": PREFIX_CACHE_MB,
+    "session_cache_mb": SESSION_CACHE_MB,
+    "session_offload_mb": SESSION_OFFLOAD_MB,
+    # Speculative decoding with a small draft model of the same family (see engine.py)
+    "draft_model": os.getenv("CYBERS_DRAFT_MODEL", ""),
+    "draft_tokens": int(os.getenv("CYBERS_DRAFT_TOKENS", "4")),
+    "draft_max_batch": int(os.getenv("CYBERS_DRAFT_MAX_BATCH", "4")),
+}
+# Seconds a chat request waits for the model to finish loading before a 503
+MODEL_WAIT = float(os.getenv("CYBERS_MODEL_WAIT", "30"))
 
-print(f"🛡️ Loading model: {MODEL_NAME}")
-bnb = build_bnb(BITS)
-tok = AutoTokenizer.from_pretrained(MODEL_NAME, trust_remote_code=TRUST_REMOTE)
-tok.padding_side = "left"
-if tok.pad_token_id is None and tok.eos_token_id is not None:
-    tok.pad_token = tok.eos_token
-
-print(f"🔧 Quantization: {BITS}-bit" if BITS else "🔧 No quantization")
-print(f"🖥️  Device: {'CUDA' if torch.cuda.is_available() else 'CPU'}")
-if torch.cuda.is_available():
-    print(f"🎮 GPU: {torch.cuda.get_device_name(0)}")
-    print(f"💾 GPU Memory: {torch.cuda.get_device_properties(0).total_memory / 1e9:.2f} GB")
-print(f"⏳ Loading model (this may take 1-2 minutes)...")
-
-# Force CUDA usage if available - use aggressive device_map
-if torch.cuda.is_available():
-    device_map_setting = {"": 0}  # Force ALL layers to GPU 0
-    print(f"📍 Device map: Forcing all layers to GPU 0")
-else:
-    device_map_setting = "auto"
-    print(f"📍 Device map: auto (CPU mode)")
-
-mdl = AutoModelForCausalLM.from_pretrained(
-    MODEL_NAME,
-    device_map=device_map_setting,  # Force all to GPU
-    dtype=torch.bfloat16 if torch.cuda.is_available() else torch.float32,
-    trust_remote_code=TRUST_REMOTE,
-    quantization_config=bnb,
-    # Don't use offload_buffers - causes offloading to CPU
-).eval()
-
-print(f"✅ Model loaded successfully!")
-
-# Verify model is on GPU
-if torch.cuda.is_available():
-    model_device = next(mdl.parameters()).device
-    print(f"✅ Model is on: {model_device}")
-    if str(model_device) == "cpu":
-        print("⚠️  WARNING: Model loaded to CPU despite CUDA being available!")
-        print("   This will be MUCH slower. Check your PyTorch installation.")
-else:
-    print(f"⚠️  Running on CPU (no CUDA available)")
-
-print(f"📊 Model size: {sum(p.numel() for p in mdl.parameters()) / 1e9:.2f}B parameters")
-
-# ---------- Global state ----------
-
-player = load_player(DEFAULT_PLAYER)
-player_filename = os.path.splitext(os.path.basename(DEFAULT_PLAYER))[0]
-conversation_history: List[Dict[str, str]] = []
-MAX_HISTORY = 10
-
-# Scenario state
-current_scenario: Optional[Dict[str, Any]] = None
-scenario_state: Optional[ScenarioState] = None
-scenarios_cache: Dict[str, Dict[str, Any]] = {}
-
-def build_system_text(p: Dict[str, Any]) -> str:
-    """Construct system prompt from player dict."""
-    return " ".join([
-        f"You are {p.get('name','Assistant')}, {p.get('profession','')}.",
-        f"Your personality: {p.get('personality','')}",
-        f"Your communication style: {p.get('style','')}",
-        "Keep facts accurate." if p.get("facts_guard") else "",
-        p.get("instructions",""),
-    ]).strip()
-
-system_text = build_system_text(player)
-asst_label = _first_word(player.get("name"))
-
-print(f"🛡️ Initial player: {player.get('name', 'Unknown')} (from {DEFAULT_PLAYER})")
+# Loaded in the background after startup so the API and static files are up at once
+tok = None
+engine = None
+model_status = "not_loaded"  # not_loaded -> loading -> ready | error
+model_error: Optional[str] = None
+model_load_started: Optional[float] = None
+# Set on the event loop once loading has finished, whether it worked or not
+model_loaded = asyncio.Event()
 
-app = FastAPI(title="Cyber Safer API", version="1.0")
+def load_model(loop: asyncio.AbstractEventLoop):
+    """Load the generation backend, blocking until it can generate (runs in a thread)."""
+    global tok, engine, model_status, model_error, model_load_started
+    model_status = "loading"
+    model_load_started = time.monotonic()
+    try:
+        tok, engine = load_backend(BACKEND, ENGINE_CONFIG, workers=WORKERS, addresses=WORKER_ADDRESSES,
+                                   authkey=WORKER_KEY.encode())
+        check_prompt_fragments()
+        model_status = "ready"
+        print(f"✅ Ready after {time.monotonic() - model_load_started:.1f}s")
+    except Exception as e:
+        model_status = "error"
+        model_error = str(e)
+        print(f"❌ Model failed to load: {e}")
+    finally:
+        if not loop.is_closed():
+            loop.call_soon_threadsafe(model_loaded.set)
+
+async def wait_for_model():
+    """Hold a generation request until the model is ready, or answer 503."""
+    if model_status == "ready":
+        return
+    if model_status != "error" and MODEL_WAIT > 0:
+        try:
+            await asyncio.wait_for(model_loaded.wait(), MODEL_WAIT)
+        except asyncio.TimeoutError:
+            pass
+        if model_status == "ready":
+            return
+    if model_status == "error":
+        raise HTTPException(status_code=503, detail=f"Model failed to load: {model_error}")
+    raise HTTPException(status_code=503, detail="Model is still loading, try again shortly",
+                        headers={"Retry-After": "10"})
+
+# ---------- Sessions ----------
+
+DEFAULT_PLAYER_FILENAME = os.path.splitext(os.path.basename(DEFAULT_PLAYER))[0]
+# Prompt tokens the conversation history may use; the oldest messages are
+# dropped to fit, so prefill cost stays bounded however long a chat runs
+HISTORY_TOKENS = int(os.getenv("CYBERS_HISTORY_TOKENS", "1536"))
+# Messages dropped at once when the history window is full. Sliding in steps
+# keeps the session's KV cache reusable between slides.
+HISTORY_SLIDE = int(os.getenv("CYBERS_HISTORY_SLIDE", "4"))
+# Keep a short memory line of dropped messages in the prompt (characters; 0 = off)
+HISTORY_MEMORY_CHARS = int(os.getenv("CYBERS_HISTORY_MEMORY", "0"))
+SESSION_COOKIE = "cybers_session"
+SESSION_HEADER = "X-Session-ID"
+SESSION_TTL = int(os.getenv("CYBERS_SESSION_TTL", "3600"))
+MAX_SESSIONS = int(os.getenv("CYBERS_MAX_SESSIONS", "256"))
+# Seconds between keep-alive comments on idle /api/scenario/events streams
+EVENTS_HEARTBEAT = float(os.getenv("CYBERS_EVENTS_HEARTBEAT", "15"))
+# How long browsers wait before reconnecting a dropped event stream (ms)
+EVENTS_RETRY_MS = int(os.getenv("CYBERS_EVENTS_RETRY_MS", "3000"))
+# SQLite file scenario attempts, turns, flags and scores are kept in (empty = memory only)
+STORE_PATH = os.getenv("CYBERS_STORE", "data/cybers.db")
+# Key teachers send as X-Teacher-Key to read /api/results (empty = results closed)
+TEACHER_KEY = os.getenv("CYBERS_TEACHER_KEY", "")
+TEACHER_HEADER = "X-Teacher-Key"
+result_store = ResultStore(
+    STORE_PATH,
+    flush_interval=float(os.getenv("CYBERS_STORE_FLUSH_MS", "200")) / 1000,
+    batch_size=int(os.getenv("CYBERS_STORE_BATCH", "500")),
+    learner_salt=TEACHER_KEY.encode(),
+) if STORE_PATH else None
+
+default_player = load_player(DEFAULT_PLAYER)
+
+def forget_session_cache(session_id: str):
+    """Release a session's carried-over KV cache, if the engine is up."""
+    if engine:
+        engine.forget_session(session_id)
+
+@lru_cache(maxsize=1)
+def message_overhead() -> int:
+    """Tokens the chat template wraps around each message (role header, end marker)."""
+    msgs = [{"role": "system", "content": "x"}]
+    base = len(tok(tok.apply_chat_template(msgs, tokenize=False))["input_ids"])
+    msgs.append({"role": "user", "content": "x"})
+    full = len(tok(tok.apply_chat_template(msgs, tokenize=False))["input_ids"])
+    return max(full - base - len(tok("x", add_special_tokens=False)["input_ids"]), 0)
+
+def count_message_tokens(content: str) -> int:
+    """Prompt tokens one history message takes up (estimated while the model loads)."""
+    if tok is None:
+        return len(content) // 4 + 4
+    return len(tok(content, add_special_tokens=False)["input_ids"]) + message_overhead()
+
+def memory_line(message: Dict[str, str]) -> str:
+    who = "Learner" if message["role"] == "user" else "You"
+    return f"{who}: {textwrap.shorten(message['content'], width=120, placeholder='...')}"
+
+class Reply:
+    """A reply streaming for a session, so a newer request can stop it."""
+
+    def __init__(self):
+        self.cancel_reason: Optional[str] = None
+        self.done = asyncio.Event()
+
+class PromptState:
+    """A session's persona, memory and history as of one moment.
+
+    Prompts are built on tokenizer_pool while the event loop keeps changing
+    the session (a reply finishing, a trim, a scenario switch), so they are
+    built from this copy, whose history and fragment IDs always line up.
+    """
+
+    def __init__(self, session: "Session"):
+        self.system_text = session.system_text
+        self.memory = "Earlier in this conversation:\n" + "\n".join(session.memory) if session.memory else None
+        self.history = list(session.conversation_history)
+        self.history_ids = list(session.history_ids)
+        self.opener = (session.current_scenario or {}).get("initial_message")
+
+class Session:
+    """Conversation and scenario state for a single learner."""
+
+    def __init__(self, session_id: str):
+        self.session_id = session_id
+        self.last_seen = time.monotonic()
+        self.conversation_history: List[Dict[str, str]] = []
+        # Token IDs each history message adds to a prompt (None when the chat
+        # template cannot be assembled from fragments), their counts and total
+        self.history_ids: List[Optional[List[int]]] = []
+        self.history_tokens: List[int] = []
+        self.history_total = 0
+        # Short lines about messages that slid out of the window
+        self.memory: List[str] = []
+        self.current_scenario: Optional[Dict[str, Any]] = None
+        self.scenario_state: Optional[ScenarioState] = None
+        self.reply: Optional[Reply] = None
+        # Queues of this learner's open /api/scenario/events streams, and the last event's ID
+        self.watchers: List[asyncio.Queue] = []
+        self.event_id = 0
+        self.set_player(default_player, DEFAULT_PLAYER_FILENAME)
+
+    def set_player(self, p: Dict[str, Any], filename: str, system_text: Optional[str] = None):
+        """Switch persona, with its system prompt if already built."""
+        self.player = p
+        self.player_filename = filename
+        self.system_text = system_text or build_system_text(p)
+
+    def add_to_history(self, role: str, content: str, entry: Optional[tuple] = None):
+        """Add message to history and trim it to the token budget if needed.
+
+        entry is history_entry(role, content), when already worked out off the event loop.
+        """
+        ids, tokens = entry or history_entry(role, content)
+        self.conversation_history.append({"role": role, "content": content})
+        self.history_ids.append(ids)
+        self.history_tokens.append(tokens)
+        self.history_total += tokens
+        if self.history_total > HISTORY_TOKENS:
+            self.trim_history()
+
+    def trim_history(self):
+        """Drop the oldest messages until the history fits its token budget.
+
+        At least HISTORY_SLIDE messages go at once, the window restarts on a
+        learner message (chat templates expect user/assistant turns), and the
+        latest exchange is always kept.
+        """
+        history = self.conversation_history
+        dropped = 0
+        while len(history) > 2 and (self.history_total > HISTORY_TOKENS or dropped < HISTORY_SLIDE
+                                    or history[0]["role"] != "user"):
+            message = history.pop(0)
+            self.history_ids.pop(0)
+            self.history_total -= self.history_tokens.pop(0)
+            dropped += 1
+            if HISTORY_MEMORY_CHARS:
+                self.memory.append(memory_line(message))
+        while self.memory and sum(len(line) for line in self.memory) > HISTORY_MEMORY_CHARS:
+            self.memory.pop(0)
+
+    def clear_history(self):
+        """Clear conversation history."""
+        self.cancel_reply("exit")
+        self.conversation_history = []
+        self.history_ids = []
+        self.history_tokens = []
+        self.history_total = 0
+        self.memory = []
+        forget_session_cache(self.session_id)
+
+    def cancel_reply(self, reason: str) -> Optional[Reply]:
+        """Stop the reply still streaming for this session, if any, and return it."""
+        reply = self.reply
+        if reply is None or reply.done.is_set() or reply.cancel_reason:
+            return None
+        reply.cancel_reason = reason
+        metrics.CANCELLATIONS.inc(reason=reason)
+        if engine:
+            engine.cancel_session(self.session_id)
+        return reply
+
+    def status(self) -> Dict[str, Any]:
+        """Scenario progress, as served by /api/scenario/status and pushed to event streams."""
+        if not self.current_scenario or not self.scenario_state:
+            return {"active": False}
+        success_criteria = self.current_scenario.get("success_criteria", [])
+        detected = self.scenario_state.red_flags_detected
+        return {
+            "active": True,
+            "scenario_id": self.current_scenario.get("id"),
+            "red_flags_detected": len(detected),
+            "red_flags_required": len(success_criteria),
+            "red_flags_found": len([f for f in success_criteria if f in detected]),
+            "all_detected_flags": list(set(detected)),
+            "completed": self.scenario_state.completed,
+        }
+
+    def prompt_state(self) -> "PromptState":
+        """What the next prompt is built from, copied in one go on the event loop."""
+        return PromptState(self)
+
+    def publish(self, event: str, data: Dict[str, Any]):
+        """Push an event to the learner's open status streams (a no-op when none are open)."""
+        self.event_id += 1
+        for queue in self.watchers:
+            queue.put_nowait((self.event_id, event, data))
 
-# ---------- Conversation management ----------
+    def reset(self):
+        """Leave any scenario and go back to the default player."""
+        self.set_player(default_player, DEFAULT_PLAYER_FILENAME)
+        self.clear_history()
+        self.current_scenario = None
+        self.scenario_state = None
 
-def add_to_history(role: str, content: str):
-    """Add message to history and trim if needed."""
-    global conversation_history
-    conversation_history.append({"role": role, "content": content})
-    if len(conversation_history) > MAX_HISTORY * 2:
-        conversation_history = conversation_history[-(MAX_HISTORY * 2):]
+class SessionStore:
+    """Bounded in-memory session store with TTL and LRU eviction."""
 
-def clear_history():
-    """Clear conversation history."""
-    global conversation_history
-    conversation_history = []
+    def __init__(self, max_sessions: int = MAX_SESSIONS, ttl: float = SESSION_TTL):
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self._sessions: "OrderedDict[str, Session]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+    def _evict(self):
+        # Entries are kept in last-access order, so expired ones sit at the front.
+        now = time.monotonic()
+        while self._sessions:
+            sid, session = next(iter(self._sessions.items()))
+            if now - session.last_seen < self.ttl and len(self._sessions) <= self.max_sessions:
+                break
+            self._sessions.pop(sid)
+            forget_session_cache(sid)
+            metrics.SESSIONS_EVICTED.inc()
+            log.debug("🧹 Evicted session %s", sid[:8])
+
+    def get(self, session_id: Optional[str]) -> Optional[Session]:
+        """Return a live session and mark it as recently used."""
+        self._evict()
+        session = self._sessions.get(session_id) if session_id else None
+        if session is not None:
+            session.last_seen = time.monotonic()
+            self._sessions.move_to_end(session_id)
+        return session
+
+    def peek(self, session_id: Optional[str]) -> Optional[Session]:
+        """Return a live session without marking it as used (e.g. for keep-alives)."""
+        self._evict()
+        return self._sessions.get(session_id) if session_id else None
+
+    def create(self) -> Session:
+        """Issue a new session, evicting the least recently used if full."""
+        session = Session(secrets.token_urlsafe(16))
+        self._sessions[session.session_id] = session
+        self._evict()
+        return session
+
+    def get_or_create(self, session_id: Optional[str]) -> Session:
+        return self.get(session_id) or self.create()
+
+    def delete(self, session_id: str):
+        self._sessions.pop(session_id, None)
+        forget_session_cache(session_id)
+
+sessions = SessionStore()
+
+def session_id_from(request: Request) -> Optional[str]:
+    """Read the session ID from the header (API clients) or cookie (browser)."""
+    return request.headers.get(SESSION_HEADER) or request.cookies.get(SESSION_COOKIE)
+
+def attach_session(response: Response, session: Session):
+    """Hand the session ID back to the client."""
+    response.set_cookie(SESSION_COOKIE, session.session_id, max_age=int(SESSION_TTL),
+                        httponly=True, samesite="lax")
+    response.headers[SESSION_HEADER] = session.session_id
+
+print(f"🛡️ Default player: {default_player.get('name', 'Unknown')} (from {DEFAULT_PLAYER})")
+
+app = FastAPI(title="Cyber Safer API", version="1.0")
 
 # ---------- Generation ----------
 
-async def stream_response(message: str) -> AsyncGenerator[str, None]:
-    """Token streaming for chat UI with conversation history."""
-    max_tokens = player.get("max_tokens", 250)
-    temp = player.get("temperature", 0.7)
-    top_p = player.get("top_p", 0.9)
-    
-    print(f"💬 User message: {message[:50]}...")
-    print(f"🎯 Generating with max_tokens={max_tokens}, temp={temp}, top_p={top_p}")
-    print(f"🖥️  Model device: {mdl.device}")
-    
+@lru_cache(maxsize=256)
+def prefix_lengths(system_text: str, opener: Optional[str]) -> tuple:
+    """Token counts at which a prompt ends its system block and scenario opener.
+
+    Every session of the same persona (and scenario) shares these prefixes, so
+    the engine caches their KV and only prefills what comes after.
+    """
     msgs = [{"role": "system", "content": system_text}]
-    msgs.extend(conversation_history)
-    msgs.append({"role": "user", "content": message})
-    
-    prompt = tok.apply_chat_template(msgs, tokenize=False, add_generation_prompt=True)
-    
-    # Explicitly move inputs to the correct device
-    device = next(mdl.parameters()).device
-    inputs = tok([prompt], return_tensors="pt")
+    lengths = [len(tok(tok.apply_chat_template(msgs, tokenize=False))["input_ids"])]
+    if opener:
+        msgs.append({"role": "assistant", "content": opener})
+        lengths.append(len(tok(tok.apply_chat_template(msgs, tokenize=False))["input_ids"]))
+    return tuple(lengths)
+
+# Prompts are put together from cached token IDs: the system block per persona
+# and each history message once, instead of templating and tokenizing the
+# whole conversation every turn. Checked against the full render when the
+# model loads; templates where the two differ use the full render.
+PROMPT_FRAGMENTS = os.getenv("CYBERS_PROMPT_FRAGMENTS", "1") == "1"
+prompt_fragments = False
+FRAGMENT_BASE = [{"role": "system", "content": "x"}]
+
+@lru_cache(maxsize=256)
+def system_ids(system_text: str) -> tuple:
+    """Token IDs of a prompt's system block, tokenized the way a full prompt is."""
+    return tuple(tok(tok.apply_chat_template([{"role": "system", "content": system_text}],
+                                             tokenize=False))["input_ids"])
+
+@lru_cache(maxsize=1)
+def generation_ids() -> tuple:
+    """Token IDs of the generation prompt (the assistant header) ending every prompt."""
+    msgs = FRAGMENT_BASE + [{"role": "user", "content": "x"}]
+    text = tok.apply_chat_template(msgs, tokenize=False)
+    full = tok.apply_chat_template(msgs, tokenize=False, add_generation_prompt=True)
+    return tuple(tok(full[len(text):], add_special_tokens=False)["input_ids"])
+
+@lru_cache(maxsize=1)
+def fragment_base() -> str:
+    return tok.apply_chat_template(FRAGMENT_BASE, tokenize=False)
+
+def message_ids(role: str, content: str) -> Optional[List[int]]:
+    """Token IDs one message adds to a prompt after the system block, if the template allows."""
+    base = fragment_base()
+    text = tok.apply_chat_template(FRAGMENT_BASE + [{"role": role, "content": content}], tokenize=False)
+    if not text.startswith(base):
+        return None
+    return tok(text[len(base):], add_special_tokens=False)["input_ids"]
+
+def history_entry(role: str, content: str) -> tuple:
+    """(fragment token IDs or None, prompt token count) of a message joining a history."""
+    ids = message_ids(role, content) if prompt_fragments else None
+    return ids, len(ids) if ids is not None else count_message_tokens(content)
+
+def check_prompt_fragments():
+    """Use cached fragments only if they give exactly the full template render's token IDs."""
+    global prompt_fragments
+    if not PROMPT_FRAGMENTS:
+        return
+    msgs = [{"role": "system", "content": "You are Sam, a mentor. Keep facts accurate."},
+            {"role": "assistant", "content": "Hi! Someone sent you a link?"},
+            {"role": "user", "content": "yeah they said i won a prize 🎁 & need to log in..."},
+            {"role": "assistant", "content": "Hmm.\n\nDon't click it yet - who sent it?"},
+            {"role": "user", "content": "  a friend of a friend?"}]
+    try:
+        full = tok(tok.apply_chat_template(msgs, tokenize=False, add_generation_prompt=True))["input_ids"]
+        parts = [message_ids(m["role"], m["content"]) for m in msgs[1:]]
+        assembled = list(system_ids(msgs[0]["content"]))
+        for ids in parts:
+            assembled += ids or []
+        assembled += generation_ids()
+        prompt_fragments = None not in parts and list(full) == assembled
+    except Exception as e:
+        log.warning("Prompt fragment check failed: %s", e)
+        prompt_fragments = False
+    print("🧩 Prompts built from cached fragments" if prompt_fragments
+          else "🧩 Chat template does not split into fragments; rendering full prompts")
+
+# Templating and tokenizing long histories is CPU work, so it runs off the
+# event loop; one thread, because tokenizers are not safe to share across threads
+tokenizer_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="tokenizer")
+
+def assemble_prompt(state: PromptState, entry: tuple) -> Optional[List[int]]:
+    """Prompt token IDs joined from cached fragments, or None if the full render is needed."""
+    if not prompt_fragments or entry[0] is None:
+        return None
+    fragments = [message_ids("system", state.memory)] if state.memory else []
+    # Messages added before the model was ready have no cached fragment yet
+    fragments += [ids if ids is not None else message_ids(m["role"], m["content"])
+                  for ids, m in zip(state.history_ids, state.history)]
+    fragments.append(entry[0])
+    if None in fragments:
+        return None
+    input_ids = list(system_ids(state.system_text))
+    for ids in fragments:
+        input_ids += ids
+    return input_ids + list(generation_ids())
+
+def build_prompt(state: PromptState, message: str) -> tuple:
+    """Prompt token IDs for the session's next reply, its shared prefix lengths,
+    and the message's history_entry."""
+    entry = history_entry("user", message)
+    input_ids = assemble_prompt(state, entry)
+    if input_ids is None:
+        msgs = [{"role": "system", "content": state.system_text}]
+        if state.memory:
+            # A message of its own, so the persona's system block stays a shared prefix
+            msgs.append({"role": "system", "content": state.memory})
+        msgs.extend(state.history)
+        msgs.append({"role": "user", "content": message})
+        prompt = tok.apply_chat_template(msgs, tokenize=False, add_generation_prompt=True)
+        input_ids = tok(prompt)["input_ids"]
     
-    # Move each tensor to device explicitly
-    inputs = {k: v.to(device) for k, v in inputs.items()}
+    # The scenario opener is only a shared prefix while it is still the first message
+    history, opener = state.history, state.opener
+    if not (history and history[0]["role"] == "assistant" and history[0]["content"] == opener):
+        opener = None
+    return input_ids, prefix_lengths(state.system_text, opener), entry
+
+# Opt-in cache replaying earlier replies to near-identical turns (see replycache.py)
+RESPONSE_CACHE = os.getenv("CYBERS_RESPONSE_CACHE", "0") == "1"
+# History messages before the new one that must match for a hit
+RESPONSE_CACHE_TAIL = int(os.getenv("CYBERS_RESPONSE_CACHE_TAIL", "2"))
+# Rate cached and banked replies are streamed at, in words per second (0 = all at once)
+RESPONSE_CACHE_TPS = float(os.getenv("CYBERS_RESPONSE_CACHE_TPS", "30"))
+response_cache = ResponseCache(
+    max_entries=int(os.getenv("CYBERS_RESPONSE_CACHE_SIZE", "2048")),
+    ttl=float(os.getenv("CYBERS_RESPONSE_CACHE_TTL", "3600")),
+    variants=int(os.getenv("CYBERS_RESPONSE_CACHE_VARIANTS", "3")),
+    max_hit_ratio=float(os.getenv("CYBERS_RESPONSE_CACHE_MAX_HIT_RATIO", "0.5")),
+) if RESPONSE_CACHE else None
+
+# Pre-generated replies to the first learner message (build_reply_bank.py)
+REPLY_BANK = os.getenv("CYBERS_REPLY_BANK", "bank/replies.json")
+REPLY_BANK_MAX_WORDS = int(os.getenv("CYBERS_REPLY_BANK_MAX_WORDS", "12"))
+reply_bank: Optional[ReplyBank] = None
+
+def load_reply_bank(scenarios: Dict[str, Dict[str, Any]]) -> Optional[ReplyBank]:
+    """Load the reply bank, keeping scenarios whose persona and opener are unchanged."""
+    if not REPLY_BANK or not os.path.exists(REPLY_BANK):
+        return None
+    contexts = {sid: context_hash(content.system_text(s["player"]), s.get("initial_message", ""))
+                for sid, s in scenarios.items() if content.player(s.get("player") or "")}
+    try:
+        bank = ReplyBank.load(REPLY_BANK, contexts, REPLY_BANK_MAX_WORDS)
+    except Exception as e:
+        print(f"⚠️  Failed to load reply bank {REPLY_BANK}: {e}")
+        return None
+    if bank:
+        stats = bank.stats()
+        print(f"🏦 Reply bank: {stats['replies']} replies for {stats['scenarios']} scenarios ({stats['model']})")
+    return bank
+
+def banked_reply(session: Session, message: str) -> Optional[str]:
+    """A pre-generated reply to the learner's first message in a scenario, if the bank has one."""
+    scenario, state = session.current_scenario, session.scenario_state
+    if reply_bank is None or not scenario or not state or (session.reply and not session.reply.done.is_set()):
+        return None
+    history = session.conversation_history
+    if len(history) != 1 or history[0]["content"] != scenario.get("initial_message"):
+        return None
+    text = reply_bank.pick(state.scenario_id, message)
+    metrics.REPLY_BANK.inc(result="hit" if text else "miss")
+    return text
+
+def response_key(session: Session, message: str) -> Optional[str]:
+    """Response cache key for the session's next reply, if the cache is on."""
+    if response_cache is None:
+        return None
+    player = session.player
+    history = session.conversation_history
+    tail = history[max(len(history) - RESPONSE_CACHE_TAIL, 0):] if RESPONSE_CACHE_TAIL > 0 else []
+    sampling = (player.get("max_tokens", 250), player.get("temperature", 0.7), player.get("top_p", 0.9))
+    return response_cache.key(session.player_filename, (session.current_scenario or {}).get("id"),
+                              tail, message, sampling)
+
+# Reply tokens are coalesced into fewer, larger HTTP chunks (see streaming.py):
+# flushed after CYBERS_STREAM_FLUSH_MS, at CYBERS_STREAM_FLUSH_BYTES, and on word boundaries
+STREAM_FLUSH = FlushPolicy(
+    interval=float(os.getenv("CYBERS_STREAM_FLUSH_MS", "30")) / 1000,
+    max_bytes=int(os.getenv("CYBERS_STREAM_FLUSH_BYTES", "512")),
+    word_boundary=os.getenv("CYBERS_STREAM_WORD_BOUNDARY", "1") == "1",
+)
+
+async def stream_response(session: Session, message: str,
+                          banked: Optional[str] = None) -> AsyncGenerator[str, None]:
+    """Token streaming for chat UI with conversation history.
+
+    banked is a reply from the reply bank to stream instead of generating one.
+    """
+    # A new message replaces a reply still streaming for this session; wait for
+    # it to end so its partial text is in the history this prompt is built from
+    previous = session.cancel_reply("new_message")
+    if previous:
+        try:
+            await asyncio.wait_for(previous.done.wait(), timeout=5)
+        except asyncio.TimeoutError:
+            pass
+    reply = session.reply = Reply()
     
-    print(f"📍 Inputs on device: {inputs['input_ids'].device}")
+    cache_key = None if banked is not None else response_key(session, message)
+    cached = None
+    if cache_key:
+        result, cached = response_cache.lookup(cache_key)
+        metrics.RESPONSE_CACHE.inc(result=result)
+    if banked is not None:
+        tokens = replay_reply(session, message, reply, banked, outcome="bank")
+    elif cached is not None:
+        tokens = replay_reply(session, message, reply, cached)
+    else:
+        tokens = generate_reply(session, message, reply, cache_key)
+    try:
+        async for token in tokens:
+            yield token
+    finally:
+        await tokens.aclose()
+        reply.done.set()
+
+def note_disconnect(reply: Reply):
+    if not reply.cancel_reason:
+        reply.cancel_reason = "disconnect"
+        metrics.CANCELLATIONS.inc(reason="disconnect")
 
-    streamer = TextIteratorStreamer(tok, skip_prompt=True, skip_special_tokens=True)
+async def record_exchange(session: Session, message: str, full_response: str, reply: Reply,
+                          message_entry: Optional[tuple] = None):
+    """Add the learner's message and the reply to the session's history."""
+    # After an exit or scenario switch the history was cleared; keep it that way
+    if reply.cancel_reason == "exit":
+        return
+    user_entry, reply_entry = await asyncio.get_running_loop().run_in_executor(
+        tokenizer_pool, lambda: (message_entry or history_entry("user", message),
+                                 history_entry("assistant", full_response)))
+    if reply.cancel_reason == "exit":
+        return
+    session.add_to_history("user", message, user_entry)
+    session.add_to_history("assistant", full_response, reply_entry)
+    if result_store and session.scenario_state:
+        result_store.record_turn(session.scenario_state.attempt_id, "user", message)
+        result_store.record_turn(session.scenario_state.attempt_id, "assistant", full_response)
+
+async def replay_reply(session: Session, message: str, reply: Reply, text: str,
+                       outcome: str = "cached") -> AsyncGenerator[str, None]:
+    """Stream a cached or banked reply like a generated one and record the exchange."""
+    sid = session.session_id[:8]
+    log.info("♻️  Reply from %s session=%s chars=%d", "reply bank" if outcome == "bank" else "cache", sid, len(text))
+    replayed = outcome
+    sent = []
+    outcome = "error"
+    try:
+        async for piece in replay(text, RESPONSE_CACHE_TPS):
+            if reply.cancel_reason:
+                break
+            sent.append(piece)
+            yield piece
+        outcome = "cancelled" if reply.cancel_reason else replayed
+    except (asyncio.CancelledError, GeneratorExit):
+        outcome = "cancelled"
+        note_disconnect(reply)
+        log.info("✋ Client disconnected session=%s (cached reply)", sid)
+        raise
+    finally:
+        metrics.REPLIES.inc(outcome=outcome)
+    await record_exchange(session, message, "".join(sent), reply)
+
+async def generate_reply(session: Session, message: str, reply: Reply,
+                         cache_key: Optional[str] = None) -> AsyncGenerator[str, None]:
+    """Stream one reply from the engine and record the exchange in the session's history.
+
+    A reply that finishes uncancelled is stored in the response cache under cache_key.
+    """
+    player = session.player
+    max_tokens = player.get("max_tokens", 250)
+    temp = player.get("temperature", 0.7)
+    top_p = player.get("top_p", 0.9)
+    
+    input_ids, lengths, message_entry = await asyncio.get_running_loop().run_in_executor(
+        tokenizer_pool, build_prompt, session.prompt_state(), message)
     
     collected_response = []
     token_count = 0
+    sid = session.session_id[:8]
+    metrics.PROMPT_TOKENS.observe(len(input_ids))
+    log.info("💬 Chat session=%s prompt_tokens=%d queue_depth=%d max_tokens=%d temp=%s top_p=%s",
+             sid, len(input_ids), engine.stats()["queue_depth"], max_tokens, temp, top_p)
+    log.debug("💬 session=%s message=%r", sid, message[:50])
     
-    def generate_and_stream():
-        print("🚀 Starting generation thread...")
-        print(f"   Model is on: {next(mdl.parameters()).device}")
-        print(f"   Inputs are on: {inputs['input_ids'].device}")
-        
-        with torch.cuda.amp.autocast(enabled=torch.cuda.is_available()):
-            mdl.generate(
-                **inputs,
-                streamer=streamer,
-                max_new_tokens=max_tokens,
-                temperature=temp,
-                top_p=top_p,
-                do_sample=True,
-                use_cache=True,
-                eos_token_id=tok.eos_token_id,
-                pad_token_id=tok.pad_token_id,
-            )
-        print("✓ Generation thread completed")
-    
-    thread = threading.Thread(target=generate_and_stream, daemon=True)
-    thread.start()
-    
-    print("⏳ Streaming tokens...")
-    for token in streamer:
-        collected_response.append(token)
-        token_count += 1
-        if token_count % 10 == 0:
-            print(f"  ... {token_count} tokens generated")
-        yield token
+    start = time.perf_counter()
+    first_token_at = None
+    outcome = "error"
+    try:
+        async for token in engine.generate(input_ids, max_new_tokens=max_tokens, temperature=temp, top_p=top_p,
+                                           prefix_lengths=lengths,
+                                           session_id=session.session_id):
+            if first_token_at is None:
+                first_token_at = time.perf_counter()
+                metrics.TIME_TO_FIRST_TOKEN.observe(first_token_at - start)
+            collected_response.append(token)
+            token_count += 1
+            if token_count % 10 == 0:
+                log.debug("  ... session=%s tokens=%d", sid, token_count)
+            yield token
+        outcome = "cancelled" if reply.cancel_reason else "ok"
+    except (asyncio.CancelledError, GeneratorExit):
+        # The client went away; leaving engine.generate cancels the request
+        outcome = "cancelled"
+        note_disconnect(reply)
+        log.info("✋ Client disconnected session=%s tokens=%d", sid, token_count)
+        raise
+    finally:
+        metrics.REPLIES.inc(outcome=outcome)
+        metrics.GENERATED_TOKENS.inc(token_count)
     
+    elapsed = time.perf_counter() - start
+    decode_seconds = elapsed - (first_token_at - start) if first_token_at else 0
+    tokens_per_second = (token_count - 1) / decode_seconds if token_count > 1 and decode_seconds > 0 else 0
+    if tokens_per_second and not reply.cancel_reason:
+        metrics.TOKENS_PER_SECOND.observe(tokens_per_second)
     full_response = "".join(collected_response)
-    print(f"✅ Response complete: {len(full_response)} chars, {token_count} tokens")
-    
-    add_to_history("user", message)
-    add_to_history("assistant", full_response)
+    if reply.cancel_reason:
+        log.info("✋ Reply stopped session=%s reason=%s tokens=%d", sid, reply.cancel_reason, token_count)
+    else:
+        log.info("✅ Reply session=%s tokens=%d chars=%d ttft_ms=%.0f tokens_per_s=%.1f total_ms=%.0f",
+                 sid, token_count, len(full_response),
+                 (first_token_at - start) * 1000 if first_token_at else -1, tokens_per_second, elapsed * 1000)
+    if cache_key and outcome == "ok" and full_response.strip():
+        response_cache.store(cache_key, full_response)
+    await record_exchange(session, message, full_response, reply, message_entry)
 
 # ---------- Startup ----------
 
+def on_content_change(kinds: set):
+    """Bring what is derived from scenarios, players and flags up to date after a reload."""
+    global default_player, reply_bank
+    if "players" in kinds:
+        default_player = content.player(DEFAULT_PLAYER) or default_player
+    if kinds & {"scenarios", "players"}:
+        reply_bank = load_reply_bank(content.scenarios)
+    if kinds & {"scenarios", "flags"} and SEMANTIC_FLAGS:
+        load_semantic_index()
+
 @app.on_event("startup")
 async def startup_event():
     """Load scenarios on startup."""
-    global scenarios_cache
-    scenarios_cache = load_scenarios()
-    print(f"✅ Loaded {len(scenarios_cache)} scenarios")
+    global reply_bank
+    content.load()
+    if result_store:
+        result_store.open({sid: s.get("success_criteria", []) for sid, s in content.scenarios.items()})
+    reply_bank = load_reply_bank(content.scenarios)
+    content.on_change(on_content_change)
+    if CONTENT_POLL > 0:
+        content.watch(CONTENT_POLL)
+    
+    # Heavy loading happens in the background; /api/ready reports progress
+    threading.Thread(target=load_model, args=(asyncio.get_running_loop(),),
+                     name="model-loader", daemon=True).start()
+    if SEMANTIC_FLAGS:
+        threading.Thread(target=load_semantic_index, name="semantic-loader", daemon=True).start()
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    """Let model workers exit instead of being restarted, and write out queued results."""
+    if isinstance(engine, WorkerPool):
+        engine.stop()
+    if result_store:
+        result_store.close()
+
+def engine_stat(key: str):
+    return engine.stats().get(key, 0) if engine else 0
+
+def gpu_memory_by_worker():
+    if isinstance(engine, WorkerPool):
+        return {(str(w["index"]),): (w["engine"] or {}).get("gpu_memory_bytes", 0)
+                for w in engine.stats()["workers"]}
+    return {("local",): engine_stat("gpu_memory_bytes")}
+
+metrics.ACTIVE_SESSIONS.set_function(lambda: len(sessions))
+metrics.QUEUE_DEPTH.set_function(lambda: engine_stat("queue_depth"))
+metrics.BATCH_SIZE.set_function(lambda: engine_stat("batch_size"))
+metrics.GPU_MEMORY.set_function(gpu_memory_by_worker)
+
+def load_semantic_index():
+    """Build the semantic red flag index; keyword matching works until it is ready."""
+    global semantic_index
+    semantic_index = SemanticFlagIndex.build(content.flags, SEMANTIC_MODEL, SEMANTIC_CACHE, SEMANTIC_THRESHOLD)
 
 # ---------- API Endpoints (ALL WITH /api PREFIX) ----------
 
@@ -334,72 +857,157 @@ async def root():
     """Health check."""
     return {"status": "ok", "app": "Cyber Safer"}
 
+@app.get("/api/ready")
+async def ready():
+    """Readiness: 200 once the model can generate, 503 (with Retry-After) before that."""
+    status = {
+        "ready": model_status == "ready",
+        "status": model_status,
+        "backend": BACKEND,
+        "model": model_label(BACKEND, ENGINE_CONFIG),
+        "loading_seconds": round(time.monotonic() - model_load_started, 1) if model_load_started else 0,
+    }
+    if model_error:
+        status["error"] = model_error
+    if model_status == "ready":
+        return status
+    headers = {"Retry-After": "10"} if model_status != "error" else {}
+    return JSONResponse(status, status_code=503, headers=headers)
+
+@app.get("/api/engine")
+async def engine_stats():
+    """Generation queue depth and current batch size."""
+    if not engine:
+        return {"ready": False}
+    stats = engine.stats()
+    if response_cache is not None:
+        stats["response_cache"] = response_cache.stats()
+    if result_store:
+        stats["result_store"] = result_store.stats()
+    return stats
+
+@app.get("/api/metrics")
+async def metrics_endpoint():
+    """Prometheus text format; includes model workers' engine metrics."""
+    extra = engine.metric_snapshots() if isinstance(engine, WorkerPool) else []
+    return PlainTextResponse(metrics.REGISTRY.render(extra), media_type="text/plain; version=0.0.4")
+
 @app.get("/api/scenarios")
 async def list_scenarios():
     """List all available scenarios grouped by category."""
-    categories = {}
+    return {"categories": content.categories}
+
+@app.get("/api/scenario/status")
+async def get_scenario_status(request: Request):
+    """Get current scenario status including red flag count.
+
+    Registered before /api/scenario/{scenario_id} so "status" is not taken as an ID.
+    """
+    session = sessions.get(session_id_from(request))
+    return session.status() if session else {"active": False}
+
+def sse_event(event_id: int, event: str, data: Dict[str, Any]) -> str:
+    return f"id: {event_id}\nevent: {event}\ndata: {json.dumps(data)}\n\n"
+
+@app.get("/api/scenario/events")
+async def scenario_events(request: Request):
+    """Server-sent events for the learner's scenario, instead of polling /api/scenario/status.
+
+    The stream opens with a full "status" event, then carries "status" (scenario
+    started or left), "red_flags" (new flags, with the updated counts) and
+    "completed" (the score) as they happen, plus a heartbeat comment when idle.
+    A reconnecting browser gets the full status again, so it never misses a change.
+    """
+    session = sessions.get_or_create(session_id_from(request))
     
-    for scenario_id, scenario in scenarios_cache.items():
-        category = scenario.get("category", "uncategorized")
-        if category not in categories:
-            categories[category] = []
-        
-        categories[category].append({
-            "id": scenario_id,
-            "title": scenario.get("title", "Untitled"),
-            "difficulty": scenario.get("difficulty", "medium"),
-            "description": scenario.get("introduction", "")[:100] + "..."
-        })
+    async def stream():
+        queue: asyncio.Queue = asyncio.Queue()
+        session.watchers.append(queue)
+        metrics.STATUS_STREAMS.inc()
+        try:
+            yield f"retry: {EVENTS_RETRY_MS}\n\n"
+            yield sse_event(session.event_id, "status", session.status())
+            while True:
+                try:
+                    event_id, event, data = await asyncio.wait_for(queue.get(), EVENTS_HEARTBEAT)
+                except asyncio.TimeoutError:
+                    # Stop streaming for learners who left or whose session expired;
+                    # an open stream alone does not keep a session alive
+                    if await request.is_disconnected() or sessions.peek(session.session_id) is not session:
+                        break
+                    yield ": heartbeat\n\n"
+                    continue
+                yield sse_event(event_id, event, data)
+        finally:
+            session.watchers.remove(queue)
+            metrics.STATUS_STREAMS.inc(-1)
     
-    return {"categories": categories}
+    response = StreamingResponse(stream(), media_type="text/event-stream",
+                                 headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+    attach_session(response, session)
+    return response
 
 @app.get("/api/scenario/{scenario_id}")
 async def get_scenario(scenario_id: str):
     """Get details of a specific scenario."""
-    if scenario_id not in scenarios_cache:
+    scenario = content.scenario(scenario_id)
+    if scenario is None:
         raise HTTPException(status_code=404, detail=f"Scenario '{scenario_id}' not found")
     
-    return scenarios_cache[scenario_id]
+    return scenario
 
 @app.post("/api/scenario/{scenario_id}/start")
-async def start_scenario(scenario_id: str):
+async def start_scenario(scenario_id: str, request: Request, response: Response):
     """Start a new scenario session."""
-    global current_scenario, scenario_state, player, system_text, player_filename
-    
-    if scenario_id not in scenarios_cache:
+    scenario = content.scenario(scenario_id)
+    if scenario is None:
         raise HTTPException(status_code=404, detail=f"Scenario '{scenario_id}' not found")
     
-    scenario = scenarios_cache[scenario_id]
-    
     # Load the adversary player for this scenario
     adversary_name = scenario.get("player")
     if not adversary_name:
         raise HTTPException(status_code=400, detail="Scenario missing player definition")
     
-    adversary = load_player(adversary_name, base_dir="players")
+    adversary = content.player(adversary_name)
     
     if not adversary:
         raise HTTPException(status_code=404, detail=f"Adversary player '{adversary_name}' not found")
     
+    # Tokenize the opener off the event loop, before the session changes, so
+    # nothing can run between clearing the history and adding it
+    initial_msg = scenario.get("initial_message", "")
+    if initial_msg:
+        entry = await asyncio.get_running_loop().run_in_executor(
+            tokenizer_pool, history_entry, "assistant", initial_msg)
+    
+    # Reuse the learner's session if they have one, otherwise issue a new one
+    session = sessions.get_or_create(session_id_from(request))
+    attach_session(response, session)
+    
     # Switch to adversary player
-    player = adversary
-    player_filename = adversary_name
-    system_text = build_system_text(adversary)
-    clear_history()
+    session.set_player(adversary, adversary_name, content.system_text(adversary_name))
+    session.clear_history()
     
     # Initialize scenario state
-    current_scenario = scenario
-    scenario_state = ScenarioState(scenario_id=scenario_id)
+    session.current_scenario = scenario
+    session.scenario_state = ScenarioState(scenario_id=scenario_id, attempt_id=secrets.token_hex(8))
+    if result_store:
+        result_store.record_attempt(session.scenario_state.attempt_id, session.session_id, scenario_id,
+                                    scenario.get("category"), adversary_name)
     
     # Add initial message from adversary
-    initial_msg = scenario.get("initial_message", "")
     if initial_msg:
-        add_to_history("assistant", initial_msg)
+        session.add_to_history("assistant", initial_msg, entry)
+        if result_store:
+            result_store.record_turn(session.scenario_state.attempt_id, "assistant", initial_msg)
+    session.publish("status", session.status())
     
-    print(f"🎮 Started scenario: {scenario.get('title')}")
+    metrics.SCENARIOS.inc(event="started")
+    log.debug("🎮 Started scenario %s session=%s active=%d", scenario_id, session.session_id[:8], len(sessions))
     
     return {
         "ok": True,
+        "session_id": session.session_id,
         "scenario": {
             "id": scenario_id,
             "title": scenario.get("title"),
@@ -407,24 +1015,43 @@ async def start_scenario(scenario_id: str):
             "category": scenario.get("category")
         },
         "initial_message": initial_msg,
-        "adversary": player.get("name")
+        "adversary": adversary.get("name")
     }
 
 @app.post("/api/chat/stream")
-async def chat_stream(payload: Dict[str, str]):
+async def chat_stream(payload: Dict[str, str], request: Request):
     """Streamed chat endpoint - shows red flags in real-time."""
     message = payload.get("message", "").strip()
     if not message:
         raise HTTPException(status_code=400, detail="Empty message.")
     
-    async def stream_with_flags():
-        """Stream both red flag alerts and AI response."""
+    # A reply from the reply bank needs no model, so it does not wait for one to load
+    existing = sessions.get(session_id_from(request))
+    banked = banked_reply(existing, message) if existing else None
+    if banked is None:
+        await wait_for_model()
+    
+    # Free chat with the default player does not need a scenario, so create on demand
+    session = sessions.get_or_create(session_id_from(request))
+    
+    fmt = negotiate(request.headers.get("accept", ""))
+    
+    async def chat_events():
+        """Red flag alerts, then the AI response, as (frame type, data) pairs."""
         detected_flags = []
+        current_scenario = session.current_scenario
+        scenario_state = session.scenario_state
         
         # If in scenario mode, detect flags BEFORE streaming response
         if current_scenario and scenario_state:
             red_flags = current_scenario.get("red_flags", [])
-            detected_flags = detect_red_flags(message, red_flags)
+            with metrics.RED_FLAG_SECONDS.time(stage="keyword"):
+                detected_flags = detect_red_flags(message, red_flags, scenario_state.scenario_id)
+            # Only flags still outstanding are worth an embedding lookup
+            remaining = [f for f in red_flags if f not in detected_flags and f not in scenario_state.red_flags_detected]
+            if semantic_index and remaining:
+                with metrics.RED_FLAG_SECONDS.time(stage="semantic"):
+                    detected_flags += await detect_semantic_flags(message, remaining)
             
             if detected_flags:
                 # Add newly detected flags to state
@@ -435,40 +1062,77 @@ async def chat_stream(payload: Dict[str, str]):
                         new_flags.append(flag)
                 
                 scenario_state.user_responses.append(message)
-                print(f"🚩 Red flags detected: {detected_flags}")
+                for flag in detected_flags:
+                    metrics.RED_FLAGS.inc(flag=flag)
+                log.info("🚩 Red flags session=%s flags=%s", session.session_id[:8], ",".join(detected_flags))
                 
-                # Stream flag notifications FIRST
+                # Send flag notifications FIRST
                 if new_flags:
-                    total_flags = len(scenario_state.red_flags_detected)
-                    start_num = total_flags - len(new_flags) + 1
-                    
-                    # Send counter update as special marker
-                    success_criteria = current_scenario.get("success_criteria", [])
-                    detected_count = len([f for f in success_criteria if f in scenario_state.red_flags_detected])
-                    total_required = len(success_criteria)
-                    yield f"[COUNTER:{detected_count}/{total_required}]\n"
-                    
+                    status = session.status()
+                    session.publish("red_flags", dict(status, new_flags=new_flags))
+                    if result_store:
+                        result_store.record_flags(scenario_state.attempt_id, new_flags)
+                    yield "counter", {"found": status["red_flags_found"], "required": status["red_flags_required"]}
+                    start_num = status["red_flags_detected"] - len(new_flags) + 1
                     for i, flag in enumerate(new_flags):
-                        flag_name = flag.replace('_', ' ').title()
-                        flag_msg = f"🚩 RED FLAG #{start_num + i} DETECTED: {flag_name}\n"
-                        yield flag_msg
-                    
-                    yield "\n"  # Separator before AI response
+                        yield "flag", {"flag": flag, "name": flag.replace('_', ' ').title(), "number": start_num + i}
         
         # Now stream the normal AI response
-        async for token in stream_response(message):
-            yield token
+        async for token in coalesce(stream_response(session, message, banked), STREAM_FLUSH):
+            yield "token", token
+    
+    async def stream_with_flags():
+        """Plain text: counter marker and flag lines, a blank line, then the response."""
+        flagged = False
+        async for kind, data in chat_events():
+            if kind == "counter":
+                yield f"[COUNTER:{data['found']}/{data['required']}]\n"
+            elif kind == "flag":
+                flagged = True
+                yield f"🚩 RED FLAG #{data['number']} DETECTED: {data['name']}\n"
+            else:
+                if flagged:
+                    flagged = False
+                    yield "\n"  # Separator before AI response
+                yield data
+        if flagged:
+            yield "\n"
+    
+    async def stream_frames():
+        """Typed frames with timings (see streaming.py)."""
+        start = time.perf_counter()
+        first_token_ms = None
+        frames = chars = 0
+        async for kind, data in chat_events():
+            elapsed_ms = round((time.perf_counter() - start) * 1000)
+            if kind == "token":
+                if first_token_ms is None:
+                    first_token_ms = elapsed_ms
+                chars += len(data)
+                frame = {"type": "token", "text": data, "t_ms": elapsed_ms}
+            else:
+                frame = {"type": kind, **data, "t_ms": elapsed_ms}
+            frames += 1
+            yield encode(fmt, frame)
+        yield encode(fmt, {"type": "done", "chars": chars, "frames": frames, "ttft_ms": first_token_ms,
+                           "total_ms": round((time.perf_counter() - start) * 1000)})
     
-    return StreamingResponse(stream_with_flags(), media_type="text/plain")
+    body = stream_with_flags() if fmt == "text" else stream_frames()
+    headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"} if fmt == "sse" else None
+    response = StreamingResponse(body, media_type=media_type(fmt), headers=headers)
+    attach_session(response, session)
+    return response
 
 @app.post("/api/scenario/complete")
-async def complete_scenario():
+async def complete_scenario(request: Request):
     """Mark scenario as complete and calculate score."""
-    global scenario_state, current_scenario
-    
-    if not current_scenario or not scenario_state:
+    session = sessions.get(session_id_from(request))
+    if not session or not session.current_scenario or not session.scenario_state:
         raise HTTPException(status_code=400, detail="No active scenario")
     
+    current_scenario = session.current_scenario
+    scenario_state = session.scenario_state
+    
     # Calculate final score
     final_score = calculate_scenario_score(scenario_state, current_scenario)
     scenario_state.score = final_score
@@ -487,50 +1151,76 @@ async def complete_scenario():
         "success_criteria_met": met_criteria,
         "success_criteria_total": success_criteria,
         "feedback": current_scenario.get("debrief", "Well done!"),
-        "learning_objectives": current_scenario.get("learning_objectives", [])
+        "learning_objectives": current_scenario.get("learning_objectives", []),
+        "attempt_id": scenario_state.attempt_id
     }
     
-    print(f"🏁 Scenario completed. Score: {final_score}/100, Passed: {passed}")
+    metrics.SCENARIOS.inc(event="completed")
+    if passed:
+        metrics.SCENARIOS.inc(event="passed")
+    log.debug("🏁 Scenario completed session=%s score=%d passed=%s", session.session_id[:8], final_score, passed)
+    if result_store:
+        result_store.record_result(scenario_state.attempt_id, scenario_state.scenario_id, result)
+    session.publish("completed", dict(session.status(), score=final_score, passed=passed))
     
     return result
 
 @app.post("/api/scenario/exit")
-async def exit_scenario():
+async def exit_scenario(request: Request):
     """Exit current scenario and return to normal mode."""
-    global current_scenario, scenario_state, player, system_text, player_filename
-    
-    # Reset to default player
-    default_player = load_player(DEFAULT_PLAYER)
-    player = default_player
-    player_filename = os.path.splitext(os.path.basename(DEFAULT_PLAYER))[0]
-    system_text = build_system_text(default_player)
-    clear_history()
-    
-    current_scenario = None
-    scenario_state = None
-    
-    print("👋 Exited scenario mode")
+    session = sessions.get(session_id_from(request))
+    if session:
+        session.reset()
+        session.publish("status", session.status())
+    metrics.SCENARIOS.inc(event="exited")
+    log.debug("👋 Exited scenario mode session=%s", session.session_id[:8] if session else None)
     
     return {"ok": True, "message": "Exited scenario mode"}
 
-@app.get("/api/scenario/status")
-async def get_scenario_status():
-    """Get current scenario status including red flag count."""
-    if not current_scenario or not scenario_state:
-        return {"active": False}
-    
-    success_criteria = current_scenario.get("success_criteria", [])
-    total_required = len(success_criteria)
-    detected_count = len([f for f in success_criteria if f in scenario_state.red_flags_detected])
-    
-    return {
-        "active": True,
-        "scenario_id": current_scenario.get("id"),
-        "red_flags_detected": len(scenario_state.red_flags_detected),
-        "red_flags_required": total_required,
-        "red_flags_found": detected_count,
-        "all_detected_flags": list(set(scenario_state.red_flags_detected))
-    }
+def require_teacher(request: Request):
+    """Only callers with the teacher key may read learners' results and transcripts."""
+    if not TEACHER_KEY:
+        raise HTTPException(status_code=403, detail="Results are closed (set CYBERS_TEACHER_KEY)")
+    if not secrets.compare_digest(request.headers.get(TEACHER_HEADER, "").encode(), TEACHER_KEY.encode()):
+        raise HTTPException(status_code=403, detail=f"Missing or wrong {TEACHER_HEADER}")
+
+@app.get("/api/results")
+async def list_results(request: Request, scenario_id: Optional[str] = None, session_id: Optional[str] = None,
+                       since: Optional[float] = None, limit: int = 100):
+    """Completed scenario attempts, newest first, from the result store (teacher key required)."""
+    require_teacher(request)
+    if not result_store:
+        raise HTTPException(status_code=404, detail="Result store is off (set CYBERS_STORE)")
+    results = await asyncio.to_thread(result_store.results, scenario_id, session_id, since, min(limit, 1000))
+    return {"results": results}
+
+@app.get("/api/results/{attempt_id}")
+async def get_result(attempt_id: str, request: Request):
+    """One scenario attempt with its turns and detected flags (teacher key required)."""
+    require_teacher(request)
+    if not result_store:
+        raise HTTPException(status_code=404, detail="Result store is off (set CYBERS_STORE)")
+    attempt = await asyncio.to_thread(result_store.attempt, attempt_id)
+    if attempt is None:
+        raise HTTPException(status_code=404, detail=f"Attempt '{attempt_id}' not found")
+    return attempt
+
+@app.get("/api/analytics")
+async def analytics():
+    """Pass rates per scenario and category, score distribution and most-missed flags."""
+    if not result_store:
+        raise HTTPException(status_code=404, detail="Result store is off (set CYBERS_STORE)")
+    return await asyncio.to_thread(result_store.analytics)
+
+@app.get("/api/analytics/{scenario_id}")
+async def scenario_analytics(scenario_id: str):
+    """The same figures for one scenario."""
+    if not result_store:
+        raise HTTPException(status_code=404, detail="Result store is off (set CYBERS_STORE)")
+    report = await asyncio.to_thread(result_store.analytics, scenario_id)
+    if not report["scenarios"]:
+        raise HTTPException(status_code=404, detail=f"No attempts at scenario '{scenario_id}'")
+    return report
 
 # ---------- Serve static UI ----------
 app.mount("/", StaticFiles(directory="static", html=True), name="static")
@@ -0,0 +1,673 @@
+"""
+Continuous batching generation engine for Cyber Safer.
+
+Chat requests are queued and decoded together at the iteration level: every
+step the engine admits waiting requests (prefilling each one), then runs a
+single batched forward pass over all active sequences. Finished sequences leave
+the batch straight away, so one long reply never holds up a short one.
+
+Each request streams its decoded text into its own asyncio queue, so the web
+tier just does `async for piece in engine.generate(...)`.
+
+Prompts that start with a shared prefix (a persona's system prompt, a
+scenario's opening message) reuse that prefix's KV cache from a PrefixCache,
+and each session keeps its own KV from the previous turn in a SessionCache,
+so prefill only covers the part of the prompt that is new.
+
+With a draft model (a small model sharing the tokenizer), decoding is
+speculative: the draft proposes a few tokens per row, the model checks them
+in one forward pass, and each row keeps the run it accepts plus one token of
+its own. Sampling follows the speculative sampling rule, so replies come from
+the same distribution as plain decoding.
+"""
+
+import asyncio
+import hashlib
+import threading
+import time
+from collections import OrderedDict, deque
+from typing import Any, AsyncGenerator, Deque, Dict, List, Optional, Sequence, Set, Tuple
+
+import torch
+import torch.nn.functional as F
+from transformers import DynamicCache
+
+from metrics import DRAFT_ACCEPTED, DRAFT_TOKENS, QUEUE_WAIT
+
+KV = Tuple[Tuple[torch.Tensor, torch.Tensor], ...]
+
+# ---------- KV cache helpers ----------
+
+def kv_to_tuples(cache: Any) -> KV:
+    """Normalise a model's past_key_values to ((k, v), ...) per layer."""
+    if isinstance(cache, tuple):
+        return cache
+    if hasattr(cache, "layers"):  # transformers >= 4.56
+        return tuple((layer.keys, layer.values) for layer in cache.layers)
+    return cache.to_legacy_cache()
+
+def kv_from_tuples(kv: KV) -> Any:
+    """Build a cache object the model accepts from ((k, v), ...) per layer."""
+    if hasattr(DynamicCache, "from_legacy_cache"):
+        return DynamicCache.from_legacy_cache(kv)
+    return DynamicCache(kv)
+
+def _left_pad(t: torch.Tensor, n: int) -> torch.Tensor:
+    """Pad the sequence axis (dim 2 of k/v, dim 1 of a mask) on the left."""
+    if n <= 0:
+        return t
+    if t.dim() == 2:
+        return F.pad(t, (n, 0))
+    return F.pad(t, (0, 0, n, 0))
+
+def eos_token_ids(model, tok) -> Set[int]:
+    """All token IDs that end a reply (tokenizer EOS plus generation_config EOS)."""
+    ids = set()
+    for value in (tok.eos_token_id, getattr(model.generation_config, "eos_token_id", None)):
+        if isinstance(value, int):
+            ids.add(value)
+        elif value:
+            ids.update(value)
+    return ids
+
+def kv_nbytes(kv: KV) -> int:
+    return sum(k.numel() * k.element_size() + v.numel() * v.element_size() for k, v in kv)
+
+def kv_prefix(kv: KV, n: int) -> KV:
+    """Copy of the first n positions (a copy, so the full tensors can be freed)."""
+    return tuple((k[:, :, :n].clone(), v[:, :, :n].clone()) for k, v in kv)
+
+# ---------- Prefix cache ----------
+
+class PrefixCache:
+    """LRU cache of past_key_values for shared prompt prefixes, bounded by memory.
+
+    Entries are keyed by a hash of the prefix token IDs. Callers pass the
+    candidate prefix lengths worth caching (e.g. end of the system block, end
+    of the scenario opener); lookups take the longest one that is present.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries: "OrderedDict[str, KV]" = OrderedDict()
+
+    @staticmethod
+    def key(ids: Sequence[int]) -> str:
+        return hashlib.blake2b(repr(list(ids)).encode(), digest_size=16).hexdigest()
+
+    def lookup(self, ids: List[int], lengths: Sequence[int]) -> Tuple[Optional[KV], int]:
+        """Longest cached prefix of ids among the candidate lengths, as (kv, length)."""
+        for n in sorted(set(lengths), reverse=True):
+            # Always leave at least one token to run through the model
+            if not 0 < n < len(ids):
+                continue
+            key = self.key(ids[:n])
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key], n
+        if lengths:
+            self.misses += 1
+        return None, 0
+
+    def store(self, ids: List[int], lengths: Sequence[int], kv: KV):
+        """Cache every candidate prefix of ids not already present, sliced from kv."""
+        for n in set(lengths):
+            if not 0 < n < len(ids):
+                continue
+            key = self.key(ids[:n])
+            if key in self._entries:
+                continue
+            entry = kv_prefix(kv, n)
+            size = kv_nbytes(entry)
+            if size > self.max_bytes:
+                continue
+            self._entries[key] = entry
+            self.nbytes += size
+        while self.nbytes > self.max_bytes and self._entries:
+            _, evicted = self._entries.popitem(last=False)
+            self.nbytes -= kv_nbytes(evicted)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "entries": len(self._entries),
+            "bytes": self.nbytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+# ---------- Session cache ----------
+
+def common_prefix_len(a: Sequence[int], b: Sequence[int]) -> int:
+    n = min(len(a), len(b))
+    for i in range(n):
+        if a[i] != b[i]:
+            return i
+    return n
+
+class SessionCache:
+    """KV cache carried across a session's conversation turns.
+
+    When a reply finishes, the tokens it covered (prompt + reply) and their KV
+    are kept under the session ID. The next turn reuses the longest common
+    token prefix with its new prompt, so normally only the new user message is
+    prefilled; when the history window slides the common part shrinks and the
+    rest is recomputed. Least recently used sessions are offloaded to CPU
+    memory once the device budget is exceeded, and dropped after that.
+    """
+
+    def __init__(self, max_bytes: int, offload_bytes: int, device: torch.device):
+        self.max_bytes = max_bytes
+        self.offload_bytes = offload_bytes if device.type != "cpu" else 0
+        self.device = device
+        self.device_nbytes = 0
+        self.offloaded_nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.reused_tokens = 0
+        self._lock = threading.Lock()
+        # key -> [token ids, kv, nbytes, on_device]
+        self._entries: "OrderedDict[str, list]" = OrderedDict()
+
+    def take(self, key: str, ids: List[int]) -> Tuple[Optional[KV], int]:
+        """Remove a session's cache and return the part reusable for ids, as (kv, length)."""
+        with self._lock:
+            entry = self._pop(key)
+        if entry is None:
+            return None, 0
+        cached_ids, kv, _, on_device = entry
+        # Always leave at least one token to run through the model
+        n = min(common_prefix_len(cached_ids, ids), len(ids) - 1)
+        if n <= 0:
+            self.misses += 1
+            return None, 0
+        if not on_device:
+            kv = tuple((k.to(self.device), v.to(self.device)) for k, v in kv)
+        self.hits += 1
+        self.reused_tokens += n
+        return tuple((k[:, :, :n], v[:, :, :n]) for k, v in kv), n
+
+    def store(self, key: str, ids: List[int], kv: KV):
+        """Keep a finished turn's KV for the session's next turn."""
+        size = kv_nbytes(kv)
+        with self._lock:
+            self._pop(key)
+            self._entries[key] = [ids, kv, size, True]
+            self.device_nbytes += size
+            self._enforce()
+
+    def drop(self, key: str):
+        with self._lock:
+            self._pop(key)
+
+    def _pop(self, key: str) -> Optional[list]:
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            if entry[3]:
+                self.device_nbytes -= entry[2]
+            else:
+                self.offloaded_nbytes -= entry[2]
+        return entry
+
+    def _enforce(self):
+        for key in list(self._entries):
+            if self.device_nbytes <= self.max_bytes:
+                break
+            entry = self._entries[key]
+            if not entry[3]:
+                continue
+            self.device_nbytes -= entry[2]
+            if self.offload_bytes:
+                entry[1] = tuple((k.to("cpu"), v.to("cpu")) for k, v in entry[1])
+                entry[3] = False
+                self.offloaded_nbytes += entry[2]
+            else:
+                del self._entries[key]
+        for key in list(self._entries):
+            if self.offloaded_nbytes <= self.offload_bytes:
+                break
+            if not self._entries[key][3]:
+                self._pop(key)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "sessions": len(self._entries),
+            "device_bytes": self.device_nbytes,
+            "offloaded_bytes": self.offloaded_nbytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "reused_tokens": self.reused_tokens,
+        }
+
+# ---------- Requests ----------
+
+class GenerationRequest:
+    """A single prompt waiting for, or going through, batched decoding."""
+
+    def __init__(self, input_ids: List[int], max_new_tokens: int, temperature: float,
+                 top_p: float, loop: asyncio.AbstractEventLoop, prefix_lengths: Sequence[int] = (),
+                 session_id: Optional[str] = None):
+        self.input_ids = input_ids
+        self.prefix_lengths = prefix_lengths
+        self.session_id = session_id
+        self.max_new_tokens = max_new_tokens
+        self.temperature = temperature
+        self.top_p = top_p
+        self.loop = loop
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self.generated: List[int] = []
+        self.emitted = 0  # characters of decoded text already sent
+        self.cancelled = False
+        self.submitted_at = time.perf_counter()
+
+    def put(self, item: Any):
+        """Hand a text piece, exception or end marker (None) to the consumer."""
+        self.loop.call_soon_threadsafe(self.queue.put_nowait, item)
+
+    def cancel(self):
+        """Ask the engine to drop this request at the next step."""
+        self.cancelled = True
+
+# ---------- Engine ----------
+
+class BatchingEngine:
+    """Schedules chat generations onto the model with continuous batching."""
+
+    def __init__(self, model, tok, max_batch_size: int = 8, prefix_cache_bytes: int = 0,
+                 session_cache_bytes: int = 0, session_offload_bytes: int = 0,
+                 draft_model=None, draft_tokens: int = 4, draft_max_batch: int = 4):
+        self.model = model
+        self.tok = tok
+        self.max_batch_size = max_batch_size
+        self.device = next(model.parameters()).device
+        self.prefix_cache = PrefixCache(prefix_cache_bytes) if prefix_cache_bytes > 0 else None
+        self.session_cache = (SessionCache(session_cache_bytes, session_offload_bytes, self.device)
+                              if session_cache_bytes > 0 else None)
+        self.eos_ids = eos_token_ids(model, tok)
+        # Speculative decoding: draft_tokens proposals per step while the batch
+        # has at most draft_max_batch rows (bigger batches are compute bound)
+        self.draft = draft_model
+        self.draft_tokens = draft_tokens
+        self.draft_max_batch = draft_max_batch
+        self.drafted = 0
+        self.accepted = 0
+
+        self._pending: Deque[GenerationRequest] = deque()
+        self._wakeup = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+        # Batched decode state: one row per active request, caches left-padded
+        self._rows: List[GenerationRequest] = []
+        self._kv: Optional[List[List[torch.Tensor]]] = None
+        self._draft_kv: Optional[List[List[torch.Tensor]]] = None
+        self._mask: Optional[torch.Tensor] = None
+
+        self.steps = 0
+        self.completed = 0
+        self.peak_batch_size = 0
+
+    def start(self):
+        """Start the scheduler thread (idempotent)."""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="generation-engine", daemon=True)
+            self._thread.start()
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "queue_depth": len(self._pending),
+            "batch_size": len(self._rows),
+            "max_batch_size": self.max_batch_size,
+            "peak_batch_size": self.peak_batch_size,
+            "steps": self.steps,
+            "completed": self.completed,
+            "gpu_memory_bytes": torch.cuda.memory_allocated(self.device) if self.device.type == "cuda" else 0,
+            "prefix_cache": self.prefix_cache.stats() if self.prefix_cache else None,
+            "session_cache": self.session_cache.stats() if self.session_cache else None,
+            "speculative": {
+                "draft_tokens": self.draft_tokens,
+                "max_batch": self.draft_max_batch,
+                "proposed": self.drafted,
+                "accepted": self.accepted,
+                "acceptance_rate": round(self.accepted / self.drafted, 3) if self.drafted else None,
+            } if self.draft is not None else None,
+        }
+
+    def forget_session(self, session_id: str):
+        """Release a session's carried-over KV (scenario switch, exit, eviction)."""
+        if self.session_cache:
+            self.session_cache.drop(session_id)
+
+    def cancel_session(self, session_id: str):
+        """Stop a session's queued or running replies; each ends at the next step.
+
+        This is the engine's stopping criterion: a cancelled row samples no
+        further tokens, flushes its text and leaves the batch.
+        """
+        for req in list(self._pending) + list(self._rows):
+            if req.session_id == session_id:
+                req.cancel()
+
+    async def generate(self, input_ids: List[int], max_new_tokens: int = 250,
+                       temperature: float = 0.7, top_p: float = 0.9,
+                       prefix_lengths: Sequence[int] = (),
+                       session_id: Optional[str] = None) -> AsyncGenerator[str, None]:
+        """Queue a prompt and yield decoded text as the batch produces it.
+
+        prefix_lengths are token counts at which the prompt ends a shared prefix
+        (system prompt, scenario opener) worth caching for other requests.
+        session_id carries this request's KV over to the session's next turn.
+        """
+        req = GenerationRequest(input_ids, max_new_tokens, temperature, top_p,
+                                asyncio.get_running_loop(), prefix_lengths, session_id)
+        self.start()
+        self._pending.append(req)
+        self._wakeup.set()
+        try:
+            while True:
+                item = await req.queue.get()
+                if item is None:
+                    break
+                if isinstance(item, BaseException):
+                    raise item
+                yield item
+        finally:
+            # Consumer finished or went away; either way the row can go
+            req.cancel()
+
+    # ----- scheduler thread -----
+
+    def _run(self):
+        with torch.inference_mode(), torch.autocast("cuda", enabled=self.device.type == "cuda"):
+            while True:
+                if not self._rows and not self._pending:
+                    self._wakeup.wait()
+                    self._wakeup.clear()
+                    continue
+                try:
+                    self._admit()
+                    if self._rows:
+                        self._step()
+                except Exception as e:
+                    print(f"❌ Generation engine error: {e}")
+                    for req in self._rows:
+                        req.put(e)
+                    self._reset_batch()
+
+    def _admit(self):
+        """Prefill waiting requests and add them to the running batch."""
+        while self._pending and len(self._rows) < self.max_batch_size:
+            req = self._pending.popleft()
+            if req.cancelled:
+                req.put(None)
+                continue
+            QUEUE_WAIT.observe(time.perf_counter() - req.submitted_at)
+            try:
+                self._prefill(req)
+            except Exception as e:
+                # The request is in neither _pending nor _rows now, so fail it here
+                print(f"❌ Prefill failed: {e}")
+                req.put(e)
+
+    def _prefill(self, req: GenerationRequest):
+        """Run one request's prompt through the model and join it to the batch."""
+        cached, start = None, 0
+        if self.session_cache and req.session_id:
+            cached, start = self.session_cache.take(req.session_id, req.input_ids)
+        if self.prefix_cache and start < max(req.prefix_lengths, default=0):
+            prefix_kv, prefix_len = self.prefix_cache.lookup(req.input_ids, req.prefix_lengths)
+            if prefix_len > start:
+                cached, start = prefix_kv, prefix_len
+        ids = torch.tensor([req.input_ids[start:]], device=self.device)
+        out = self.model(
+            input_ids=ids,
+            past_key_values=kv_from_tuples(cached) if cached else None,
+            use_cache=True,
+        )
+        kv = kv_to_tuples(out.past_key_values)
+        if self.prefix_cache:
+            self.prefix_cache.store(req.input_ids, req.prefix_lengths, kv)
+        token = self._sample(out.logits[:, -1, :], [req])[0]
+        if self._advance(req, token):
+            return
+        draft_kv = None
+        if self.draft is not None:
+            # The draft has no shared caches; it prefills the whole prompt
+            ids = torch.tensor([req.input_ids], device=self.device)
+            draft_kv = kv_to_tuples(self.draft(input_ids=ids, use_cache=True).past_key_values)
+        self._join(req, kv, draft_kv)
+
+    def _join(self, req: GenerationRequest, kv: KV, draft_kv: Optional[KV] = None):
+        """Append a prefilled request as a new row, left-padding to a common length."""
+        new_len = kv[0][0].shape[2]
+        mask = torch.ones(1, new_len, dtype=torch.long, device=self.device)
+        if self._kv is None:
+            self._kv = [[k, v] for k, v in kv]
+            self._draft_kv = [[k, v] for k, v in draft_kv] if draft_kv else None
+            self._mask = mask
+        else:
+            cur_len = self._mask.shape[1]
+            pad_new, pad_cur = max(cur_len - new_len, 0), max(new_len - cur_len, 0)
+            cat = lambda a, b: [
+                [torch.cat([_left_pad(k0, pad_cur), _left_pad(k, pad_new)]),
+                 torch.cat([_left_pad(v0, pad_cur), _left_pad(v, pad_new)])]
+                for (k0, v0), (k, v) in zip(a, b)
+            ]
+            self._kv = cat(self._kv, kv)
+            if draft_kv:
+                self._draft_kv = cat(self._draft_kv, draft_kv)
+            self._mask = torch.cat([_left_pad(self._mask, pad_cur), _left_pad(mask, pad_new)])
+        self._rows.append(req)
+        self.peak_batch_size = max(self.peak_batch_size, len(self._rows))
+
+    def _step(self):
+        """One decode iteration for every active row."""
+        if self.draft is not None and len(self._rows) <= self.draft_max_batch:
+            self._speculate()
+            return
+        input_ids = torch.tensor([[r.generated[-1]] for r in self._rows], device=self.device)
+        # Padding is masked out, so each row's next position is its real length
+        position_ids = self._mask.sum(dim=1, keepdim=True)
+        mask = torch.cat([self._mask, self._mask.new_ones(len(self._rows), 1)], dim=1)
+        out = self.model(
+            input_ids=input_ids,
+            attention_mask=mask,
+            position_ids=position_ids,
+            past_key_values=kv_from_tuples(tuple(tuple(layer) for layer in self._kv)),
+            use_cache=True,
+        )
+        self._kv = [[k, v] for k, v in kv_to_tuples(out.past_key_values)]
+        if self.draft is not None:
+            # Keep the draft's cache in step for when the batch is small again
+            draft_out = self.draft(
+                input_ids=input_ids,
+                attention_mask=mask,
+                position_ids=position_ids,
+                past_key_values=kv_from_tuples(tuple(tuple(layer) for layer in self._draft_kv)),
+                use_cache=True,
+            )
+            self._draft_kv = [[k, v] for k, v in kv_to_tuples(draft_out.past_key_values)]
+        self._mask = mask
+        self.steps += 1
+
+        tokens = self._sample(out.logits[:, -1, :], self._rows)
+        done = [i for i, (req, token) in enumerate(zip(self._rows, tokens)) if self._advance(req, token)]
+        if done:
+            self._drop(done)
+
+    def _speculate(self):
+        """One speculative decoding iteration for every active row.
+
+        The draft runs draft_tokens + 1 single-token steps (the last only to
+        cache its final proposal), the model scores all proposals in one pass,
+        and each row accepts proposal j with probability min(1, p/q). The
+        first rejected position is resampled from max(p - q, 0); a row that
+        accepts everything gets a bonus token from p. Both caches then hold
+        positions nobody accepted at their ends, which _realign removes.
+        """
+        rows, depth = self._rows, self.draft_tokens
+        lengths = self._mask.sum(dim=1, keepdim=True)
+        mask = self._mask
+        last = torch.tensor([[r.generated[-1]] for r in rows], device=self.device)
+        draft_kv = kv_from_tuples(tuple(tuple(layer) for layer in self._draft_kv))
+        token, proposals, draft_probs = last, [], []
+        for j in range(depth + 1):
+            mask = torch.cat([mask, mask.new_ones(len(rows), 1)], dim=1)
+            out = self.draft(input_ids=token, attention_mask=mask, position_ids=lengths + j,
+                             past_key_values=draft_kv, use_cache=True)
+            draft_kv = out.past_key_values
+            if j == depth:
+                break
+            probs = self._probs(out.logits[:, -1:, :], rows)[:, 0]
+            token = torch.multinomial(probs, 1)
+            proposals.append(token)
+            draft_probs.append(probs)
+        drafted = torch.cat(proposals, dim=1)
+        out = self.model(
+            input_ids=torch.cat([last, drafted], dim=1),
+            attention_mask=mask,
+            position_ids=lengths + torch.arange(depth + 1, device=self.device),
+            past_key_values=kv_from_tuples(tuple(tuple(layer) for layer in self._kv)),
+            use_cache=True,
+        )
+        self._kv = [[k, v] for k, v in kv_to_tuples(out.past_key_values)]
+        self._draft_kv = [[k, v] for k, v in kv_to_tuples(draft_kv)]
+        self._mask = mask
+        self.steps += 1
+
+        # Models of one family may pad their vocabularies differently
+        q = torch.stack(draft_probs, dim=1)
+        vocab = min(q.shape[-1], out.logits.shape[-1])
+        p = self._probs(out.logits[..., :vocab], rows)
+        q = q[..., :vocab]
+        p_drafted = p[:, :depth].gather(-1, drafted.unsqueeze(-1)).squeeze(-1)
+        q_drafted = q.gather(-1, drafted.unsqueeze(-1)).squeeze(-1)
+        accepted = (torch.rand_like(p_drafted) * q_drafted < p_drafted).long().cumprod(dim=1).sum(dim=1)
+        index = torch.arange(len(rows), device=self.device)
+        target = p[index, accepted]
+        residual = (target - F.pad(q, (0, 0, 0, 1))[index, accepted]).clamp(min=0)
+        residual = torch.where(residual.sum(dim=-1, keepdim=True) > 0, residual, target)
+        extra = torch.multinomial(residual, 1).squeeze(1)
+
+        drafted, accepted, extra = drafted.tolist(), accepted.tolist(), extra.tolist()
+        self.drafted += depth * len(rows)
+        self.accepted += sum(accepted)
+        DRAFT_TOKENS.inc(depth * len(rows))
+        DRAFT_ACCEPTED.inc(sum(accepted))
+        done = []
+        for i, req in enumerate(rows):
+            for token in drafted[i][:accepted[i]] + [extra[i]]:
+                if self._advance(req, token):
+                    done.append(i)
+                    break
+        self._realign([depth - n for n in accepted])
+        if done:
+            self._drop(done)
+
+    def _realign(self, rejected: List[int]):
+        """Remove each row's rejected trailing positions from both caches.
+
+        Rows keep right-aligned: each one shifts right by its rejected count,
+        and the positions that shift in on the left are masked as padding.
+        """
+        cut = min(rejected)
+        if cut:
+            self._kv = [[k[:, :, :-cut], v[:, :, :-cut]] for k, v in self._kv]
+            self._draft_kv = [[k[:, :, :-cut], v[:, :, :-cut]] for k, v in self._draft_kv]
+            self._mask = self._mask[:, :-cut]
+        shift = torch.tensor([n - cut for n in rejected], device=self.device).unsqueeze(1)
+        if not shift.any():
+            return
+        positions = torch.arange(self._mask.shape[1], device=self.device).unsqueeze(0)
+        source = (positions - shift).clamp(min=0)
+        self._mask = self._mask.gather(1, source) * (positions >= shift)
+
+        def gather(t: torch.Tensor) -> torch.Tensor:
+            return t.gather(2, source[:, None, :, None].expand_as(t))
+        self._kv = [[gather(k), gather(v)] for k, v in self._kv]
+        self._draft_kv = [[gather(k), gather(v)] for k, v in self._draft_kv]
+        start = int(self._mask.any(dim=0).nonzero()[0])
+        if start:
+            self._kv = [[k[:, :, start:], v[:, :, start:]] for k, v in self._kv]
+            self._draft_kv = [[k[:, :, start:], v[:, :, start:]] for k, v in self._draft_kv]
+            self._mask = self._mask[:, start:]
+
+    def _probs(self, logits: torch.Tensor, rows: List[GenerationRequest]) -> torch.Tensor:
+        """Per-row sampling distributions over (rows, positions, vocab) logits, after
+        temperature and top-p; temperature <= 0 (greedy) gives a one-hot argmax."""
+        logits = logits.float()
+        temps = torch.tensor([r.temperature for r in rows], device=logits.device).view(-1, 1, 1)
+        top_p = torch.tensor([r.top_p for r in rows], device=logits.device).view(-1, 1, 1)
+        probs = torch.softmax(logits / temps.clamp(min=1e-5), dim=-1)
+        sorted_probs, sorted_idx = probs.sort(dim=-1, descending=True)
+        cumulative = sorted_probs.cumsum(dim=-1)
+        sorted_probs[(cumulative - sorted_probs) > top_p] = 0
+        probs = torch.zeros_like(probs).scatter_(-1, sorted_idx, sorted_probs)
+        probs = probs / probs.sum(dim=-1, keepdim=True)
+        greedy = F.one_hot(logits.argmax(dim=-1), logits.shape[-1]).to(probs.dtype)
+        return torch.where(temps <= 0, greedy, probs)
+
+    def _sample(self, logits: torch.Tensor, rows: List[GenerationRequest]) -> List[int]:
+        """Per-row temperature / top-p sampling (temperature <= 0 means greedy)."""
+        probs = self._probs(logits.unsqueeze(1), rows)[:, 0]
+        return torch.multinomial(probs, 1).squeeze(1).tolist()
+
+    def _advance(self, req: GenerationRequest, token: int) -> bool:
+        """Record a sampled token, stream any new text, and report if the request is done."""
+        done = token in self.eos_ids or req.cancelled
+        if not done:
+            req.generated.append(token)
+            done = len(req.generated) >= req.max_new_tokens
+        text = self.tok.decode(req.generated, skip_special_tokens=True)
+        # Hold back incomplete multi-byte characters until the next token
+        if (done or not text.endswith("�")) and len(text) > req.emitted:
+            req.put(text[req.emitted:])
+            req.emitted = len(text)
+        if done:
+            self.completed += 1
+            req.put(None)
+        return done
+
+    def _drop(self, indices: List[int]):
+        """Remove finished rows and trim padding no remaining row needs."""
+        if self.session_cache:
+            for i in indices:
+                self._save_session(i)
+        gone = set(indices)
+        keep = [i for i in range(len(self._rows)) if i not in gone]
+        if not keep:
+            self._reset_batch()
+            return
+        index = torch.tensor(keep, device=self.device)
+        self._rows = [self._rows[i] for i in keep]
+        self._kv = [[k.index_select(0, index), v.index_select(0, index)] for k, v in self._kv]
+        if self._draft_kv is not None:
+            self._draft_kv = [[k.index_select(0, index), v.index_select(0, index)] for k, v in self._draft_kv]
+        self._mask = self._mask.index_select(0, index)
+        start = int(self._mask.any(dim=0).nonzero()[0])
+        if start:
+            self._kv = [[k[:, :, start:], v[:, :, start:]] for k, v in self._kv]
+            if self._draft_kv is not None:
+                self._draft_kv = [[k[:, :, start:], v[:, :, start:]] for k, v in self._draft_kv]
+            self._mask = self._mask[:, start:]
+
+    def _save_session(self, i: int):
+        """Copy row i's KV (without its left padding) into the session cache."""
+        req = self._rows[i]
+        if not req.session_id:
+            return
+        length = int(self._mask[i].sum())
+        total = self._mask.shape[1]
+        kv = tuple((k[i:i + 1, :, total - length:].clone(), v[i:i + 1, :, total - length:].clone())
+                   for k, v in self._kv)
+        self.session_cache.store(req.session_id, (req.input_ids + req.generated)[:length], kv)
+
+    def _reset_batch(self):
+        self._rows = []
+        self._kv = None
+        self._draft_kv = None
+        self._mask = None
@@ -0,0 +1,252 @@
+"""
+Metrics for Cyber Safer, served at /api/metrics in the Prometheus text format.
+
+A small in-process registry (no client library needed) with counters, gauges
+and histograms. Every metric the app records is declared at the bottom of
+this file. Model worker processes send a snapshot of their registry with each
+heartbeat, and the app adds those into its own output (see workers.py).
+"""
+
+import bisect
+import threading
+import time
+from typing import Any, Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+LabelValues = Tuple[str, ...]
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    parts = [f'{n}="{_escape(str(v))}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+def _number(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) and not value.is_integer() else str(int(value))
+
+class Metric:
+    type = ""
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = (), registry: Optional["Registry"] = None):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self._lock = threading.Lock()
+        (registry or REGISTRY).register(self)
+
+    def _key(self, labels: Dict[str, Any]) -> LabelValues:
+        return tuple(str(labels.get(n, "")) for n in self.label_names)
+
+    def snapshot(self) -> Dict[str, Any]:
+        """Plain-data copy of this metric (sent across processes, merged on render)."""
+        raise NotImplementedError
+
+    @staticmethod
+    def render(snap: Dict[str, Any]) -> List[str]:
+        raise NotImplementedError
+
+class Counter(Metric):
+    """Monotonically increasing count, optionally per label set."""
+
+    type = "counter"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._values: Dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            values = list(self._values.items())
+        return {"name": self.name, "help": self.help, "type": self.type,
+                "labels": self.label_names, "values": values}
+
+    @staticmethod
+    def merge(a: Dict[str, Any], b: Dict[str, Any]) -> Dict[str, Any]:
+        values = dict((tuple(k), v) for k, v in a["values"])
+        for k, v in b["values"]:
+            values[tuple(k)] = values.get(tuple(k), 0) + v
+        return dict(a, values=list(values.items()))
+
+    @staticmethod
+    def render(snap: Dict[str, Any]) -> List[str]:
+        return [f"{snap['name']}{_labels(snap['labels'], k)} {_number(v)}" for k, v in snap["values"]]
+
+class Gauge(Counter):
+    """A value that goes up and down, set directly or read from a callback at scrape time."""
+
+    type = "gauge"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = (),
+                 registry: Optional["Registry"] = None):
+        super().__init__(name, help, labels, registry)
+        self._callback: Optional[Callable[[], Any]] = None
+
+    def set(self, value: float, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def set_function(self, fn: Callable[[], Any]):
+        """Read the value at scrape time: fn returns a number, or {label value tuple: number}."""
+        self._callback = fn
+
+    def snapshot(self) -> Dict[str, Any]:
+        if self._callback is not None:
+            try:
+                value = self._callback()
+            except Exception:
+                value = None
+            if isinstance(value, dict):
+                with self._lock:
+                    self._values = {tuple(str(x) for x in k): v for k, v in value.items()}
+            elif value is not None:
+                self.set(value)
+        return super().snapshot()
+
+class Histogram(Metric):
+    """Distribution of observed values in cumulative buckets."""
+
+    type = "histogram"
+
+    def __init__(self, name: str, help: str, buckets: Sequence[float], labels: Sequence[str] = (),
+                 registry: Optional["Registry"] = None):
+        super().__init__(name, help, labels, registry)
+        self.buckets = tuple(sorted(buckets))
+        # label values -> [per-bucket counts (last is +Inf), sum]
+        self._series: Dict[LabelValues, list] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][i] += 1
+            series[1] += value
+
+    def time(self, **labels) -> "_Timer":
+        """Context manager observing the elapsed seconds of its block."""
+        return _Timer(self, labels)
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            series = [(k, list(counts), total) for k, (counts, total) in self._series.items()]
+        return {"name": self.name, "help": self.help, "type": self.type, "labels": self.label_names,
+                "buckets": self.buckets, "series": series}
+
+    @staticmethod
+    def merge(a: Dict[str, Any], b: Dict[str, Any]) -> Dict[str, Any]:
+        if tuple(a["buckets"]) != tuple(b["buckets"]):
+            return a
+        series = {tuple(k): (list(c), s) for k, c, s in a["series"]}
+        for k, counts, total in b["series"]:
+            k = tuple(k)
+            if k in series:
+                mine, mine_total = series[k]
+                series[k] = ([x + y for x, y in zip(mine, counts)], mine_total + total)
+            else:
+                series[k] = (list(counts), total)
+        return dict(a, series=[(k, c, s) for k, (c, s) in series.items()])
+
+    @staticmethod
+    def render(snap: Dict[str, Any]) -> List[str]:
+        lines = []
+        bounds = list(snap["buckets"]) + [float("inf")]
+        for key, counts, total in snap["series"]:
+            cumulative = 0
+            for bound, count in zip(bounds, counts):
+                cumulative += count
+                le = 'le="' + _number(bound) + '"'
+                lines.append(f"{snap['name']}_bucket{_labels(snap['labels'], key, le)} {cumulative}")
+            lines.append(f"{snap['name']}_sum{_labels(snap['labels'], key)} {_number(total)}")
+            lines.append(f"{snap['name']}_count{_labels(snap['labels'], key)} {cumulative}")
+        return lines
+
+class _Timer:
+    def __init__(self, histogram: Histogram, labels: Dict[str, Any]):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start, **self.labels)
+
+_KINDS = {"counter": Counter, "gauge": Gauge, "histogram": Histogram}
+
+class Registry:
+    def __init__(self):
+        self._metrics: Dict[str, Metric] = {}
+
+    def register(self, metric: Metric):
+        self._metrics[metric.name] = metric
+
+    def snapshot(self) -> List[Dict[str, Any]]:
+        return [m.snapshot() for m in self._metrics.values()]
+
+    def render(self, extra: Iterable[List[Dict[str, Any]]] = ()) -> str:
+        """Prometheus text exposition, with other processes' snapshots added in."""
+        snaps = {s["name"]: s for s in self.snapshot()}
+        for snapshot in extra:
+            for snap in snapshot:
+                mine = snaps.get(snap["name"])
+                if mine is None:
+                    snaps[snap["name"]] = snap
+                elif mine["type"] == snap["type"] and mine["type"] != "gauge":
+                    snaps[snap["name"]] = _KINDS[mine["type"]].merge(mine, snap)
+        lines = []
+        for snap in snaps.values():
+            lines.append(f"# HELP {snap['name']} {snap['help']}")
+            lines.append(f"# TYPE {snap['name']} {snap['type']}")
+            lines.extend(_KINDS[snap["type"]].render(snap))
+        return "\n".join(lines) + "\n"
+
+REGISTRY = Registry()
+
+# ---------- Metrics ----------
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+TOKEN_BUCKETS = (16, 32, 64, 128, 256, 512, 1024, 2048, 4096, 8192)
+RATE_BUCKETS = (1, 2, 5, 10, 20, 30, 50, 75, 100, 200, 500)
+
+TIME_TO_FIRST_TOKEN = Histogram("cybers_time_to_first_token_seconds",
+                                "Time from a chat request reaching the engine to its first streamed token",
+                                LATENCY_BUCKETS)
+TOKENS_PER_SECOND = Histogram("cybers_tokens_per_second", "Decode rate of each reply after its first token",
+                              RATE_BUCKETS)
+PROMPT_TOKENS = Histogram("cybers_prompt_tokens", "Prompt length of each chat request in tokens", TOKEN_BUCKETS)
+GENERATED_TOKENS = Counter("cybers_generated_tokens_total", "Streamed reply tokens")
+REPLIES = Counter("cybers_replies_total", "Chat replies by outcome (ok, cached, bank, cancelled, error)", ["outcome"])
+RESPONSE_CACHE = Counter("cybers_response_cache_lookups_total",
+                         "Response cache lookups by result (hit, miss, capped)", ["result"])
+REPLY_BANK = Counter("cybers_reply_bank_lookups_total",
+                     "Reply bank lookups for first learner messages by result (hit, miss)", ["result"])
+CANCELLATIONS = Counter("cybers_cancellations_total",
+                        "Replies stopped early, by trigger (disconnect, new_message, exit)", ["reason"])
+DRAFT_TOKENS = Counter("cybers_draft_tokens_total", "Tokens proposed by the speculative decoding draft model")
+DRAFT_ACCEPTED = Counter("cybers_draft_tokens_accepted_total",
+                         "Draft tokens the model accepted (acceptance rate = accepted / proposed)")
+QUEUE_WAIT = Histogram("cybers_queue_wait_seconds",
+                       "Time a request waited for a batch slot before its prefill", LATENCY_BUCKETS)
+RED_FLAG_SECONDS = Histogram("cybers_red_flag_detection_seconds",
+                             "Red flag detection time per chat message", LATENCY_BUCKETS, ["stage"])
+RED_FLAGS = Counter("cybers_red_flags_detected_total", "Red flags detected", ["flag"])
+ACTIVE_SESSIONS = Gauge("cybers_active_sessions", "Learner sessions held in memory")
+SESSIONS_EVICTED = Counter("cybers_sessions_evicted_total", "Learner sessions dropped for idling or room")
+SCENARIOS = Counter("cybers_scenarios_total", "Scenario runs by event (started, completed, passed, exited)",
+                    ["event"])
+STATUS_STREAMS = Gauge("cybers_status_streams", "Open /api/scenario/events streams")
+QUEUE_DEPTH = Gauge("cybers_queue_depth", "Chat requests waiting for a batch slot")
+BATCH_SIZE = Gauge("cybers_batch_size", "Replies currently being decoded")
+GPU_MEMORY = Gauge("cybers_gpu_memory_bytes", "GPU memory allocated by the model and caches", ["worker"])
@@ -0,0 +1,340 @@
+"""
+Red flag detection for Cyber Safer.
+
+Every flag's keywords are compiled once into a single regex shaped like a trie
+(keywords sharing a prefix share a branch), so a message is scanned in one
+pass no matter how many keywords there are.
+
+Matching works on whole words: messages are lower-cased, and a keyword only
+counts when it starts and ends on a word boundary ("url" does not fire inside
+"hurl"). Inside a keyword, a space matches any run of whitespace or
+punctuation and an apostrophe is optional (the keyword "don't" matches both
+"don't" and "dont"). A trailing "*" marks a word stem: "block*" matches
+"block", "blocked" and "blocking". A keyword ending in , ? ! or . only counts
+when that punctuation follows it: "is that you," matches "Is that you, Sarah?"
+but not "what is that you want".
+
+Keywords live in flags/*.json, one file per flag, so content authors can tune
+detection without touching code. A flag file may add extra keywords for
+particular scenarios:
+
+  {
+    "id": "verifies_independently",
+    "description": "...",
+    "keywords": ["check myself", "look it up"],
+    "examples": ["I'll text her on her usual number"],
+    "scenarios": {"identity_fake_friend": ["verify with", "real sarah"]}
+  }
+
+"examples" feed the optional semantic stage (SemanticFlagIndex), which catches
+paraphrases the keywords miss by comparing sentence embeddings.
+"""
+
+import os
+import re
+import json
+import hashlib
+from typing import Any, Dict, Iterable, List, NamedTuple, Optional, Set
+
+_SEPARATORS = re.compile(r"\W+")
+_NOT_WORD = re.compile(r"[^\w']+")
+_QUOTES = str.maketrans({"‘": "'", "’": "'", "ʼ": "'", "`": "'"})
+# Punctuation a keyword can end on, to match only where a clause ends
+_CLAUSE_ENDS = ",?!."
+
+class RedFlagMatch(NamedTuple):
+    """One flag found in a message; start/end index into the original message."""
+    flag: str
+    keyword: str
+    start: int
+    end: int
+
+def normalize(text: str) -> str:
+    """Lower-case and straighten quotes, keeping every character's index."""
+    if not text.isascii():
+        text = text.translate(_QUOTES)
+    lowered = text.lower()
+    if len(lowered) != len(text):
+        # A few characters lower-case to more than one; keep those as-is
+        lowered = "".join(c.lower() if len(c.lower()) == 1 else c for c in text)
+    return lowered
+
+def canonical(text: str) -> str:
+    """Keyword or matched text as compared: words split on punctuation, no apostrophes."""
+    return _SEPARATORS.sub(" ", normalize(text).replace("'", "")).strip()
+
+def _key(text: str) -> str:
+    """canonical(text), keeping the punctuation a clause-end keyword ends on."""
+    text = text.rstrip()
+    key = canonical(text)
+    return f"{key} {text[-1]}" if text[-1:] in _CLAUSE_ENDS else key
+
+class _Node:
+    __slots__ = ("children", "end", "stem")
+
+    def __init__(self):
+        self.children: Dict[str, "_Node"] = {}
+        self.end = False
+        self.stem = False
+
+def _render(node: _Node) -> str:
+    """Regex for a trie node; longer continuations are tried before ending here."""
+    branches = []
+    for ch, child in sorted(node.children.items()):
+        if ch == " ":
+            edge = r"\W+"
+        elif ch in _CLAUSE_ENDS:
+            # Always the last character of a keyword
+            branches.append(r"\s*" + re.escape(ch))
+            continue
+        elif ch == "'":
+            edge = "'?"
+        else:
+            edge = re.escape(ch)
+        branches.append(edge + _render(child))
+    if node.stem:
+        branches.append(r"\w*(?!\w)")
+    elif node.end:
+        branches.append(r"(?!\w)")
+    return branches[0] if len(branches) == 1 else "(?:" + "|".join(branches) + ")"
+
+class RedFlagMatcher:
+    """Keywords for all flags compiled into one single-pass pattern."""
+
+    def __init__(self, keywords: Dict[str, Iterable[str]]):
+        self.keywords = {flag: list(words) for flag, words in keywords.items()}
+        self._exact: Dict[str, Set[str]] = {}
+        self._stems: Dict[str, Set[str]] = {}
+        root = _Node()
+        for flag, words in self.keywords.items():
+            for word in words:
+                word = word.strip()
+                stem = word.endswith("*")
+                clause_end = word[-1] if word[-1:] in _CLAUSE_ENDS else ""
+                # Apostrophes stay (optional when matching); other punctuation separates words
+                text = " ".join(_NOT_WORD.sub(" ", normalize(word.rstrip("*"))).split())
+                if not text:
+                    continue
+                text += clause_end
+                node = root
+                for ch in text:
+                    node = node.children.setdefault(ch, _Node())
+                node.end = True
+                node.stem = node.stem or stem
+                (self._stems if stem else self._exact).setdefault(_key(text), set()).add(flag)
+        self._implied = self._prefix_closure()
+        self._memo: Dict[str, Set[str]] = {}
+        self._pattern = re.compile(r"(?<!\w)(?=(" + _render(root) + "))") if root.children else None
+
+    def _prefix_closure(self) -> Dict[str, Set[str]]:
+        """Flags implied by each keyword because a shorter keyword ends inside it.
+
+        The pattern reports only the longest keyword starting at a position, so
+        "is that you really" must also yield the flags of "is that you".
+        """
+        implied: Dict[str, Set[str]] = {}
+        words = [(w, False) for w in self._exact] + [(w, True) for w in self._stems]
+        for word, _ in words:
+            flags = set()
+            for other, stem in words:
+                if word.startswith(other) and (stem or len(word) == len(other) or word[len(other)] == " "):
+                    flags |= (self._stems if stem else self._exact)[other]
+            implied[word] = flags
+        return implied
+
+    def _flags_for(self, matched: str) -> Set[str]:
+        flags = self._memo.get(matched)
+        if flags is None:
+            flags = set()
+            word = _key(matched)
+            if word in self._exact:
+                flags = self._implied[word]
+            else:
+                # Stem matches run to the end of the word; find the longest stem that fits
+                for n in range(len(word), 0, -1):
+                    if word[:n] in self._stems:
+                        flags = self._implied[word[:n]]
+                        break
+            if len(self._memo) < 4096:
+                self._memo[matched] = flags
+        return flags
+
+    def scan(self, message: str) -> List[RedFlagMatch]:
+        """Every flag match in the message, in order of position."""
+        if self._pattern is None:
+            return []
+        matches = []
+        for m in self._pattern.finditer(normalize(message)):
+            start, end = m.span(1)
+            for flag in sorted(self._flags_for(m.group(1))):
+                matches.append(RedFlagMatch(flag, message[start:end], start, end))
+        return matches
+
+    def detect(self, message: str, red_flags: List[str]) -> List[str]:
+        """The flags from red_flags that the message hits, in red_flags order."""
+        if self._pattern is None:
+            return []
+        found: Set[str] = set()
+        for matched in self._pattern.findall(normalize(message)):
+            found |= self._flags_for(matched)
+        return [flag for flag in red_flags if flag in found]
+
+# ---------- Catalogue ----------
+
+class FlagCatalogue:
+    """Flag keywords from flags/*.json, compiled once into one matcher per scenario.
+
+    Scenarios without their own keywords share the default matcher; flags that
+    no file covers fall back to the flag's own name.
+    """
+
+    def __init__(self, keywords: Dict[str, List[str]],
+                 overrides: Optional[Dict[str, Dict[str, List[str]]]] = None,
+                 descriptions: Optional[Dict[str, str]] = None,
+                 examples: Optional[Dict[str, List[str]]] = None):
+        self.keywords = keywords
+        self.overrides = overrides or {}
+        self.descriptions = descriptions or {}
+        self.examples = examples or {}
+        self.default = RedFlagMatcher(keywords)
+        self._matchers: Dict[str, RedFlagMatcher] = {}
+        for scenario_id, extra in self.overrides.items():
+            merged = {flag: list(words) for flag, words in keywords.items()}
+            for flag, words in extra.items():
+                merged.setdefault(flag, []).extend(words)
+            self._matchers[scenario_id] = RedFlagMatcher(merged)
+
+    def matcher_for(self, scenario_id: Optional[str] = None) -> RedFlagMatcher:
+        return self._matchers.get(scenario_id, self.default)
+
+    def detect(self, message: str, red_flags: List[str], scenario_id: Optional[str] = None) -> List[str]:
+        return self.matcher_for(scenario_id).detect(message, red_flags)
+
+    def missing(self, scenarios: Dict[str, Dict[str, Any]]) -> Dict[str, List[str]]:
+        """Flags used by each scenario (red_flags or success_criteria) with no keywords."""
+        result = {}
+        for scenario_id, scenario in scenarios.items():
+            known = self.matcher_for(scenario_id).keywords
+            gaps = [flag for flag in dict.fromkeys(scenario.get("red_flags", []) + scenario.get("success_criteria", []))
+                    if not known.get(flag)]
+            if gaps:
+                result[scenario_id] = gaps
+        return result
+
+def load_flag_catalogue(flags_dir: str = "flags",
+                        scenarios: Optional[Dict[str, Dict[str, Any]]] = None) -> FlagCatalogue:
+    """Load flags/*.json and compile it, checking every scenario flag has keywords."""
+    keywords: Dict[str, List[str]] = {}
+    overrides: Dict[str, Dict[str, List[str]]] = {}
+    descriptions: Dict[str, str] = {}
+    examples: Dict[str, List[str]] = {}
+
+    if not os.path.exists(flags_dir):
+        print(f"⚠️  Flags directory '{flags_dir}' not found")
+    else:
+        for filename in sorted(os.listdir(flags_dir)):
+            if not filename.endswith(".json"):
+                continue
+            try:
+                with open(os.path.join(flags_dir, filename), "r", encoding="utf-8") as f:
+                    data = json.load(f)
+                flag = data.get("id", filename[:-5])
+                keywords[flag] = list(data.get("keywords", []))
+                descriptions[flag] = data.get("description", "")
+                examples[flag] = list(data.get("examples", []))
+                for scenario_id, words in data.get("scenarios", {}).items():
+                    overrides.setdefault(scenario_id, {})[flag] = list(words)
+            except Exception as e:
+                print(f"⚠️  Failed to load {filename}: {e}")
+
+    scenarios = scenarios or {}
+    unknown = [flag for extra in overrides.values() for flag in extra if flag not in keywords]
+    catalogue = FlagCatalogue(keywords, overrides, descriptions, examples)
+    missing = catalogue.missing(scenarios)
+    for scenario_id, flags in missing.items():
+        print(f"⚠️  Scenario '{scenario_id}' uses flags with no keywords in {flags_dir}/: "
+              f"{', '.join(flags)} (matching on the flag name instead)")
+    for scenario_id in overrides:
+        if scenarios and scenario_id not in scenarios:
+            print(f"⚠️  {flags_dir}/ has keywords for unknown scenario '{scenario_id}'")
+    if missing or unknown:
+        # Rebuild with name fallbacks so every flag still has a matcher
+        for flag in unknown + [f for flags in missing.values() for f in flags]:
+            keywords.setdefault(flag, [flag.replace("_", " ")])
+        catalogue = FlagCatalogue(keywords, overrides, descriptions, examples)
+
+    print(f"🚩 Compiled {len(keywords)} red flags ({sum(len(w) for w in keywords.values())} keywords, "
+          f"{len(overrides)} scenario overrides)")
+    return catalogue
+
+# ---------- Semantic detection ----------
+
+class SemanticFlagIndex:
+    """Optional second stage: flags whose example utterances are close in meaning.
+
+    Examples from flags/*.json are embedded once with a small CPU sentence
+    embedding model into a row-normalised matrix, saved under cache_dir and
+    memory-mapped on later starts (the file name hashes the model and the
+    examples, so edits rebuild it). A message costs one embedding plus one
+    matrix-vector product; a flag fires when its closest example reaches the
+    threshold.
+
+    Needs the optional sentence-transformers package.
+    """
+
+    def __init__(self, model, flags: List[str], matrix, threshold: float):
+        import numpy as np
+        self.model = model
+        self.flags = flags
+        self.matrix = matrix
+        self.threshold = threshold
+        # Rows are grouped by flag; _starts[i] is the first row of flag_names[i]
+        self.flag_names = list(dict.fromkeys(flags))
+        self._starts = np.asarray([flags.index(f) for f in self.flag_names])
+
+    @classmethod
+    def build(cls, catalogue: FlagCatalogue, model_name: str, cache_dir: str,
+              threshold: float = 0.6) -> Optional["SemanticFlagIndex"]:
+        """Load or build the example index; None if the dependencies are missing."""
+        try:
+            import numpy as np
+            from sentence_transformers import SentenceTransformer
+        except ImportError as e:
+            print(f"⚠️  Semantic red flags disabled ({e}); pip install sentence-transformers")
+            return None
+
+        flags = [flag for flag, texts in sorted(catalogue.examples.items()) for _ in texts]
+        texts = [text for _, examples in sorted(catalogue.examples.items()) for text in examples]
+        if not texts:
+            print("⚠️  Semantic red flags disabled: no examples in the flag catalogue")
+            return None
+
+        model = SentenceTransformer(model_name, device="cpu")
+        digest = hashlib.sha1(json.dumps([model_name, flags, texts]).encode()).hexdigest()[:16]
+        path = os.path.join(cache_dir, f"semantic_{digest}.npy")
+        if os.path.exists(path):
+            matrix = np.load(path, mmap_mode="r")
+            print(f"🧠 Semantic red flags: mapped {len(texts)} examples from {path}")
+        else:
+            matrix = model.encode(texts, batch_size=64, normalize_embeddings=True,
+                                  convert_to_numpy=True).astype(np.float32)
+            os.makedirs(cache_dir, exist_ok=True)
+            np.save(path, matrix)
+            print(f"🧠 Semantic red flags: embedded {len(texts)} examples -> {path}")
+        return cls(model, flags, matrix, threshold)
+
+    def scores(self, message: str) -> Dict[str, float]:
+        """Best cosine similarity per flag."""
+        import numpy as np
+        vector = self.model.encode([message], normalize_embeddings=True, convert_to_numpy=True)[0]
+        sims = self.matrix @ vector.astype(np.float32)
+        best = np.maximum.reduceat(sims, self._starts)
+        return dict(zip(self.flag_names, best.tolist()))
+
+    def detect(self, message: str, red_flags: List[str]) -> List[str]:
+        """The flags from red_flags that the message is close enough to, in red_flags order."""
+        candidates = [flag for flag in red_flags if flag in self.flag_names]
+        if not candidates:
+            return []
+        scores = self.scores(message)
+        return [flag for flag in candidates if scores[flag] >= self.threshold]
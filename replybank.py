@@ -0,0 +1,106 @@
+"""
+Pre-generated adversary replies for Cyber Safer (built by build_reply_bank.py).
+
+Most learners answer a scenario's opening message in one of a few ways: they
+ask who is writing, refuse to click, ask for proof, or just go along with it.
+The reply bank holds several model replies per scenario for each of those
+learner intents, generated offline in large batches. At serve time the
+learner's first message is classified by keyword, and a hit is answered from
+the bank without the model; anything else (other intents, several intents at
+once, long messages, later turns) goes to the live model.
+
+The bank file is JSON:
+
+  {
+    "version": 1,
+    "model": "meta-llama/Llama-3.1-8B-Instruct",
+    "intents": {"questions_sender": ["who is this", ...], "complies": [...]},
+    "scenarios": {
+      "phishing_prize_winner": {
+        "context": "<hash of the persona's system text and the opener>",
+        "replies": {"questions_sender": ["...", "..."], ...}
+      }
+    }
+  }
+
+A scenario whose persona or opener changed since the build no longer matches
+its context hash and is skipped until the bank is rebuilt.
+"""
+
+import hashlib
+import json
+import os
+import random
+from typing import Any, Dict, List, Optional
+
+from redflags import RedFlagMatcher
+
+BANK_VERSION = 1
+
+def context_hash(system_text: str, opener: str) -> str:
+    """Identifies the prompt a scenario's replies were generated from."""
+    return hashlib.blake2b(json.dumps([system_text, opener]).encode(), digest_size=8).hexdigest()
+
+class IntentClassifier:
+    """Keyword intent detection on the compiled red flag matcher.
+
+    A message gets an intent only if keywords of exactly one intent match and
+    it is short; anything mixed or long is left to the model.
+    """
+
+    def __init__(self, intents: Dict[str, List[str]], max_words: int = 12):
+        self.matcher = RedFlagMatcher(intents)
+        self.intents = list(intents)
+        self.max_words = max_words
+
+    def classify(self, message: str) -> Optional[str]:
+        if len(message.split()) > self.max_words:
+            return None
+        found = set(self.matcher.detect(message, self.intents))
+        return found.pop() if len(found) == 1 else None
+
+class ReplyBank:
+    """Replies per (scenario, intent), loaded from a bank file."""
+
+    def __init__(self, intents: Dict[str, List[str]], replies: Dict[str, Dict[str, List[str]]],
+                 model: str = "", max_words: int = 12):
+        self.replies = replies
+        self.model = model
+        self.classifier = IntentClassifier(intents, max_words)
+
+    @classmethod
+    def load(cls, path: str, contexts: Dict[str, str], max_words: int = 12) -> Optional["ReplyBank"]:
+        """Load a bank file, keeping scenarios whose context hash matches contexts[scenario_id]."""
+        if not os.path.exists(path):
+            return None
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        if data.get("version") != BANK_VERSION:
+            print(f"⚠️  Reply bank {path} has version {data.get('version')}, expected {BANK_VERSION}; not used")
+            return None
+        replies, stale = {}, []
+        for scenario_id, entry in data.get("scenarios", {}).items():
+            if contexts.get(scenario_id) != entry.get("context"):
+                stale.append(scenario_id)
+                continue
+            replies[scenario_id] = {intent: texts for intent, texts in entry.get("replies", {}).items() if texts}
+        if stale:
+            print(f"⚠️  Reply bank skips {len(stale)} changed or unknown scenarios "
+                  f"(rebuild with build_reply_bank.py): {', '.join(sorted(stale))}")
+        return cls(data.get("intents", {}), replies, data.get("model", ""), max_words)
+
+    def pick(self, scenario_id: str, message: str) -> Optional[str]:
+        """A banked reply to the learner's first message in the scenario, or None."""
+        by_intent = self.replies.get(scenario_id)
+        if not by_intent:
+            return None
+        intent = self.classifier.classify(message)
+        texts = by_intent.get(intent) if intent else None
+        return random.choice(texts) if texts else None
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "model": self.model,
+            "scenarios": len(self.replies),
+            "replies": sum(len(t) for by_intent in self.replies.values() for t in by_intent.values()),
+        }
@@ -0,0 +1,107 @@
+"""
+Response cache for Cyber Safer: replays earlier replies to near-identical turns.
+
+A class running the same scenario sends the same few first replies ("who is
+this?"), and the adversary's answers repeat too. Replies are cached under
+(player, scenario, normalised history tail + message, sampling settings); a
+hit streams back word by word like a live reply, without the model.
+
+Each key keeps a few variants and a hit picks one at random. A hit-ratio cap
+sends a share of cacheable requests to the model anyway, so conversations
+stay varied and the variants keep being refreshed. Entries expire after a
+TTL, and the least recently used go first when the cache is full.
+
+Everything runs on the event loop, so there is no locking.
+"""
+
+import asyncio
+import hashlib
+import json
+import random
+import re
+import time
+from collections import OrderedDict, deque
+from typing import AsyncGenerator, Deque, Dict, List, Optional, Sequence, Tuple
+
+def normalise(text: str) -> str:
+    """Lowercase words only, so punctuation, case and spacing don't split keys."""
+    return " ".join(re.findall(r"[a-z0-9']+", text.lower()))
+
+class ResponseCache:
+    """LRU + TTL cache of reply variants with a cap on the share of requests it serves."""
+
+    def __init__(self, max_entries: int = 2048, ttl: float = 3600, variants: int = 3,
+                 max_hit_ratio: float = 0.5, window: int = 500):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.variants = variants
+        self.max_hit_ratio = max_hit_ratio
+        self.hits = 0
+        self.misses = 0
+        self.capped = 0
+        # key -> (stored at, [reply variants])
+        self._entries: "OrderedDict[str, Tuple[float, List[str]]]" = OrderedDict()
+        # Recent lookups (True = served from the cache), for the hit-ratio cap
+        self._recent: Deque[bool] = deque(maxlen=window)
+
+    @staticmethod
+    def key(player: str, scenario: Optional[str], history_tail: Sequence[Dict[str, str]], message: str,
+            sampling: Sequence[float]) -> str:
+        turns = [(m["role"], normalise(m["content"])) for m in history_tail]
+        raw = json.dumps([player, scenario, turns, normalise(message), list(sampling)])
+        return hashlib.blake2b(raw.encode(), digest_size=16).hexdigest()
+
+    def hit_ratio(self) -> float:
+        return sum(self._recent) / len(self._recent) if self._recent else 0.0
+
+    def lookup(self, key: str) -> Tuple[str, Optional[str]]:
+        """("hit", reply), or ("miss" | "capped", None) when the model should answer."""
+        entry = self._entries.get(key)
+        if entry is not None and time.monotonic() - entry[0] > self.ttl:
+            del self._entries[key]
+            entry = None
+        if entry is None:
+            self.misses += 1
+            self._recent.append(False)
+            return "miss", None
+        self._entries.move_to_end(key)
+        if self.hit_ratio() >= self.max_hit_ratio:
+            self.capped += 1
+            self._recent.append(False)
+            return "capped", None
+        self.hits += 1
+        self._recent.append(True)
+        return "hit", random.choice(entry[1])
+
+    def store(self, key: str, reply: str):
+        """Add a finished reply as a variant, replacing the oldest once the key is full."""
+        entry = self._entries.pop(key, None)
+        if entry is None or time.monotonic() - entry[0] > self.ttl:
+            variants = []
+        else:
+            variants = entry[1]
+        if reply not in variants:
+            variants = (variants + [reply])[-self.variants:]
+        self._entries[key] = (time.monotonic(), variants)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "capped": self.capped,
+            "hit_ratio": round(self.hit_ratio(), 3),
+            "max_hit_ratio": self.max_hit_ratio,
+        }
+
+async def replay(text: str, tokens_per_second: float) -> AsyncGenerator[str, None]:
+    """Stream text a word at a time at about the given rate (0 = all at once)."""
+    if tokens_per_second <= 0:
+        yield text
+        return
+    for piece in re.findall(r"\s*\S+(?:\s+$)?", text) or [text]:
+        yield piece
+        await asyncio.sleep(1 / tokens_per_second)
@@ -39,6 +39,7 @@ export CYBERS_PORT="${CYBERS_PORT:-8021}"
 export CYBERS_HOST="${CYBERS_HOST:-127.0.0.1}"
 
 echo "📋 Active Configuration:"
+echo "   Backend: ${CYBERS_BACKEND:-transformers}"
 echo "   Model: $CYBERS_MODEL"
 echo "   Quantization: ${CYBERS_BITS}-bit"
 echo "   Player: $CYBERS_PLAYER"
@@ -71,12 +72,19 @@ if [ ! -d "scenarios" ]; then
     echo "   The server may not work correctly"
 fi
 
+if [ ! -d "flags" ]; then
+    echo "⚠️  Warning: 'flags' directory not found"
+    echo "   Red flags will only match on their own names"
+fi
+
 # ========== MODEL TEST ==========
 
 # Step 1: Test model loading
 echo "Step 1: Testing model loading..."
 echo "--------------------------------"
-if python3 test_model.py; then
+if [ "${CYBERS_BACKEND:-transformers}" != "transformers" ]; then
+    echo "💡 Backend '${CYBERS_BACKEND}' does not use CYBERS_MODEL, skipping model test"
+elif python3 test_model.py; then
     echo ""
     echo "✅ Model test passed!"
 else
@@ -41,6 +41,38 @@ function updateLastMessage(chunk) {
   messagesDiv.scrollTop = messagesDiv.scrollHeight;
 }
 
+// Framed alternative: request the chat stream with
+// Accept: application/x-ndjson and hand the response to readChatFrames.
+// Flags, counter updates and reply text arrive as separate JSON frames, so
+// nothing has to be scanned for markers.
+
+async function readChatFrames(response, onToken) {
+  const reader = response.body.getReader();
+  const decoder = new TextDecoder();
+  let buffered = '';
+  
+  while (true) {
+    const {done, value} = await reader.read();
+    if (done) break;
+    buffered += decoder.decode(value, {stream: true});
+    const lines = buffered.split('\n');
+    buffered = lines.pop();  // keep a partial frame for the next read
+    for (const line of lines) {
+      if (!line) continue;
+      const frame = JSON.parse(line);
+      if (frame.type === 'counter') {
+        updateCounter(frame.found, frame.required);
+      } else if (frame.type === 'flag') {
+        onToken(`🚩 RED FLAG #${frame.number} DETECTED: ${frame.name}\n`);
+      } else if (frame.type === 'token') {
+        onToken(frame.text);
+      } else if (frame.type === 'done') {
+        console.log(`⏱️ Reply: first token ${frame.ttft_ms} ms, total ${frame.total_ms} ms`);
+      }
+    }
+  }
+}
+
 function updateCounter(current, total) {
   // Update the counter display in the header
   const counterElement = document.getElementById('redFlagCounter');
@@ -58,11 +90,49 @@ function updateCounter(current, total) {
   console.log(`🚩 Counter updated: ${current}/${total}`);
 }
 
-// Alternative: Poll for status updates
-// Add this to periodically check the counter:
+// Status updates pushed by the server over /api/scenario/events.
+// The server sends the full status on connect and an event whenever the
+// scenario changes; EventSource reconnects by itself if the stream drops.
 
+let statusEvents = null;
 let statusCheckInterval = null;
 
+function startStatusEvents(onCompleted) {
+  if (statusEvents || statusCheckInterval) return;
+  if (!window.EventSource) {
+    startStatusPolling();
+    return;
+  }
+
+  statusEvents = new EventSource('/api/scenario/events');
+
+  const onStatus = (event) => {
+    const status = JSON.parse(event.data);
+    if (status.active) {
+      updateCounter(status.red_flags_found, status.red_flags_required);
+    }
+  };
+  statusEvents.addEventListener('status', onStatus);
+  statusEvents.addEventListener('red_flags', onStatus);
+  statusEvents.addEventListener('completed', (event) => {
+    onStatus(event);
+    if (onCompleted) onCompleted(JSON.parse(event.data));
+  });
+  statusEvents.onerror = () => {
+    console.warn('Status stream interrupted, reconnecting...');
+  };
+}
+
+function stopStatusEvents() {
+  if (statusEvents) {
+    statusEvents.close();
+    statusEvents = null;
+  }
+  stopStatusPolling();
+}
+
+// Fallback for browsers without EventSource: poll every 2 seconds
+
 function startStatusPolling() {
   if (statusCheckInterval) return;
   
@@ -89,5 +159,5 @@ function stopStatusPolling() {
   }
 }
 
-// Call startStatusPolling() when scenario begins
-// Call stopStatusPolling() when scenario ends
+// Call startStatusEvents() when scenario begins
+// Call stopStatusEvents() when scenario ends
@@ -0,0 +1,390 @@
+"""
+Durable scenario results for Cyber Safer (SQLite in WAL mode).
+
+Sessions, scenario attempts, their turns, detected red flags and final scores
+are written to one SQLite file, so results survive restarts and
+/api/scenario/exit and can be read back for teacher dashboards.
+
+The chat path never touches the disk: the record_* methods queue a statement
+and return. A writer thread drains the queue and commits whatever has built
+up within a short window (or a batch size) in a single transaction, which is
+one fsync for many rows. If the queue fills up (the disk cannot keep up),
+new records are dropped and counted rather than slowing chat down.
+
+Reads open their own connection (WAL lets them run alongside the writer) and
+use the indexes on scenario, session and completion time. Call them off the
+event loop (asyncio.to_thread). Session IDs are login tokens, so reads never
+return them: each attempt carries a "learner" ID instead, a keyed hash of its
+session that groups a learner's attempts but cannot be used as a session.
+
+Teacher analytics read materialised counters instead of scanning attempts:
+per-scenario attempt, completion, pass and score totals, a score histogram,
+and per-flag detected/missed counts. They are updated in the same
+transaction that records each result, so a dashboard query costs the same
+with a hundred attempts or a million.
+"""
+
+import hashlib
+import hmac
+import json
+import os
+import queue
+import secrets
+import sqlite3
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    session_id TEXT PRIMARY KEY,
+    first_seen REAL NOT NULL,
+    last_seen REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS attempts (
+    attempt_id TEXT PRIMARY KEY,
+    session_id TEXT NOT NULL,
+    scenario_id TEXT NOT NULL,
+    category TEXT,
+    player TEXT,
+    started_at REAL NOT NULL,
+    completed_at REAL,
+    score INTEGER,
+    passed INTEGER,
+    red_flags_detected TEXT,
+    success_criteria_met TEXT,
+    success_criteria_total INTEGER
+);
+CREATE INDEX IF NOT EXISTS attempts_by_scenario ON attempts (scenario_id, completed_at);
+CREATE INDEX IF NOT EXISTS attempts_by_session ON attempts (session_id, started_at);
+CREATE INDEX IF NOT EXISTS attempts_by_completion ON attempts (completed_at);
+CREATE TABLE IF NOT EXISTS turns (
+    id INTEGER PRIMARY KEY,
+    attempt_id TEXT NOT NULL,
+    role TEXT NOT NULL,
+    content TEXT NOT NULL,
+    created_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS turns_by_attempt ON turns (attempt_id, id);
+CREATE TABLE IF NOT EXISTS flags (
+    attempt_id TEXT NOT NULL,
+    flag TEXT NOT NULL,
+    detected_at REAL NOT NULL,
+    PRIMARY KEY (attempt_id, flag)
+);
+CREATE INDEX IF NOT EXISTS flags_by_flag ON flags (flag);
+CREATE TABLE IF NOT EXISTS scenario_stats (
+    scenario_id TEXT PRIMARY KEY,
+    category TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    completed INTEGER NOT NULL DEFAULT 0,
+    passed INTEGER NOT NULL DEFAULT 0,
+    score_sum INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS score_buckets (
+    scenario_id TEXT NOT NULL,
+    bucket INTEGER NOT NULL,
+    count INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (scenario_id, bucket)
+);
+CREATE TABLE IF NOT EXISTS flag_stats (
+    scenario_id TEXT NOT NULL,
+    flag TEXT NOT NULL,
+    required INTEGER NOT NULL DEFAULT 0,
+    detected INTEGER NOT NULL DEFAULT 0,
+    missed INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (scenario_id, flag)
+);
+"""
+
+# Scores are counted in buckets of this width (0-9, 10-19, ..., 100)
+SCORE_BUCKET = 10
+
+# SQL and its parameters, or a function run as fn(conn, *params) in the batch's transaction
+Statement = Tuple[Union[str, Callable[..., None]], Tuple[Any, ...]]
+
+class ResultStore:
+    """SQLite store with a batching writer thread."""
+
+    def __init__(self, path: str, flush_interval: float = 0.2, batch_size: int = 500,
+                 max_pending: int = 20000, learner_salt: bytes = b""):
+        self.path = path
+        # Key for learner IDs; a random one means they change on every restart
+        self.learner_salt = learner_salt or secrets.token_bytes(16)
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.written = 0
+        self.batches = 0
+        self.dropped = 0
+        self.failed = 0
+        self._queue: "queue.Queue[Optional[Statement]]" = queue.Queue(maxsize=max_pending)
+        self._thread: Optional[threading.Thread] = None
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.execute("PRAGMA journal_mode=WAL")
+        # Durable at checkpoints rather than every commit; a crash loses at most the last batch
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def open(self, required_flags: Optional[Dict[str, List[str]]] = None):
+        """Create the schema and start the writer thread.
+
+        required_flags (scenario ID -> success criteria) is used to build the
+        analytics counters from stored attempts if they are missing.
+        """
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        conn = self._connect()
+        with conn:
+            conn.executescript(SCHEMA)
+        attempts = conn.execute("SELECT COUNT(*) FROM attempts").fetchone()[0]
+        if attempts and not conn.execute("SELECT COUNT(*) FROM scenario_stats").fetchone()[0]:
+            rebuild_aggregates(conn, required_flags or {})
+            print(f"📈 Rebuilt analytics counters from {attempts} stored attempts")
+        conn.close()
+        self._thread = threading.Thread(target=self._run, name="store-writer", daemon=True)
+        self._thread.start()
+        print(f"🗄️  Result store: {self.path} ({attempts} attempts)")
+
+    def close(self):
+        """Write out everything queued and stop the writer."""
+        if self._thread is None:
+            return
+        self._queue.put(None)
+        self._thread.join(timeout=30)
+        self._thread = None
+
+    # ----- writes (non-blocking) -----
+
+    def _submit(self, sql: Union[str, Callable[..., None]], params: Tuple[Any, ...]):
+        try:
+            self._queue.put_nowait((sql, params))
+        except queue.Full:
+            self.dropped += 1
+
+    def record_attempt(self, attempt_id: str, session_id: str, scenario_id: str, category: Optional[str],
+                       player: str):
+        now = time.time()
+        self._submit("INSERT INTO sessions (session_id, first_seen, last_seen) VALUES (?, ?, ?) "
+                     "ON CONFLICT (session_id) DO UPDATE SET last_seen = excluded.last_seen",
+                     (session_id, now, now))
+        self._submit("INSERT OR IGNORE INTO attempts (attempt_id, session_id, scenario_id, category, player, "
+                     "started_at) VALUES (?, ?, ?, ?, ?, ?)",
+                     (attempt_id, session_id, scenario_id, category, player, now))
+        self._submit("INSERT INTO scenario_stats (scenario_id, category, attempts) VALUES (?, ?, 1) "
+                     "ON CONFLICT (scenario_id) DO UPDATE SET attempts = attempts + 1, category = excluded.category",
+                     (scenario_id, category))
+
+    def record_turn(self, attempt_id: str, role: str, content: str):
+        self._submit("INSERT INTO turns (attempt_id, role, content, created_at) VALUES (?, ?, ?, ?)",
+                     (attempt_id, role, content, time.time()))
+
+    def record_flags(self, attempt_id: str, flags: List[str]):
+        now = time.time()
+        for flag in flags:
+            self._submit("INSERT OR IGNORE INTO flags (attempt_id, flag, detected_at) VALUES (?, ?, ?)",
+                         (attempt_id, flag, now))
+
+    def record_result(self, attempt_id: str, scenario_id: str, result: Dict[str, Any]):
+        """Final score of an attempt (as returned by /api/scenario/complete).
+
+        Only an attempt's first result is kept and counted in the analytics.
+        """
+        self._submit(apply_result, (attempt_id, scenario_id, time.time(), result))
+
+    def _run(self):
+        conn = self._connect()
+        stopping = False
+        while not stopping:
+            item = self._queue.get()
+            if item is None:
+                break
+            # Let the batch build up, then take it in one go: waking per row
+            # would keep taking the GIL from the event loop
+            time.sleep(self.flush_interval)
+            batch = [item]
+            while len(batch) < self.batch_size:
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+            self._write(conn, batch)
+        conn.close()
+
+    def _write(self, conn: sqlite3.Connection, batch: List[Statement]):
+        try:
+            with conn:
+                for sql, params in batch:
+                    run_statement(conn, sql, params)
+            self.written += len(batch)
+        except Exception as e:
+            # Retry one by one so a single bad row does not lose the batch. Not
+            # just sqlite3.Error: apply_result can fail on an odd payload, and
+            # an exception escaping here would end the writer thread.
+            print(f"⚠️  Result store batch failed ({e!r}), retrying {len(batch)} rows singly")
+            for sql, params in batch:
+                try:
+                    with conn:
+                        run_statement(conn, sql, params)
+                    self.written += 1
+                except Exception as e:
+                    self.failed += 1
+                    print(f"⚠️  Result store dropped a row: {e!r}")
+        self.batches += 1
+
+    # ----- reads (blocking; run in a thread) -----
+
+    def results(self, scenario_id: Optional[str] = None, session_id: Optional[str] = None,
+                since: Optional[float] = None, limit: int = 100) -> List[Dict[str, Any]]:
+        """Completed attempts, newest first."""
+        where, params = ["completed_at IS NOT NULL"], []
+        for column, value in (("scenario_id", scenario_id), ("session_id", session_id)):
+            if value:
+                where.append(f"{column} = ?")
+                params.append(value)
+        if since:
+            where.append("completed_at >= ?")
+            params.append(since)
+        conn = self._connect()
+        try:
+            rows = conn.execute(f"SELECT * FROM attempts WHERE {' AND '.join(where)} "
+                                "ORDER BY completed_at DESC LIMIT ?", (*params, limit)).fetchall()
+        finally:
+            conn.close()
+        return [attempt_row(row, self.learner_salt) for row in rows]
+
+    def attempt(self, attempt_id: str) -> Optional[Dict[str, Any]]:
+        """One attempt with its turns and detected flags."""
+        conn = self._connect()
+        try:
+            row = conn.execute("SELECT * FROM attempts WHERE attempt_id = ?", (attempt_id,)).fetchone()
+            if row is None:
+                return None
+            turns = conn.execute("SELECT role, content, created_at FROM turns WHERE attempt_id = ? ORDER BY id",
+                                 (attempt_id,)).fetchall()
+            flags = conn.execute("SELECT flag, detected_at FROM flags WHERE attempt_id = ? ORDER BY detected_at",
+                                 (attempt_id,)).fetchall()
+        finally:
+            conn.close()
+        return dict(attempt_row(row, self.learner_salt), turns=[dict(t) for t in turns], flags=[dict(f) for f in flags])
+
+    def analytics(self, scenario_id: Optional[str] = None, top_flags: int = 10) -> Dict[str, Any]:
+        """Pass rates, score distribution, most-missed flags and category difficulty.
+
+        Read from the counters only; cost does not grow with the number of attempts.
+        """
+        where, params = ("WHERE scenario_id = ?", (scenario_id,)) if scenario_id else ("", ())
+        conn = self._connect()
+        try:
+            scenarios = [dict(row) for row in conn.execute(
+                f"SELECT * FROM scenario_stats {where} ORDER BY scenario_id", params)]
+            buckets = conn.execute(f"SELECT bucket, SUM(count) AS count FROM score_buckets {where} "
+                                   "GROUP BY bucket ORDER BY bucket", params).fetchall()
+            flags = conn.execute(f"SELECT flag, SUM(detected) AS detected, SUM(missed) AS missed, "
+                                 f"MAX(required) AS required FROM flag_stats {where} GROUP BY flag "
+                                 "ORDER BY missed DESC, detected ASC, flag LIMIT ?", (*params, top_flags)).fetchall()
+        finally:
+            conn.close()
+
+        categories: Dict[str, Dict[str, Any]] = {}
+        for row in scenarios:
+            rates(row)
+            total = categories.setdefault(row["category"] or "uncategorized",
+                                          {"scenarios": 0, "attempts": 0, "completed": 0, "passed": 0, "score_sum": 0})
+            total["scenarios"] += 1
+            for key in ("attempts", "completed", "passed", "score_sum"):
+                total[key] += row[key]
+        for total in categories.values():
+            rates(total)
+        # Hardest first: lowest pass rate among categories with results
+        ranked = sorted(categories.items(), key=lambda item: (item[1]["pass_rate"] is None, item[1]["pass_rate"] or 0))
+        return {
+            "scenarios": scenarios,
+            "categories": dict(ranked),
+            "score_distribution": [{"from": b["bucket"] * SCORE_BUCKET,
+                                    "to": min(b["bucket"] * SCORE_BUCKET + SCORE_BUCKET - 1, 100),
+                                    "count": b["count"]} for b in buckets],
+            "most_missed_flags": [dict(f, miss_rate=round(f["missed"] / (f["missed"] + f["detected"]), 3)
+                                       if f["missed"] + f["detected"] else None) for f in flags],
+        }
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "path": self.path,
+            "pending": self._queue.qsize(),
+            "written": self.written,
+            "batches": self.batches,
+            "dropped": self.dropped,
+            "failed": self.failed,
+        }
+
+def learner_id(session_id: str, salt: bytes) -> str:
+    """Stable, non-reversible stand-in for a session ID in results."""
+    return hmac.new(salt, session_id.encode(), hashlib.sha256).hexdigest()[:16]
+
+def attempt_row(row: sqlite3.Row, salt: bytes) -> Dict[str, Any]:
+    result = dict(row)
+    result["learner"] = learner_id(result.pop("session_id"), salt)
+    for key in ("red_flags_detected", "success_criteria_met"):
+        result[key] = json.loads(result[key]) if result[key] else []
+    if result["passed"] is not None:
+        result["passed"] = bool(result["passed"])
+    return result
+
+def rates(row: Dict[str, Any]):
+    """Add pass_rate, completion_rate and mean_score to a counter row."""
+    completed = row["completed"]
+    row["pass_rate"] = round(row["passed"] / completed, 3) if completed else None
+    row["completion_rate"] = round(completed / row["attempts"], 3) if row["attempts"] else None
+    row["mean_score"] = round(row["score_sum"] / completed, 1) if completed else None
+
+def run_statement(conn: sqlite3.Connection, sql: Union[str, Callable[..., None]], params: Tuple[Any, ...]):
+    if callable(sql):
+        sql(conn, *params)
+    else:
+        conn.execute(sql, params)
+
+def count_result(conn: sqlite3.Connection, scenario_id: str, score: int, passed: bool,
+                 required: List[str], detected: List[str]):
+    """Add one completed attempt to the analytics counters."""
+    conn.execute("INSERT INTO scenario_stats (scenario_id) VALUES (?) ON CONFLICT (scenario_id) DO NOTHING",
+                 (scenario_id,))
+    conn.execute("UPDATE scenario_stats SET completed = completed + 1, passed = passed + ?, "
+                 "score_sum = score_sum + ? WHERE scenario_id = ?", (int(passed), score, scenario_id))
+    conn.execute("INSERT INTO score_buckets (scenario_id, bucket, count) VALUES (?, ?, 1) "
+                 "ON CONFLICT (scenario_id, bucket) DO UPDATE SET count = count + 1",
+                 (scenario_id, min(score, 100) // SCORE_BUCKET))
+    for flag in dict.fromkeys(required + detected):
+        hit = flag in detected
+        conn.execute("INSERT INTO flag_stats (scenario_id, flag, required, detected, missed) VALUES (?, ?, ?, ?, ?) "
+                     "ON CONFLICT (scenario_id, flag) DO UPDATE SET required = MAX(required, excluded.required), "
+                     "detected = detected + excluded.detected, missed = missed + excluded.missed",
+                     (scenario_id, flag, int(flag in required), int(hit), int(not hit)))
+
+def apply_result(conn: sqlite3.Connection, attempt_id: str, scenario_id: str, completed_at: float,
+                 result: Dict[str, Any]):
+    """Store an attempt's result and count it, unless it already has one."""
+    cursor = conn.execute(
+        "UPDATE attempts SET completed_at = ?, score = ?, passed = ?, red_flags_detected = ?, "
+        "success_criteria_met = ?, success_criteria_total = ? WHERE attempt_id = ? AND completed_at IS NULL",
+        (completed_at, result["score"], int(result["passed"]), json.dumps(result["red_flags_detected"]),
+         json.dumps(result["success_criteria_met"]), len(result["success_criteria_total"]), attempt_id))
+    if cursor.rowcount:
+        count_result(conn, scenario_id, result["score"], result["passed"], list(result["success_criteria_total"]),
+                     list(result["red_flags_detected"]))
+
+def rebuild_aggregates(conn: sqlite3.Connection, required_flags: Dict[str, List[str]]):
+    """Recount the analytics counters from the attempts table (one full scan)."""
+    with conn:
+        for table in ("scenario_stats", "score_buckets", "flag_stats"):
+            conn.execute(f"DELETE FROM {table}")
+        conn.execute("INSERT INTO scenario_stats (scenario_id, category, attempts) "
+                     "SELECT scenario_id, MAX(category), COUNT(*) FROM attempts GROUP BY scenario_id")
+        for row in conn.execute("SELECT * FROM attempts WHERE completed_at IS NOT NULL").fetchall():
+            count_result(conn, row["scenario_id"], row["score"], bool(row["passed"]),
+                         required_flags.get(row["scenario_id"], []), json.loads(row["red_flags_detected"] or "[]"))
@@ -0,0 +1,148 @@
+"""
+Framed chat streaming for Cyber Safer.
+
+/api/chat/stream answers in plain text by default: a [COUNTER:x/y] marker and
+"🚩 RED FLAG" lines, then the reply, all in one character stream the client
+has to scan. A client that sends Accept: application/x-ndjson (one JSON
+object per line) or Accept: text/event-stream (server-sent events) gets typed
+frames instead:
+
+  {"type": "counter", "found": 1, "required": 2, "t_ms": 3}
+  {"type": "flag", "flag": "questions_sender", "name": "Questions Sender", "number": 1, "t_ms": 3}
+  {"type": "token", "text": "Hmm, I'd slow down", "t_ms": 41}
+  {"type": "done", "chars": 145, "frames": 12, "ttft_ms": 41, "total_ms": 900}
+
+Reply tokens are coalesced in every format (see coalesce()): tokens arriving
+close together go out as one chunk or token frame, so a reply is a handful of
+writes rather than one per token.
+"""
+
+import asyncio
+import json
+from collections import deque
+from typing import Any, AsyncGenerator, AsyncIterable, Deque, Dict, Optional, Tuple
+
+# Media type -> frame format; anything else gets plain text
+FORMATS = {"application/x-ndjson": "ndjson", "text/event-stream": "sse"}
+
+def negotiate(accept: str) -> str:
+    """The frame format asked for in an Accept header: "ndjson", "sse" or "text"."""
+    for part in accept.split(","):
+        media_type, _, params = part.partition(";")
+        fmt = FORMATS.get(media_type.strip().lower())
+        if fmt and "q=0" not in params.replace(" ", "").split(";"):
+            return fmt
+    return "text"
+
+def media_type(fmt: str) -> str:
+    return {"ndjson": "application/x-ndjson", "sse": "text/event-stream"}.get(fmt, "text/plain")
+
+def encode(fmt: str, frame: Dict[str, Any]) -> str:
+    data = json.dumps(frame, ensure_ascii=False)
+    if fmt == "sse":
+        return f"event: {frame['type']}\ndata: {data}\n\n"
+    return data + "\n"
+
+class FlushPolicy:
+    """When coalesce() sends what it has buffered.
+
+    interval: seconds a piece may wait for others to join it (0 = no batching)
+    max_bytes: flush as soon as this much text is waiting (0 = no limit)
+    word_boundary: on a deadline, send up to the last space and keep the
+        partial word for the next chunk (a chunk with no space goes whole)
+    """
+
+    def __init__(self, interval: float = 0.03, max_bytes: int = 512, word_boundary: bool = True):
+        self.interval = interval
+        self.max_bytes = max_bytes
+        self.word_boundary = word_boundary
+
+def split_at_word(text: str) -> Tuple[str, str]:
+    """(text up to and including its last whitespace, the partial word after it)."""
+    cut = max(text.rfind(" "), text.rfind("\n")) + 1
+    return (text[:cut], text[cut:]) if cut else (text, "")
+
+async def coalesce(pieces: AsyncIterable[str], policy: FlushPolicy) -> AsyncGenerator[str, None]:
+    """Join streamed pieces into fewer, larger chunks.
+
+    The first piece goes out at once so time to first token is unchanged.
+    After that pieces are buffered until policy.interval has passed since the
+    first one waiting, policy.max_bytes are waiting, or the source ends. The
+    deadline fires even if the source stalls, so batching holds text back
+    for at most the interval (twice that for the end of a word held back by
+    policy.word_boundary). The flush adapts to the source's pace:
+    while pieces arrive further apart than the interval there is nothing to
+    join, and each is passed straight through instead of waiting.
+    """
+    if policy.interval <= 0:
+        async for piece in pieces:
+            yield piece
+        return
+    loop = asyncio.get_running_loop()
+    # One task reads the source and wakes the loop below, which is also woken
+    # by a timer at the flush deadline (no task or timeout per piece)
+    arrived: Deque[str] = deque()
+    wake = asyncio.Event()
+    finished = False
+    failure: Optional[BaseException] = None
+
+    async def pump():
+        nonlocal finished, failure
+        try:
+            async for piece in pieces:
+                arrived.append(piece)
+                wake.set()
+        except Exception as e:
+            failure = e
+        finally:
+            finished = True
+            wake.set()
+
+    producer = loop.create_task(pump())
+    buffer = ""
+    deadline = 0.0
+    timer = None
+    # Smoothed gap between pieces; starts as "slow" so the first piece is sent at once
+    gap = policy.interval * 2
+    last = loop.time()
+    try:
+        while True:
+            await wake.wait()
+            wake.clear()
+            now = loop.time()
+            while arrived:
+                piece = arrived.popleft()
+                gap = 0.7 * gap + 0.3 * (now - last)
+                last = now
+                if not buffer:
+                    deadline = now + policy.interval
+                buffer += piece
+                if gap > policy.interval or (policy.max_bytes and len(buffer.encode()) >= policy.max_bytes):
+                    # Nothing else will arrive in time to join it, or it is big enough
+                    yield buffer
+                    buffer = ""
+            if buffer and loop.time() >= deadline:
+                chunk, buffer = split_at_word(buffer) if policy.word_boundary else (buffer, "")
+                if chunk:
+                    yield chunk
+                if buffer:
+                    deadline = loop.time() + policy.interval
+            if finished and not arrived:
+                break
+            if buffer and (timer is None or timer.when() != deadline):
+                if timer:
+                    timer.cancel()
+                timer = loop.call_at(deadline, wake.set)
+        if failure:
+            raise failure
+        if buffer:
+            yield buffer
+    finally:
+        if timer:
+            timer.cancel()
+        if not producer.done():
+            producer.cancel()
+            try:
+                await producer
+            except asyncio.CancelledError:
+                pass
@@ -6,12 +6,14 @@ Usage:
   python test_client.py                    # Test health endpoint
   python test_client.py test               # Test model generation
   python test_client.py chat "Hello!"      # Test chat with custom message
+
+See also: bench_load.py for load testing.
 """
 
 import sys
 import requests
 import json
-from time import time
+from time import time, sleep
 
 BASE_URL = "http://localhost:8021"
 
@@ -36,30 +38,27 @@ def test_health():
         return False
 
 def test_model_endpoint():
-    """Test the model generation endpoint."""
-    print("\n🤖 Testing model endpoint...")
-    print("⏳ This may take 10-30 seconds for first generation...")
+    """Wait for the model to finish loading, then run one short generation."""
+    print("\n🤖 Testing model readiness...")
+    print("⏳ The model loads in the background, this may take a few minutes...")
     
     try:
         start = time()
-        response = requests.get(f"{BASE_URL}/api/test", timeout=60)
-        elapsed = time() - start
-        
-        if response.status_code == 200:
+        while True:
+            response = requests.get(f"{BASE_URL}/api/ready", timeout=10)
             data = response.json()
-            print(f"✅ Model test passed in {elapsed:.1f}s")
-            print(f"   Model: {data.get('model')}")
-            print(f"   Device: {data.get('device')}")
-            print(f"   Response: {data.get('response')}")
-            return True
-        else:
-            print(f"❌ Test failed with status {response.status_code}")
-            print(f"   Response: {response.text}")
-            return False
-    except requests.exceptions.Timeout:
-        print("❌ Request timed out after 60 seconds")
-        print("💡 Model might be loading slowly or hung")
-        return False
+            if response.status_code == 200:
+                break
+            if data.get("status") == "error":
+                print(f"❌ Model failed to load: {data.get('error')}")
+                return False
+            if time() - start > 600:
+                print("❌ Model still not ready after 10 minutes")
+                return False
+            sleep(5)
+        
+        print(f"✅ Model ready: {data.get('model')} (loaded in {data.get('loading_seconds')}s)")
+        return test_chat("Say hello in five words.")
     except Exception as e:
         print(f"❌ Error: {e}")
         return False
@@ -0,0 +1,44 @@
+"""
+BatchingEngine failure handling.
+
+Run from the repo root: python -m unittest discover tests
+"""
+
+import asyncio
+import types
+import unittest
+
+import torch
+
+from engine import BatchingEngine
+
+class FailingModel(torch.nn.Module):
+    """A model whose every forward pass fails, like a prefill that runs out of memory."""
+
+    def __init__(self):
+        super().__init__()
+        self.weight = torch.nn.Parameter(torch.zeros(1))
+        self.generation_config = types.SimpleNamespace(eos_token_id=None)
+
+    def forward(self, **kwargs):
+        raise RuntimeError("CUDA out of memory")
+
+class PrefillFailureTest(unittest.TestCase):
+    def test_failed_prefill_fails_the_caller(self):
+        engine = BatchingEngine(FailingModel(), types.SimpleNamespace(eos_token_id=0))
+
+        async def reply():
+            return [piece async for piece in engine.generate([1, 2, 3], max_new_tokens=4)]
+
+        async def main():
+            # Two requests, so the second is admitted after the first fails
+            return await asyncio.wait_for(asyncio.gather(reply(), reply(), return_exceptions=True), timeout=10)
+
+        results = asyncio.run(main())
+        for result in results:
+            self.assertIsInstance(result, RuntimeError)
+            self.assertIn("out of memory", str(result))
+        self.assertEqual(engine.stats()["batch_size"], 0)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,129 @@
+"""
+Prompts assembled from cached fragments vs the full chat template render.
+
+Run from the repo root: python -m unittest discover tests
+Set CYBERS_TINY_MODEL to a local model directory to also check a real tokenizer.
+"""
+
+import os
+import unittest
+from unittest import mock
+
+os.environ.setdefault("CYBERS_STORE", "")
+os.environ.setdefault("CYBERS_CONTENT_POLL", "0")
+
+import cybers
+from backends import ScriptedTokenizer
+
+EXCHANGES = [
+    ("user", "who is this?"),
+    ("assistant", "It's Sarah! I need you to click this link: bit.ly/prize-claim 🎁"),
+    ("user", "  why is it so urgent...\n\nI don't trust this"),
+    ("assistant", "Hmm.\n\nIt expires in 24 hours, just log in with your password & you'll see"),
+    ("user", "I'm going to tell my teacher"),
+    ("assistant", "No wait, don't tell anyone! It's a surprise"),
+    ("user", "that's exactly what a scammer would say"),
+    ("assistant", "ok fine, I'll prove it's me"),
+]
+
+def use_tokenizer(tokenizer):
+    """Point cybers at a tokenizer, as load_model does, and re-run the fragment check."""
+    cybers.tok = tokenizer
+    for cached in (cybers.system_ids, cybers.generation_ids, cybers.fragment_base,
+                   cybers.message_overhead, cybers.prefix_lengths):
+        cached.cache_clear()
+    cybers.prompt_fragments = False
+    if tokenizer is not None:
+        cybers.check_prompt_fragments()
+
+def full_render(session, message):
+    """The prompt the way build_prompt renders it without fragments."""
+    tok = cybers.tok
+    msgs = [{"role": "system", "content": session.system_text}]
+    if session.memory:
+        msgs.append({"role": "system", "content": "Earlier in this conversation:\n" + "\n".join(session.memory)})
+    msgs.extend(session.conversation_history)
+    msgs.append({"role": "user", "content": message})
+    return tok(tok.apply_chat_template(msgs, tokenize=False, add_generation_prompt=True))["input_ids"]
+
+class PromptFragmentsMixin:
+    def setUp(self):
+        self.addCleanup(use_tokenizer, None)
+        use_tokenizer(self.tokenizer())
+        self.assertTrue(cybers.prompt_fragments)
+
+    def assemble(self, session, message):
+        return cybers.assemble_prompt(session.prompt_state(), cybers.history_entry("user", message))
+
+    def assertMatchesFullRender(self, session, message):
+        input_ids = self.assemble(session, message)
+        self.assertIsNotNone(input_ids)
+        self.assertEqual(list(input_ids), list(full_render(session, message)))
+        self.assertEqual(list(cybers.build_prompt(session.prompt_state(), message)[0]), list(input_ids))
+
+    def test_first_message(self):
+        self.assertMatchesFullRender(cybers.Session("s"), "hi")
+
+    def test_scenario_history(self):
+        session = cybers.Session("s")
+        session.add_to_history("assistant", "Hey it's Sarah, can you do me a quick favour?")
+        for role, content in EXCHANGES:
+            session.add_to_history(role, content)
+            self.assertMatchesFullRender(session, "what do you want?")
+
+    def test_messages_added_before_fragments(self):
+        # History from before the model loaded has no cached fragment IDs
+        session = cybers.Session("s")
+        cybers.prompt_fragments = False
+        for role, content in EXCHANGES[:4]:
+            session.add_to_history(role, content)
+        cybers.prompt_fragments = True
+        self.assertEqual(session.history_ids, [None] * 4)
+        self.assertMatchesFullRender(session, "is this a scam?")
+
+    def test_other_persona(self):
+        session = cybers.Session("s")
+        session.system_text = "You are Alex, a chatty classmate.\n\nNever share passwords."
+        for role, content in EXCHANGES[:3]:
+            session.add_to_history(role, content)
+        self.assertMatchesFullRender(session, "ok")
+
+    def test_after_trimming(self):
+        for memory_chars in (0, 400):
+            with self.subTest(memory_chars=memory_chars), \
+                    mock.patch.object(cybers, "HISTORY_TOKENS", 60), \
+                    mock.patch.object(cybers, "HISTORY_SLIDE", 2), \
+                    mock.patch.object(cybers, "HISTORY_MEMORY_CHARS", memory_chars):
+                session = cybers.Session("s")
+                for role, content in EXCHANGES * 2:
+                    session.add_to_history(role, content)
+                self.assertLess(len(session.conversation_history), len(EXCHANGES) * 2)
+                self.assertEqual(session.conversation_history[0]["role"], "user")
+                self.assertEqual(bool(session.memory), bool(memory_chars))
+                self.assertMatchesFullRender(session, "prove it then")
+
+    def test_session_changing_after_snapshot(self):
+        # The event loop may append to or trim the history while the prompt is built
+        session = cybers.Session("s")
+        for role, content in EXCHANGES[:4]:
+            session.add_to_history(role, content)
+        state = session.prompt_state()
+        expected = full_render(session, "really?")
+        for role, content in EXCHANGES[4:]:
+            session.add_to_history(role, content)
+        session.conversation_history.pop(0)
+        session.history_ids.pop(0)
+        self.assertEqual(list(cybers.build_prompt(state, "really?")[0]), list(expected))
+
+class ScriptedTokenizerTest(PromptFragmentsMixin, unittest.TestCase):
+    def tokenizer(self):
+        return ScriptedTokenizer()
+
+@unittest.skipUnless(os.getenv("CYBERS_TINY_MODEL"), "set CYBERS_TINY_MODEL to a local model")
+class TinyTokenizerTest(PromptFragmentsMixin, unittest.TestCase):
+    def tokenizer(self):
+        from transformers import AutoTokenizer
+        return AutoTokenizer.from_pretrained(os.environ["CYBERS_TINY_MODEL"])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,44 @@
+"""
+Red flag keywords from flags/*.json.
+
+Run from the repo root: python -m unittest discover tests
+"""
+
+import unittest
+
+from redflags import RedFlagMatcher, load_flag_catalogue
+
+class FlagKeywordsTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.matcher = load_flag_catalogue("flags").default
+
+    def assertFlags(self, message, flags):
+        self.assertEqual(self.matcher.detect(message, sorted(self.matcher.keywords)), flags, message)
+
+    def test_questions_sender(self):
+        for message in ("Is that you, Sarah?", "is that you?", "wait is that you ,sarah", "is that you really"):
+            self.assertFlags(message, ["questions_sender"])
+
+    def test_questions_sender_not_inside_sentences(self):
+        for message in ("what is that you want", "this is that you sent me", "What is that you mean?"):
+            self.assertFlags(message, [])
+
+    def test_plural_and_my_phrasings(self):
+        for message, flags in (("I will tell parents", ["tells_adult"]),
+                               ("ill tell my teacher", ["tells_adult"]),
+                               ("talk to adults", ["tells_adult"]),
+                               ("suspicious links", ["checks_url", "refuses_to_click"]),
+                               ("don't give information", ["questions_personal_info"])):
+            self.assertFlags(message, flags)
+
+class ClauseEndTest(unittest.TestCase):
+    def test_punctuation_must_follow(self):
+        matcher = RedFlagMatcher({"a": ["is it you,"], "b": ["is it you really"]})
+        self.assertEqual(matcher.detect("Is it you, Sam?", ["a", "b"]), ["a"])
+        self.assertEqual(matcher.detect("is it you really", ["a", "b"]), ["b"])
+        self.assertEqual(matcher.detect("what is it you want", ["a", "b"]), [])
+        self.assertEqual([m.keyword for m in matcher.scan("so... is it you , Sam")], ["is it you ,"])
+
+if __name__ == "__main__":
+    unittest.main()
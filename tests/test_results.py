@@ -0,0 +1,66 @@
+"""
+Access to stored results: teacher key required, session IDs never returned.
+
+Run from the repo root: python -m unittest discover tests
+"""
+
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+os.environ.setdefault("CYBERS_STORE", "")
+os.environ.setdefault("CYBERS_CONTENT_POLL", "0")
+
+from fastapi.testclient import TestClient
+
+import cybers
+from store import ResultStore
+
+SESSION_ID = "learner-session-token"
+RESULT = {"score": 80, "passed": True, "red_flags_detected": ["questions_sender"],
+          "success_criteria_met": ["questions_sender"], "success_criteria_total": ["questions_sender"]}
+
+class ResultsAccessTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        store = ResultStore(os.path.join(directory.name, "results.db"), flush_interval=0,
+                            learner_salt=b"teacher-key")
+        store.open()
+        store.record_attempt("a1", SESSION_ID, "sarah_prize", "phishing", "sarah")
+        store.record_turn("a1", "user", "who is this?")
+        store.record_result("a1", "sarah_prize", RESULT)
+        store.close()
+        for patch in (mock.patch.object(cybers, "result_store", store),
+                      mock.patch.object(cybers, "TEACHER_KEY", "teacher-key")):
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.client = TestClient(cybers.app)
+
+    def get(self, path, key=None):
+        return self.client.get(path, headers={cybers.TEACHER_HEADER: key} if key else {})
+
+    def test_teacher_key_required(self):
+        for path in ("/api/results", "/api/results/a1", f"/api/results?session_id={SESSION_ID}"):
+            self.assertEqual(self.get(path).status_code, 403, path)
+            self.assertEqual(self.get(path, "wrong").status_code, 403, path)
+            self.assertEqual(self.get(path, "teacher-key").status_code, 200, path)
+
+    def test_closed_without_configured_key(self):
+        with mock.patch.object(cybers, "TEACHER_KEY", ""):
+            self.assertEqual(self.get("/api/results", "").status_code, 403)
+            self.assertEqual(self.get("/api/results/a1", "anything").status_code, 403)
+
+    def test_session_id_not_returned(self):
+        listed = self.get("/api/results", "teacher-key").json()["results"]
+        attempt = self.get("/api/results/a1", "teacher-key").json()
+        self.assertEqual(len(listed), 1)
+        for result in (listed[0], attempt):
+            self.assertNotIn("session_id", result)
+            self.assertNotIn(SESSION_ID, str(result))
+            self.assertEqual(result["learner"], listed[0]["learner"])
+        self.assertEqual(attempt["turns"][0]["content"], "who is this?")
+
+if __name__ == "__main__":
+    unittest.main()
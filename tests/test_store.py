@@ -0,0 +1,42 @@
+"""
+ResultStore writer thread.
+
+Run from the repo root: python -m unittest discover tests
+"""
+
+import os
+import tempfile
+import time
+import unittest
+
+from store import ResultStore
+
+RESULT = {"score": 60, "passed": False, "red_flags_detected": [], "success_criteria_met": [],
+          "success_criteria_total": ["questions_sender"]}
+
+class WriterFailureTest(unittest.TestCase):
+    def test_bad_result_does_not_stop_the_writer(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        store = ResultStore(os.path.join(directory.name, "results.db"), flush_interval=0.05)
+        store.open()
+        store.record_attempt("a1", "s1", "sarah_prize", "phishing", "sarah")
+        store.record_attempt("a2", "s2", "sarah_prize", "phishing", "sarah")
+        # A payload missing keys raises KeyError inside apply_result, not sqlite3.Error
+        store.record_result("a1", "sarah_prize", {"score": 10})
+        store.record_result("a2", "sarah_prize", RESULT)
+        deadline = time.monotonic() + 5
+        while store.batches == 0 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertTrue(store._thread.is_alive())
+        # Still writing after the failure
+        store.record_turn("a2", "user", "who is this?")
+        store.close()
+
+        self.assertEqual(store.failed, 1)
+        self.assertEqual(store.dropped, 0)
+        self.assertEqual([r["attempt_id"] for r in store.results()], ["a2"])
+        self.assertEqual(len(store.attempt("a2")["turns"]), 1)
+
+if __name__ == "__main__":
+    unittest.main()
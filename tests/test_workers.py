@@ -0,0 +1,63 @@
+"""
+WorkerPool load failures.
+
+Run from the repo root: python -m unittest discover tests
+"""
+
+import time
+import unittest
+from unittest import mock
+
+import backends
+import workers
+from workers import WorkerPool
+
+class LoadFailureTest(unittest.TestCase):
+    def pool(self, error: Exception) -> WorkerPool:
+        pool = WorkerPool({"max_batch": 1}, workers=2)
+
+        def connect(worker):
+            raise error
+
+        pool._connect = connect
+        self.addCleanup(setattr, pool, "_stopping", True)
+        return pool
+
+    def test_worker_dying_during_load_fails_wait_ready(self):
+        # A worker process that dies while loading closes its pipe: EOFError with no message
+        pool = self.pool(EOFError())
+        with mock.patch.object(workers, "RESTART_DELAY", 0.05):
+            pool.start()
+            with self.assertRaises(RuntimeError) as raised:
+                pool.wait_ready(timeout=10)
+        self.assertIn("Model worker 0 exited during load (EOFError)", str(raised.exception))
+        self.assertIn("Model worker 1 exited during load (EOFError)", str(raised.exception))
+
+    def test_load_error_message_is_kept(self):
+        pool = self.pool(RuntimeError("CUDA out of memory"))
+        with mock.patch.object(workers, "RESTART_DELAY", 0.05):
+            pool.start()
+            with self.assertRaisesRegex(RuntimeError, "^CUDA out of memory$"):
+                pool.wait_ready(timeout=10)
+
+    def test_failed_load_stops_respawning(self):
+        attempts = []
+
+        def connect(pool, worker):
+            attempts.append(worker.index)
+            raise RuntimeError("bad weights")
+
+        config = {"model_name": "test", "max_batch": 1}
+        with mock.patch.object(workers, "RESTART_DELAY", 0.05), \
+                mock.patch.object(workers, "MAX_RESTART_DELAY", 0.05), \
+                mock.patch.object(WorkerPool, "_connect", connect), \
+                mock.patch.object(backends, "load_tokenizer", lambda config: None):
+            with self.assertRaisesRegex(RuntimeError, "bad weights"):
+                backends.load_backend("transformers", config, workers=2)
+            time.sleep(0.2)
+            settled = len(attempts)
+            time.sleep(0.3)
+        self.assertEqual(len(attempts), settled)
+
+if __name__ == "__main__":
+    unittest.main()
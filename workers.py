@@ -0,0 +1,442 @@
+#!/usr/bin/env python3
+"""
+Out-of-process model workers for Cyber Safer.
+
+By default the web process owns the model (one uvicorn worker = one model
+copy). With workers, inference runs in separate processes and the web tier
+only tokenizes prompts and relays text:
+
+  CYBERS_WORKERS=N               the app spawns N worker processes over pipes
+                                 and restarts any that crash
+  CYBERS_WORKER_ADDRESSES=a,b    the app connects to workers started on their
+                                 own, so several uvicorn workers can share them:
+                                   python workers.py --listen /tmp/cybers-0.sock
+
+Each worker loads the model once and runs a BatchingEngine (see engine.py).
+Requests go to the least-loaded worker, preferring the one that served the
+session last so its KV cache can be reused. Messages are plain dicts over a
+multiprocessing Connection:
+
+  app -> worker   {"op": "generate", "id", "input_ids", "max_new_tokens",
+                   "temperature", "top_p", "prefix_lengths", "session_id"}
+                  {"op": "cancel", "id"}   {"op": "forget", "session_id"}
+  worker -> app   {"op": "ready", "pid"}   {"op": "error", "error"}
+                  {"op": "text", "id", "text"}   {"op": "done", "id"}
+                  {"op": "failed", "id", "error"}   {"op": "stats", "stats"}
+"""
+
+import argparse
+import asyncio
+import itertools
+import multiprocessing as mp
+import os
+import threading
+import time
+from multiprocessing.connection import Client, Connection, Listener
+from typing import Any, AsyncGenerator, Dict, List, Optional, Sequence, Tuple
+
+from backends import config_from_env, load_engine, tiny_config
+from metrics import REGISTRY
+
+# Seconds between a worker's stats messages (they double as its heartbeat)
+HEARTBEAT = 1.0
+# Restart / reconnect delay after a worker goes away, doubling up to the max
+RESTART_DELAY = 1.0
+MAX_RESTART_DELAY = 30.0
+
+# ---------- Worker side ----------
+
+class WorkerServer:
+    """Serves generation requests from one or more app connections onto an engine."""
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.loop = asyncio.new_event_loop()
+
+    def serve(self, conn: Connection):
+        """Handle one app connection until it closes (blocking)."""
+        done = asyncio.run_coroutine_threadsafe(self._handle(conn), self.loop)
+        done.result()
+
+    def run_forever(self):
+        self.loop.run_forever()
+
+    async def _handle(self, conn: Connection):
+        tasks: Dict[int, asyncio.Task] = {}
+        inbox: asyncio.Queue = asyncio.Queue()
+        # Connection.recv blocks, so a thread feeds this connection's messages to the loop
+        def read():
+            while True:
+                try:
+                    msg = conn.recv()
+                except (EOFError, OSError):
+                    msg = None
+                self.loop.call_soon_threadsafe(inbox.put_nowait, msg)
+                if msg is None:
+                    return
+        threading.Thread(target=read, name="worker-conn", daemon=True).start()
+        heartbeat = asyncio.ensure_future(self._heartbeat(conn))
+        try:
+            while True:
+                msg = await inbox.get()
+                if msg is None or msg["op"] == "shutdown":
+                    break
+                if msg["op"] == "generate":
+                    tasks[msg["id"]] = asyncio.ensure_future(self._generate(conn, msg, tasks))
+                elif msg["op"] == "cancel":
+                    task = tasks.pop(msg["id"], None)
+                    if task:
+                        task.cancel()
+                elif msg["op"] == "forget":
+                    self.engine.forget_session(msg["session_id"])
+        finally:
+            heartbeat.cancel()
+            for task in tasks.values():
+                task.cancel()
+            conn.close()
+
+    async def _generate(self, conn: Connection, msg: Dict[str, Any], tasks: Dict[int, asyncio.Task]):
+        rid = msg["id"]
+        try:
+            async for text in self.engine.generate(
+                    msg["input_ids"], max_new_tokens=msg["max_new_tokens"], temperature=msg["temperature"],
+                    top_p=msg["top_p"], prefix_lengths=msg["prefix_lengths"], session_id=msg["session_id"]):
+                conn.send({"op": "text", "id": rid, "text": text})
+            conn.send({"op": "done", "id": rid})
+        except asyncio.CancelledError:
+            raise
+        except (EOFError, OSError):
+            pass  # the app went away; _handle cleans up
+        except Exception as e:
+            try:
+                conn.send({"op": "failed", "id": rid, "error": str(e)})
+            except (EOFError, OSError):
+                pass
+        finally:
+            tasks.pop(rid, None)
+
+    async def _heartbeat(self, conn: Connection):
+        try:
+            while True:
+                conn.send({"op": "stats", "stats": self.engine.stats(), "metrics": REGISTRY.snapshot()})
+                await asyncio.sleep(HEARTBEAT)
+        except (EOFError, OSError):
+            pass
+
+def worker_main(conn: Connection, config: Dict[str, Any]):
+    """Entry point of a worker process spawned by a WorkerPool (one pipe)."""
+    try:
+        _, _, engine = load_engine(config)
+    except Exception as e:
+        print(f"❌ Model worker failed to load: {e}")
+        conn.send({"op": "error", "error": str(e)})
+        return
+    server = WorkerServer(engine)
+    threading.Thread(target=server.run_forever, name="worker-loop", daemon=True).start()
+    conn.send({"op": "ready", "pid": os.getpid()})
+    server.serve(conn)
+
+def listen_main(address: str, config: Dict[str, Any], authkey: bytes):
+    """Standalone worker accepting app connections on a socket (several uvicorn workers can share it)."""
+    _, _, engine = load_engine(config)
+    server = WorkerServer(engine)
+    threading.Thread(target=server.run_forever, name="worker-loop", daemon=True).start()
+    with Listener(parse_address(address), authkey=authkey) as listener:
+        print(f"🔌 Model worker {os.getpid()} listening on {address}")
+        while True:
+            try:
+                conn = listener.accept()
+            except (OSError, EOFError) as e:
+                print(f"⚠️  Rejected worker connection: {e}")
+                continue
+            conn.send({"op": "ready", "pid": os.getpid()})
+            threading.Thread(target=server.serve, args=(conn,), name="worker-serve", daemon=True).start()
+
+def parse_address(address: str):
+    """'host:port' for TCP, anything else is a Unix socket path."""
+    host, sep, port = address.rpartition(":")
+    if sep and port.isdigit() and "/" not in address:
+        return (host or "127.0.0.1", int(port))
+    return address
+
+# ---------- App side ----------
+
+class WorkerHandle:
+    """The app's end of one worker: its connection, in-flight requests and last stats."""
+
+    def __init__(self, index: int, address: Optional[str] = None):
+        self.index = index
+        self.address = address  # None: a process this app spawns and restarts
+        self.process: Optional[mp.Process] = None
+        self.conn: Optional[Connection] = None
+        self.pid: Optional[int] = None
+        self.ready = False
+        self.error: Optional[str] = None
+        self.restarts = 0
+        self.last_stats: Dict[str, Any] = {}
+        self.last_metrics: List[Dict[str, Any]] = []
+        self.last_seen = 0.0
+        # request id -> (event loop, queue, session id) of the consumer
+        self.inflight: Dict[int, Tuple[asyncio.AbstractEventLoop, asyncio.Queue, Optional[str]]] = {}
+        self.send_lock = threading.Lock()
+
+    def send(self, msg: Dict[str, Any]) -> bool:
+        conn = self.conn
+        if conn is None:
+            return False
+        try:
+            with self.send_lock:
+                conn.send(msg)
+            return True
+        except (EOFError, OSError):
+            return False
+
+    def deliver(self, rid: int, item: Any, final: bool = False):
+        """Hand a text piece, exception or end marker (None) to a waiting consumer."""
+        entry = self.inflight.pop(rid, None) if final else self.inflight.get(rid)
+        if entry:
+            loop, queue, _ = entry
+            loop.call_soon_threadsafe(queue.put_nowait, item)
+
+    def fail_inflight(self, error: Exception):
+        for rid in list(self.inflight):
+            self.deliver(rid, error, final=True)
+
+    def describe(self) -> Dict[str, Any]:
+        return {
+            "index": self.index,
+            "address": self.address,
+            "pid": self.pid,
+            "ready": self.ready,
+            "inflight": len(self.inflight),
+            "restarts": self.restarts,
+            "error": self.error,
+            "engine": self.last_stats or None,
+        }
+
+class WorkerPool:
+    """Routes generations to model worker processes; same interface as BatchingEngine.
+
+    Workers are either spawned here (restarted with backoff when they die) or
+    reached at the given addresses (reconnected when they come back).
+    """
+
+    def __init__(self, config: Dict[str, Any], workers: int = 0, addresses: Sequence[str] = (),
+                 authkey: bytes = b""):
+        self.config = config
+        self.max_batch_size = config["max_batch"]
+        self.authkey = authkey
+        self.workers = ([WorkerHandle(i, address) for i, address in enumerate(addresses)]
+                        or [WorkerHandle(i) for i in range(workers)])
+        self.affinity: Dict[str, int] = {}  # session id -> worker index holding its KV
+        self.ready = threading.Event()
+        self.completed = 0
+        self._ids = itertools.count(1)
+        self._ctx = mp.get_context("spawn")  # CUDA cannot be used in forked children
+        self._started = False
+        self._stopping = False
+
+    def start(self):
+        """Start (or connect to) every worker (idempotent)."""
+        if self._started:
+            return
+        self._started = True
+        for worker in self.workers:
+            threading.Thread(target=self._supervise, args=(worker,),
+                             name=f"model-worker-{worker.index}", daemon=True).start()
+
+    def stop(self):
+        """Shut workers down for good (app shutdown); spawned processes exit with their pipe."""
+        self._stopping = True
+        for worker in self.workers:
+            worker.send({"op": "shutdown"})
+
+    def wait_ready(self, timeout: Optional[float] = None) -> bool:
+        """Block until at least one worker can take requests, or every worker failed to load."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not self.ready.wait(0.5):
+            if all(w.error is not None and not w.ready for w in self.workers) and not any(w.address for w in self.workers):
+                raise RuntimeError("; ".join(sorted({w.error for w in self.workers})))
+            if deadline is not None and time.monotonic() > deadline:
+                return False
+        return True
+
+    def stats(self) -> Dict[str, Any]:
+        live = [w.last_stats for w in self.workers if w.ready and w.last_stats]
+        return {
+            "queue_depth": sum(s.get("queue_depth", 0) for s in live),
+            "batch_size": sum(s.get("batch_size", 0) for s in live),
+            "max_batch_size": self.max_batch_size * len(self.workers),
+            "completed": self.completed,
+            "gpu_memory_bytes": sum(s.get("gpu_memory_bytes", 0) for s in live),
+            "workers": [w.describe() for w in self.workers],
+        }
+
+    def metric_snapshots(self) -> List[List[Dict[str, Any]]]:
+        """Each live worker's metrics registry, as of its last heartbeat."""
+        return [w.last_metrics for w in self.workers if w.ready and w.last_metrics]
+
+    def forget_session(self, session_id: str):
+        index = self.affinity.pop(session_id, None)
+        if index is not None:
+            self.workers[index].send({"op": "forget", "session_id": session_id})
+
+    def cancel_session(self, session_id: str):
+        """Stop a session's in-flight replies: the worker drops the row, the consumer's stream ends."""
+        for worker in self.workers:
+            for rid, (_, _, sid) in list(worker.inflight.items()):
+                if sid == session_id:
+                    worker.send({"op": "cancel", "id": rid})
+                    worker.deliver(rid, None, final=True)
+
+    def pick(self, session_id: Optional[str]) -> WorkerHandle:
+        """Least-loaded ready worker, unless the session's own worker still has room."""
+        ready = [w for w in self.workers if w.ready]
+        if not ready:
+            raise RuntimeError("No model worker is available")
+        index = self.affinity.get(session_id) if session_id else None
+        if index is not None:
+            worker = self.workers[index]
+            if worker.ready and len(worker.inflight) < self.max_batch_size:
+                return worker
+        return min(ready, key=lambda w: len(w.inflight))
+
+    async def generate(self, input_ids: List[int], max_new_tokens: int = 250,
+                       temperature: float = 0.7, top_p: float = 0.9,
+                       prefix_lengths: Sequence[int] = (),
+                       session_id: Optional[str] = None) -> AsyncGenerator[str, None]:
+        """Send a prompt to a worker and yield its decoded text as it streams back."""
+        worker = self.pick(session_id)
+        if session_id:
+            previous = self.affinity.get(session_id)
+            if previous is not None and previous != worker.index:
+                # The session moved, so its KV on the old worker is dead weight
+                self.workers[previous].send({"op": "forget", "session_id": session_id})
+            self.affinity[session_id] = worker.index
+        rid = next(self._ids)
+        queue: asyncio.Queue = asyncio.Queue()
+        worker.inflight[rid] = (asyncio.get_running_loop(), queue, session_id)
+        finished = False
+        try:
+            if not worker.send({"op": "generate", "id": rid, "input_ids": list(input_ids),
+                                "max_new_tokens": max_new_tokens, "temperature": temperature,
+                                "top_p": top_p, "prefix_lengths": tuple(prefix_lengths),
+                                "session_id": session_id}):
+                raise RuntimeError(f"Model worker {worker.index} is not reachable")
+            while True:
+                item = await queue.get()
+                if item is None:
+                    finished = True
+                    self.completed += 1
+                    break
+                if isinstance(item, BaseException):
+                    finished = True
+                    raise item
+                yield item
+        finally:
+            worker.inflight.pop(rid, None)
+            if not finished:
+                # Consumer went away mid-reply; free the worker's batch row
+                worker.send({"op": "cancel", "id": rid})
+
+    # ----- supervision -----
+
+    def _supervise(self, worker: WorkerHandle):
+        """Keep a worker connected for the life of the app, restarting it when it dies."""
+        delay = RESTART_DELAY
+        while not self._stopping:
+            try:
+                self._connect(worker)
+                if worker.ready:
+                    delay = RESTART_DELAY
+                    self._read(worker)
+            except Exception as e:
+                # A pipe closing mid-load raises EOFError with no message
+                stage = "while serving" if worker.ready else "during load"
+                worker.error = str(e) or f"Model worker {worker.index} exited {stage} ({type(e).__name__})"
+            was_ready = worker.ready
+            self._disconnect(worker)
+            if self._stopping:
+                return
+            if was_ready:
+                print(f"⚠️  Model worker {worker.index} went away, {'restarting' if worker.address is None else 'reconnecting'} in {delay:.0f}s")
+            time.sleep(delay)
+            delay = min(delay * 2, MAX_RESTART_DELAY)
+            worker.restarts += 1
+
+    def _connect(self, worker: WorkerHandle):
+        if worker.address is None:
+            parent, child = self._ctx.Pipe()
+            worker.process = self._ctx.Process(target=worker_main, args=(child, self.config),
+                                               name=f"cybers-model-worker-{worker.index}", daemon=True)
+            worker.process.start()
+            child.close()
+            worker.conn = parent
+        else:
+            worker.conn = Client(parse_address(worker.address), authkey=self.authkey)
+        hello = worker.conn.recv()
+        if hello["op"] == "error":
+            raise RuntimeError(hello["error"])
+        worker.pid = hello["pid"]
+        worker.ready = True
+        worker.error = None
+        worker.last_seen = time.monotonic()
+        self.ready.set()
+        print(f"🔌 Model worker {worker.index} ready (pid {worker.pid})")
+
+    def _read(self, worker: WorkerHandle):
+        """Dispatch a worker's messages until its connection closes."""
+        while True:
+            try:
+                msg = worker.conn.recv()
+            except (EOFError, OSError):
+                return
+            worker.last_seen = time.monotonic()
+            op = msg["op"]
+            if op == "text":
+                worker.deliver(msg["id"], msg["text"])
+            elif op == "done":
+                worker.deliver(msg["id"], None, final=True)
+            elif op == "failed":
+                worker.deliver(msg["id"], RuntimeError(msg["error"]), final=True)
+            elif op == "stats":
+                worker.last_stats = msg["stats"]
+                worker.last_metrics = msg.get("metrics", [])
+
+    def _disconnect(self, worker: WorkerHandle):
+        worker.ready = False
+        worker.last_stats = {}
+        worker.last_metrics = []
+        worker.fail_inflight(RuntimeError(f"Model worker {worker.index} exited"))
+        if worker.conn is not None:
+            worker.conn.close()
+            worker.conn = None
+        if worker.process is not None:
+            worker.process.join(timeout=5)
+            if worker.process.is_alive():
+                worker.process.kill()
+            worker.process = None
+        # Sessions routed here lost their KV along with the worker
+        for session_id, index in list(self.affinity.items()):
+            if index == worker.index:
+                self.affinity.pop(session_id, None)
+        if not any(w.ready for w in self.workers):
+            self.ready.clear()
+
+# ---------- Standalone worker ----------
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a Cyber Safer model worker")
+    parser.add_argument("--listen", required=True,
+                        help="Unix socket path or host:port to accept app connections on")
+    args = parser.parse_args()
+    authkey = os.getenv("CYBERS_WORKER_KEY", "")
+    if not authkey:
+        parser.error("set CYBERS_WORKER_KEY (shared with the app) before listening on a socket")
+    config = config_from_env()
+    if os.getenv("CYBERS_BACKEND") == "tiny":
+        config = tiny_config(config)
+    listen_main(args.listen, config, authkey.encode())
+
+if __name__ == "__main__":
+    main()